@@ -0,0 +1,8 @@
+"""
+Micro-benchmarks, run from the top of the tree, eg:
+
+    python -m benchmarks.encrypt
+    python -m benchmarks.results
+    python -m benchmarks.badges
+    python -m benchmarks.endpoints
+"""
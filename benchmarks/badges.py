@@ -0,0 +1,102 @@
+"""
+Badge requests per second through the WSGI app
+
+Times cold renders, cache hits, conditional requests answered with a 304
+and re-rendering after new results invalidate a branch.  Requests are made
+in-process with webapp2's Request.blank, so this measures our handler and
+not the network.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import time
+
+import webapp2
+
+from theopencorps import app
+from theopencorps.badges import BADGES, STYLES, badge_cache
+from theopencorps.results import results_store
+
+
+def _report(label, count, elapsed):
+    print("%-28s %8d requests in %6.3fs  %10.1f requests/s  %8.1fus each" % (
+        label, count, elapsed, count / elapsed, 1e6 * elapsed / count))
+
+
+def _commit(number):
+    return hashlib.sha1(str(number).encode("ascii")).hexdigest()
+
+
+def _get(url, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return webapp2.Request.blank(url, headers=headers).get_response(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--projects", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    store = results_store(app)
+    cache = badge_cache(app)
+    for number in range(args.projects):
+        store.record("owner/project%d" % number, "master", _commit(number),
+                     1451606400.0 + number,
+                     {"passed": 10.0, "failed": float(number % 3 == 0),
+                      "coverage": 50.0 + number % 50, "cells": 900.0 + number})
+
+    urls = ["/badges/owner/project%d/%s.svg?style=%s" % (number, metric, style)
+            for number in range(args.projects)
+            for metric in sorted(BADGES)
+            for style in sorted(STYLES)]
+
+    start = time.time()
+    etags = [_get(url).headers["ETag"] for url in urls]
+    _report("render (miss)", len(urls), time.time() - start)
+
+    requests = [(urls[i % len(urls)], etags[i % len(urls)])
+                for i in range(args.requests)]
+    start = time.time()
+    for url, _ in requests:
+        _get(url)
+    _report("cache hit (200)", len(requests), time.time() - start)
+
+    start = time.time()
+    for url, etag in requests:
+        assert _get(url, etag).status_int == 304
+    _report("conditional (304)", len(requests), time.time() - start)
+
+    start = time.time()
+    for number in range(args.projects):
+        store.record("owner/project%d" % number, "master", _commit(number),
+                     1451606400.0 + number, {"failed": 0.0})
+    for url in urls:
+        _get(url)
+    _report("invalidate + re-render", len(urls), time.time() - start)
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
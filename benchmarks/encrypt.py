@@ -0,0 +1,128 @@
+"""
+Secrets per second through TravisEndpoint.encrypt
+
+Compares parsing the repository key for every secret (what encrypt used to
+do) with the cached parsed key used by encrypt / encrypt_many, and the
+fan-out across repositories of encrypt_repos.  Keys are served by a stub
+transport so no network is involved.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import base64
+import json
+import time
+
+import rsa
+from rsa.asn1 import OpenSSLPubKey
+from pyasn1.codec.der import encoder
+from pyasn1.type import univ
+
+from theopencorps.endpoints import APIEndpointBase
+from theopencorps.endpoints.futures import Future
+from theopencorps.endpoints.transport import Headers, Response, Transport
+from theopencorps.endpoints.travis import TravisEndpoint
+
+
+class KeyTransport(Transport):
+    """
+    Answers /repos/<owner>/<repo>/key with the same public key
+    """
+    def __init__(self, pem):
+        self.body = json.dumps({"key": pem}).encode("utf8")
+
+    def fetch_async(self, url, **kwargs):
+        future = Future()
+        future.set_result(Response(200, self.body, Headers()))
+        return future
+
+    def wait_any(self, rpcs):
+        return rpcs[0]
+
+
+def openssl_pem(pubkey):
+    """
+    Travis hands out keys in the OpenSSL (SubjectPublicKeyInfo) PEM form,
+    which rsa can load but not save
+    """
+    info = OpenSSLPubKey()
+    info["header"]["oid"] = univ.ObjectIdentifier("1.2.840.113549.1.1.1")
+    info["key"] = univ.BitString.fromOctetString(pubkey.save_pkcs1(format="DER"))
+    body = base64.b64encode(encoder.encode(info)).decode("ascii")
+    lines = [body[i:i+64] for i in range(0, len(body), 64)]
+    return "-----BEGIN PUBLIC KEY-----\n%s\n-----END PUBLIC KEY-----\n" % \
+           "\n".join(lines)
+
+
+def _rate(label, count, elapsed):
+    print("%-28s %8d secrets in %6.3fs  %10.1f secrets/s" % (
+        label, count, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repos", type=int, default=20)
+    parser.add_argument("--secrets", type=int, default=10,
+                        help="secrets per repository")
+    parser.add_argument("--bits", type=int, default=2048)
+    args = parser.parse_args()
+
+    pubkey, _ = rsa.newkeys(args.bits)
+    pem = openssl_pem(pubkey)
+
+    APIEndpointBase.rate_limiter = None
+    transport = KeyTransport(pem)
+    travis = TravisEndpoint("token", transport=transport)
+    secrets = ["SECRET_%d=%s" % (i, "x" * 32) for i in range(args.secrets)]
+    repos = [("owner", "repo%d" % i) for i in range(args.repos)]
+    total = len(repos) * len(secrets)
+
+    start = time.time()
+    for owner, repo in repos:
+        for secret in secrets:
+            key = rsa.PublicKey.load_pkcs1_openssl_pem(travis.get_key(owner, repo))
+            rsa.encrypt(secret.encode("utf8"), key)
+    _rate("parse key per secret", total, time.time() - start)
+
+    # Memoisation is per instance, so a fresh endpoint starts cold
+    travis = TravisEndpoint("token", transport=transport)
+    start = time.time()
+    for owner, repo in repos:
+        for secret in secrets:
+            travis.encrypt(owner, repo, secret)
+    _rate("encrypt (cached key)", total, time.time() - start)
+
+    travis = TravisEndpoint("token", transport=transport)
+    start = time.time()
+    for owner, repo in repos:
+        travis.encrypt_many(owner, repo, secrets)
+    _rate("encrypt_many", total, time.time() - start)
+
+    travis = TravisEndpoint("token", transport=transport)
+    start = time.time()
+    travis.encrypt_repos(dict((repo, secrets) for repo in repos))
+    _rate("encrypt_repos", total, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Throughput and latency of the endpoint classes against a local fake API
+
+Each scenario drives GithubEndpoint / TravisEndpoint through the pooled
+HTTP transport against benchmarks.fakeapi and reports requests per second,
+p50 / p99 latency, and the requests and bytes each operation cost on the
+wire.  For the sync patterns latency is per call.  For async and fan-out it
+is the time from the start of the batch to each result being available.
+
+    python -m benchmarks.endpoints --latency 0.02 --error-rate 0.01
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import logging
+import time
+
+from benchmarks.fakeapi import Faults, FakeAPIServer
+from theopencorps.endpoints import APIEndpointBase, HTTPException
+from theopencorps.endpoints.futures import Backoff
+from theopencorps.endpoints.github import GithubEndpoint
+from theopencorps.endpoints.ratelimit import RateLimiter
+from theopencorps.endpoints.transport import PooledHTTPTransport, TransportError
+from theopencorps.endpoints.travis import TravisEndpoint
+from theopencorps.logparse import CocotbParser, LogPipeline
+
+_FAILURES = (HTTPException, TransportError)
+
+
+def _timed(count, func):
+    """
+    Call func(i) count times, returns (latencies, errors)
+    """
+    latencies, errors = [], 0
+    for index in range(count):
+        start = time.time()
+        try:
+            func(index)
+        except _FAILURES:
+            errors += 1
+        latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def sync_get_repo(github, travis, count):
+    return _timed(count, lambda i: github.get_repo("bench", "repo%d" % (i % 50)))
+
+
+def sync_get_head(github, travis, count):
+    return _timed(count, lambda i: github.get_head("bench", "repo%d" % i))
+
+
+def sync_get_head_watched(github, travis, count):
+    # Webhooks arrive for these repos, with a push for every 20 reads
+    for repo in range(50):
+        github.watch("/repos/bench/watched%d" % repo)
+
+    def _read(i):
+        if i % 20 == 0:
+            github.head_moved("bench", "watched%d" % (i % 50), "master")
+        github.get_head("bench", "watched%d" % (i % 50))
+    return _timed(count, _read)
+
+
+def sync_merge(github, travis, count):
+    return _timed(count, lambda i: github.merge("bench", "repo%d" % i, "%040x" % i))
+
+
+def sync_fork(github, travis, count):
+    backoff = Backoff(initial=0.01, maximum=0.05)
+    return _timed(count, lambda i: github.fork("bench", "repo%d" % i, "org",
+                                               backoff=backoff))
+
+
+def sync_travis_sync(github, travis, count):
+    backoff = Backoff(initial=0.01, maximum=0.05)
+    return _timed(count, lambda i: travis.sync(backoff=backoff))
+
+
+def sync_read_log(github, travis, count):
+    return _timed(count, lambda i: travis.read_log(
+        10000 + i, LogPipeline(CocotbParser()), chunk_size=64*1024))
+
+
+def async_request_json(github, travis, count):
+    start = time.time()
+    results = [github.request_json("/repos/bench/async%d" % i) for i in range(count)]
+    latencies, errors = [], 0
+    for result in results:
+        if result.get_result() is None:
+            errors += 1
+        latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def async_chained(github, travis, count):
+    start = time.time()
+    futures = [github.request_json("/repos/bench/chain%d" % i).then(
+        lambda repo: github.request_json("/repos/bench/%s/git/refs/heads/%s" % (
+            repo["name"], repo["default_branch"]))) for i in range(count)]
+    latencies, errors = [], 0
+    for future in futures:
+        if future.get_result() is None:
+            errors += 1
+        latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def fan_out_request_many(github, travis, count):
+    start = time.time()
+    latencies, errors = [], 0
+    for result in github.request_many(["/repos/bench/fan%d" % i for i in range(count)],
+                                      max_in_flight=8, ordered=False):
+        if result.error is not None:
+            errors += 1
+        latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def fan_out_travis_jobs(github, travis, count):
+    start = time.time()
+    latencies, errors = [], 0
+    for result in travis.get_jobs([10000 + i for i in range(count)]):
+        if result.error is not None:
+            errors += 1
+        latencies.append(time.time() - start)
+    return latencies, errors
+
+
+def fan_out_propagate(github, travis, count):
+    # Ten forks of each upstream
+    pairs = [(("bench", "upstream%d" % (i // 10), "master"),
+              ("org", "fork%d" % i, "master")) for i in range(count)]
+    start = time.time()
+    results = github.propagate(pairs, max_in_flight=8)
+    elapsed = time.time() - start
+    errors = sum(1 for result in results if result.action == "failed")
+    return [elapsed] * len(results), errors
+
+
+def fan_out_sync_builds(github, travis, count):
+    return _timed(count, lambda i: travis.sync_builds(1))
+
+
+SCENARIOS = [
+    ("sync get_repo",           sync_get_repo,          1),
+    ("sync get_head",           sync_get_head,          1),
+    ("sync get_head watched",   sync_get_head_watched,  1),
+    ("sync merge",              sync_merge,             1),
+    ("sync fork",               sync_fork,              0.1),
+    ("sync travis sync",        sync_travis_sync,       0.1),
+    ("sync read_log",           sync_read_log,          0.1),
+    ("async request_json",      async_request_json,     1),
+    ("async then",              async_chained,          1),
+    ("fan-out request_many",    fan_out_request_many,   1),
+    ("fan-out get_jobs",        fan_out_travis_jobs,    1),
+    ("fan-out propagate",       fan_out_propagate,      1),
+    ("fan-out sync_builds",     fan_out_sync_builds,    0.02),
+]
+
+
+def _percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(server, label, scenario, count):
+    # Fresh budgets and caches, so one scenario can't warm the next
+    APIEndpointBase.rate_limiter = RateLimiter()
+    APIEndpointBase.response_cache.clear()
+    transport = PooledHTTPTransport(max_per_host=8)
+    github = GithubEndpoint("bench", transport=transport)
+    travis = TravisEndpoint("bench", transport=transport)
+
+    requests, sent = server.api.requests, server.api.bytes_sent
+    start = time.time()
+    latencies, errors = scenario(github, travis, count)
+    elapsed = time.time() - start
+    requests, sent = server.api.requests - requests, server.api.bytes_sent - sent
+    transport.close()
+
+    print("%-22s %6d %9.1f %9.2f %9.2f %8.1f %10.0f %6d" % (
+        label, count, count / elapsed,
+        1000 * _percentile(latencies, 0.5), 1000 * _percentile(latencies, 0.99),
+        float(requests) / count, float(sent) / count, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--count", type=int, default=500,
+                        help="operations per scenario (scaled down for slow ones)")
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--conflict-rate", type=float, default=0.1)
+    parser.add_argument("--accepted-rate", type=float, default=0.1)
+    parser.add_argument("--diverged-rate", type=float, default=0.5)
+    parser.add_argument("--payload-bytes", type=int, default=0)
+    parser.add_argument("--log-bytes", type=int, default=1024*1024)
+    parser.add_argument("--rate-limit", type=int, default=10**9)
+    parser.add_argument("--only", action="append", default=[],
+                        help="run scenarios whose name contains this")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    server = FakeAPIServer(Faults(latency=args.latency, jitter=args.jitter,
+                                  error_rate=args.error_rate,
+                                  conflict_rate=args.conflict_rate,
+                                  accepted_rate=args.accepted_rate,
+                                  diverged_rate=args.diverged_rate,
+                                  payload_bytes=args.payload_bytes,
+                                  log_bytes=args.log_bytes,
+                                  rate_limit=args.rate_limit)).start()
+    # Class-wide so that invalidation, which isn't per instance, goes there too
+    GithubEndpoint._endpoint = server.url
+    TravisEndpoint._endpoint = server.url + "/travis"
+    print("%-22s %6s %9s %9s %9s %8s %10s %6s" % (
+        "scenario", "ops", "ops/s", "p50 ms", "p99 ms", "req/op", "bytes/op", "errors"))
+    try:
+        for label, scenario, scale in SCENARIOS:
+            if args.only and not any(name in label for name in args.only):
+                continue
+            run(server, label, scenario, max(1, int(args.count * scale)))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""
+Local stand-in for the GitHub and Travis APIs
+
+Serves the routes GithubEndpoint and TravisEndpoint use, GitHub at the
+root and Travis under /travis, with keep-alive connections, ETags and
+X-RateLimit headers like the real thing.  Faults can be injected: latency,
+5xx errors, 202s and 409s from merges, and padding to make payloads large.
+
+    server = FakeAPIServer(Faults(latency=0.02)).start()
+    github = GithubEndpoint("token")
+    github._endpoint = server.url
+    travis = TravisEndpoint("token")
+    travis._endpoint = server.url + "/travis"
+
+Run as a module to serve until interrupted.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+
+
+class Faults(object):
+    """
+    What to inject into responses
+
+        latency         seconds added to every response
+        jitter          up to this many more seconds, at random
+        error_rate      fraction of requests answered with a 502
+        accepted_rate   fraction of merges answered 202 (accepted)
+        conflict_rate   fraction of merges answered 409 (conflict)
+        diverged_rate   fraction of ref updates refused as not fast-forwards
+        payload_bytes   padding added to repository and file payloads
+        rate_limit      requests per token per window
+        window          rate limit window in seconds
+        sync_polls      /users/ reports is_syncing this many times after a sync
+        builds          builds in each Travis repository's history
+        log_bytes       size of each job log
+    """
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 accepted_rate=0.0, conflict_rate=0.0, diverged_rate=0.0,
+                 payload_bytes=0,
+                 rate_limit=5000, window=3600, sync_polls=2, builds=100,
+                 log_bytes=64*1024, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.accepted_rate = accepted_rate
+        self.conflict_rate = conflict_rate
+        self.diverged_rate = diverged_rate
+        self.payload_bytes = payload_bytes
+        self.rate_limit = rate_limit
+        self.window = window
+        self.sync_polls = sync_polls
+        self.builds = builds
+        self.log_bytes = log_bytes
+        self.random = random.Random(seed)
+
+
+def _sha(*parts):
+    return hashlib.sha1(repr(parts).encode("utf8")).hexdigest()
+
+
+class FakeAPI(object):
+    """
+    The state behind the server and the route handlers
+
+    Handlers take (method, match, query, body, token) and return
+    (status, payload, headers) where payload is JSON-able or bytes.
+    """
+    def __init__(self, faults=None):
+        self.faults = faults or Faults()
+        self.refs = {}
+        self.contents = {}
+        self.syncing = {}
+        self.budgets = {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self._key = None
+        self._lock = threading.Lock()
+        self.routes = [(method, re.compile(pattern + "$"), handler) for method, pattern, handler in [
+            ("GET",     r"/user",                                       self.user),
+            ("GET",     r"/users/([^/]+)/repos",                        self.user_repos),
+            ("GET",     r"/repos/([^/]+)/([^/]+)",                      self.repo),
+            ("GET",     r"/repos/([^/]+)/([^/]+)/git/refs/heads/(.+)",  self.get_ref),
+            ("PATCH",   r"/repos/([^/]+)/([^/]+)/git/refs/heads/(.+)",  self.set_ref),
+            ("GET",     r"/repos/([^/]+)/([^/]+)/contents/(.+)",        self.get_contents),
+            ("PUT",     r"/repos/([^/]+)/([^/]+)/contents/(.+)",        self.put_contents),
+            ("POST",    r"/repos/([^/]+)/([^/]+)/merges",               self.merge),
+            ("POST",    r"/repos/([^/]+)/([^/]+)/forks",                self.fork),
+            ("POST",    r"/repos/([^/]+)/([^/]+)/hooks",                self.created),
+            ("POST",    r"/repos/([^/]+)/([^/]+)/statuses/(\w+)",       self.created),
+            ("GET",     r"/travis/repos/(\d+)/builds",                  self.travis_builds),
+            ("GET",     r"/travis/repos/([^/]+)/([^/]+)/key",           self.travis_key),
+            ("GET",     r"/travis/repos/([^/]+)/([^/]+)",               self.travis_repo),
+            ("GET",     r"/travis/builds/(\d+)",                        self.travis_build),
+            ("GET",     r"/travis/jobs/(\d+)/log",                      self.travis_log),
+            ("GET",     r"/travis/jobs/(\d+)",                          self.travis_job),
+            ("POST",    r"/travis/users/sync",                          self.travis_sync),
+            ("GET",     r"/travis/users/",                              self.travis_user),
+            ("GET",     r"/travis/hooks",                               self.travis_hooks),
+            ("PUT",     r"/travis/hooks(?:/\d+)?",                      self.travis_hook),
+        ]]
+
+    def _padding(self):
+        return "x" * self.faults.payload_bytes
+
+    # GitHub
+
+    def user(self, method, match, query, body, token):
+        return 200, {"login": "bench", "id": 1}, {}
+
+    def user_repos(self, method, match, query, body, token):
+        page = int(query.get("page", ["1"])[0])
+        repos = [{"name": "repo%d" % (i + 100 * (page - 1)),
+                  "owner": {"login": match.group(1)}} for i in range(100)]
+        headers = {}
+        if page < 3:
+            headers["Link"] = '<%s?per_page=100&page=%d>; rel="next"' % (
+                match.group(0), page + 1)
+        return 200, repos, headers
+
+    def repo(self, method, match, query, body, token):
+        owner, name = match.groups()
+        return 200, {"name": name, "full_name": "%s/%s" % (owner, name),
+                     "owner": {"login": owner}, "default_branch": "master",
+                     "padding": self._padding()}, {}
+
+    def get_ref(self, method, match, query, body, token):
+        with self._lock:
+            sha = self.refs.setdefault(match.groups(), _sha(*match.groups()))
+        return 200, {"ref": "refs/heads/" + match.group(3),
+                     "object": {"sha": sha, "type": "commit"}}, {}
+
+    def set_ref(self, method, match, query, body, token):
+        update = json.loads(body)
+        sha = update["sha"]
+        if not update.get("force") and \
+                self.faults.random.random() < self.faults.diverged_rate:
+            return 422, {"message": "Update is not a fast forward"}, {}
+        with self._lock:
+            self.refs[match.groups()] = sha
+        return 200, {"object": {"sha": sha}}, {}
+
+    def get_contents(self, method, match, query, body, token):
+        key = match.groups()
+        with self._lock:
+            content = self.contents.get(key)
+        if content is None:
+            content = ("%s\n%s" % (match.group(3), self._padding())).encode("utf8")
+        return 200, {"sha": _sha(content), "encoding": "base64",
+                     "content": base64.b64encode(content).decode("ascii")}, {}
+
+    def put_contents(self, method, match, query, body, token):
+        content = base64.b64decode(json.loads(body)["content"])
+        with self._lock:
+            self.contents[match.groups()] = content
+        return 201, {"content": {"sha": _sha(content)}}, {}
+
+    def merge(self, method, match, query, body, token):
+        head = json.loads(body)["head"]
+        roll = self.faults.random.random()
+        if roll < self.faults.conflict_rate:
+            return 409, {"message": "Merge conflict"}, {}
+        roll -= self.faults.conflict_rate
+        if roll < self.faults.accepted_rate:
+            return 202, {"sha": _sha("merge", head)}, {}
+        return 201, {"sha": _sha("merge", head)}, {}
+
+    def fork(self, method, match, query, body, token):
+        owner, name = match.groups()
+        organisation = json.loads(body)["organization"] if body else "bench"
+        return 202, {"name": name, "full_name": "%s/%s" % (organisation, name),
+                     "owner": {"login": organisation}, "default_branch": "master"}, {}
+
+    def created(self, method, match, query, body, token):
+        return 201, {}, {}
+
+    # Travis
+
+    def travis_repo(self, method, match, query, body, token):
+        return 200, {"repo": {"id": 1, "slug": "/".join(match.groups()),
+                              "last_build_number": str(self.faults.builds)}}, {}
+
+    def _build(self, number):
+        return {"id": 1000 + number, "number": str(number), "state": "passed",
+                "job_ids": [10000 + 2 * number, 10001 + 2 * number]}
+
+    def travis_builds(self, method, match, query, body, token):
+        after = int(query.get("after_number", [self.faults.builds + 1])[0])
+        numbers = range(min(after - 1, self.faults.builds), 0, -1)[:25]
+        return 200, {"builds": [self._build(number) for number in numbers],
+                     "commits": []}, {}
+
+    def travis_build(self, method, match, query, body, token):
+        return 200, {"build": self._build(int(match.group(1)) - 1000)}, {}
+
+    def travis_job(self, method, match, query, body, token):
+        job = int(match.group(1))
+        return 200, {"job": {"id": job, "build_id": 1000 + (job - 10000) // 2,
+                             "state": "passed", "log_id": job}}, {}
+
+    def travis_log(self, method, match, query, body, token):
+        line = b"     0.00ns INFO     cocotb.regression     Test Passed: test_%d\n"
+        log = b"".join(line % i for i in range(self.faults.log_bytes // len(line) + 1))
+        return 200, log[:self.faults.log_bytes], {"Content-Type": "text/plain"}
+
+    def travis_sync(self, method, match, query, body, token):
+        with self._lock:
+            self.syncing[token] = self.faults.sync_polls
+        return 200, {"result": True}, {}
+
+    def travis_user(self, method, match, query, body, token):
+        with self._lock:
+            remaining = self.syncing.get(token, 0)
+            self.syncing[token] = max(0, remaining - 1)
+        return 200, {"user": {"login": "bench", "is_syncing": remaining > 0,
+                              "synced_at": "2016-01-01T00:00:00Z"}}, {}
+
+    def travis_hooks(self, method, match, query, body, token):
+        return 200, {"hooks": [{"id": i, "name": "repo%d" % i, "active": False}
+                               for i in range(50)]}, {}
+
+    def travis_hook(self, method, match, query, body, token):
+        return 200, {"result": True}, {}
+
+    def travis_key(self, method, match, query, body, token):
+        with self._lock:
+            if self._key is None:
+                import rsa
+                from benchmarks.encrypt import openssl_pem
+                self._key = openssl_pem(rsa.newkeys(1024)[0])
+        return 200, {"key": self._key}, {}
+
+    # Serving
+
+    def rate_limit(self, token):
+        """
+        Count a request against token, returns the X-RateLimit headers or
+        None if the budget is exhausted
+        """
+        now = time.time()
+        with self._lock:
+            reset, used = self.budgets.get(token, (now + self.faults.window, 0))
+            if reset <= now:
+                reset, used = now + self.faults.window, 0
+            used += 1
+            self.budgets[token] = (reset, used)
+        headers = {"X-RateLimit-Limit": str(self.faults.rate_limit),
+                   "X-RateLimit-Remaining": str(max(0, self.faults.rate_limit - used)),
+                   "X-RateLimit-Reset": str(int(reset))}
+        return headers if used <= self.faults.rate_limit else None
+
+    # pylint: disable=too-many-arguments
+    def handle(self, method, path, body, headers):
+        """
+        Returns (status, body bytes, headers)
+        """
+        delay = self.faults.latency + self.faults.random.random() * self.faults.jitter
+        if delay:
+            time.sleep(delay)
+        parts = urlsplit(path)
+        query = parse_qs(parts.query)
+        token = headers.get("Authorization", "")
+
+        limits = self.rate_limit(token)
+        if limits is None:
+            return 403, b'{"message": "API rate limit exceeded"}', {}
+        if self.faults.random.random() < self.faults.error_rate:
+            return 502, b"<html>Bad Gateway</html>", limits
+
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(parts.path)
+            if match is not None and route_method == method:
+                break
+        else:
+            return 404, b'{"message": "Not Found"}', limits
+
+        status, payload, extra = handler(method, match, query, body, token)
+        extra.update(limits)
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode("utf8")
+
+        if method == "GET" and status == 200:
+            if "Range" in headers:
+                return self._range(payload, headers["Range"], extra)
+            etag = '"%s"' % hashlib.sha1(payload).hexdigest()
+            extra["ETag"] = etag
+            if headers.get("If-None-Match") == etag:
+                return 304, b"", extra
+        return status, payload, extra
+
+    @staticmethod
+    def _range(payload, header, extra):
+        first, last = re.match(r"bytes=(\d+)-(\d*)", header).groups()
+        first = int(first)
+        if first >= len(payload):
+            return 416, b"", extra
+        last = min(int(last) if last else len(payload) - 1, len(payload) - 1)
+        extra["Content-Range"] = "bytes %d-%d/%d" % (first, last, len(payload))
+        return 206, payload[first:last + 1], extra
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, don't let them wait on an ACK
+    disable_nagle_algorithm = True
+
+    def _serve(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        status, content, headers = self.server.api.handle(
+            self.command, self.path, body, self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        with self.server.api._lock:
+            self.server.api.requests += 1
+            self.server.api.bytes_sent += len(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+    def log_message(self, *args):     # pylint: disable=arguments-differ
+        pass
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server for a FakeAPI on localhost
+    """
+    daemon_threads = True
+
+    def __init__(self, faults=None, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _Handler)
+        self.api = FakeAPI(faults)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="fakeapi")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeAPIServer(Faults(latency=args.latency, error_rate=args.error_rate),
+                           port=args.port)
+    print("Serving on %s (Travis at %s/travis)" % (server.url, server.url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
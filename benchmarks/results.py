@@ -0,0 +1,126 @@
+"""
+Recording and querying build history in the ResultsStore
+
+Records a synthetic history (a build every ten minutes or so, a few out of
+order) then times range queries against a linear scan of the same rows
+held as a list of dicts, rollup queries, and serialisation.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import random
+import time
+
+from theopencorps.results import ResultsStore, Series
+
+DAY = 24 * 3600
+
+
+def _report(label, count, elapsed, unit="ops"):
+    print("%-28s %8d %s in %7.3fs  %12.1f %s/s  %9.2fus each" % (
+        label, count, unit, elapsed, count / elapsed, unit,
+        1e6 * elapsed / count))
+
+
+def history(builds, seed=0):
+    """
+    (commit, time, metrics) for builds builds, roughly in time order
+    """
+    rng = random.Random(seed)
+    when = 1451606400.0
+    for number in range(builds):
+        when += rng.uniform(60, 1140)
+        # Builds occasionally finish out of order
+        jitter = -rng.uniform(0, 3600) if rng.random() < 0.01 else 0
+        commit = hashlib.sha1(str(number).encode("ascii")).hexdigest()
+        yield commit, when + jitter, {"passed": float(rng.randint(90, 100)),
+                                      "failed": float(rng.randint(0, 3)),
+                                      "cells": float(rng.randint(900, 1100)),
+                                      "coverage": rng.uniform(70, 90)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--builds", type=int, default=1000000)
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--scans", type=int, default=20,
+                        help="queries to time by linear scan")
+    args = parser.parse_args()
+
+    rows = list(history(args.builds))
+    store = ResultsStore()
+    start = time.time()
+    for index, (commit, when, metrics) in enumerate(rows):
+        store.record("project", "branch%d" % (index % args.branches),
+                     commit, when, metrics)
+    _report("record", len(rows), time.time() - start, "builds")
+
+    series = store.series("project", "branch0")
+    size = len(series.dumps())
+    print("%-28s %8d rows, %d bytes serialised, %.1f bytes/row" % (
+        "branch0", len(series), size, float(size) / len(series)))
+
+    first, last = series.times[0], series.times[-1]
+    rng = random.Random(1)
+    windows = []
+    for _ in range(args.queries):
+        lo = rng.uniform(first, last - 30 * DAY)
+        windows.append((lo, lo + 30 * DAY))
+
+    start = time.time()
+    returned = 0
+    for lo, hi in windows:
+        returned += len(series.query(lo, hi, ["cells"])["time"])
+    _report("30 day query", len(windows), time.time() - start, "queries")
+    print("%-28s %8.1f rows per query" % ("", float(returned) / len(windows)))
+
+    dicts = [{"time": when, "commit": commit, "metrics": metrics}
+             for index, (commit, when, metrics) in enumerate(rows)
+             if index % args.branches == 0]
+    start = time.time()
+    for lo, hi in windows[:args.scans]:
+        [row["metrics"]["cells"] for row in dicts if lo <= row["time"] < hi]
+    _report("30 day query (scan)", args.scans, time.time() - start, "queries")
+
+    start = time.time()
+    for lo, hi in windows:
+        series.rollup("day", lo, hi, ["cells", "coverage"])
+    _report("30 day rollup", len(windows), time.time() - start, "queries")
+
+    start = time.time()
+    for _ in range(100):
+        series.rollup("week", metrics=["cells"])
+    _report("full history weekly rollup", 100, time.time() - start, "queries")
+
+    start = time.time()
+    blob = series.dumps()
+    _report("dumps", 1, time.time() - start, "series")
+    start = time.time()
+    Series.loads(blob)
+    _report("loads", 1, time.time() - start, "series")
+
+
+if __name__ == "__main__":
+    main()
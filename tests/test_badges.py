@@ -0,0 +1,87 @@
+"""
+Badge ETags agree between instances sharing results
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+import webapp2
+
+from theopencorps.badges import BadgePage, metric_etag, render_metric
+from theopencorps.endpoints.sharedcache import LocalCache, SharedCache
+from theopencorps.results import ResultsStore
+
+URL = "/badges/o/r/status.svg"
+
+
+class TestBadgePage(unittest.TestCase):
+
+    def setUp(self):
+        shared = SharedCache(LocalCache())
+        self.instances = []
+        for _ in range(2):
+            app = webapp2.WSGIApplication([(r'/badges/([^/]+/[^/]+)/(\w+)\.svg', BadgePage)])
+            app.registry["results"] = ResultsStore(shared=shared)
+            self.instances.append(app)
+
+    def get(self, app, etag=None):
+        headers = {"If-None-Match": etag} if etag else {}
+        return webapp2.Request.blank(URL, headers=headers).get_response(app)
+
+    def record(self, commit, failed):
+        self.instances[0].registry["results"].record(
+            "o/r", "master", commit, 100.0, {"passed": 1, "failed": failed})
+
+    def test_instances_agree(self):
+        self.record("a" * 40, 0)
+        here, there = [self.get(app) for app in self.instances]
+        self.assertEqual(here.headers["ETag"], there.headers["ETag"])
+        self.assertIn("passing", there.body)
+        self.assertEqual(self.get(self.instances[1], here.headers["ETag"]).status_int, 304)
+
+    def test_new_result_changes_etag(self):
+        self.record("a" * 40, 0)
+        before = self.get(self.instances[1]).headers["ETag"]
+        self.record("b" * 40, 1)
+        response = self.get(self.instances[1], before)
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers["ETag"], before)
+        self.assertIn("failing", response.body)
+
+
+class TestMetricEtag(unittest.TestCase):
+
+    def test_keyed_on_result(self):
+        latest = {"commit": "a" * 40, "passed": 3.0, "failed": 0.0}
+        self.assertEqual(render_metric(latest, "status").etag, metric_etag(latest, "status"))
+        self.assertEqual(metric_etag(latest, "status"),
+                         metric_etag(dict(latest, passed=4.0), "status"))
+        self.assertNotEqual(metric_etag(latest, "status"),
+                            metric_etag(dict(latest, commit="b" * 40), "status"))
+        self.assertNotEqual(metric_etag(latest, "status"),
+                            metric_etag(latest, "status", "flat-square"))
+        self.assertNotEqual(metric_etag(None, "status"), metric_etag(latest, "status"))
+
+
+if __name__ == "__main__":
+    unittest.main()
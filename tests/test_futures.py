@@ -0,0 +1,125 @@
+"""
+then() and gather() without background threads, as on App Engine
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from theopencorps.endpoints import futures
+from theopencorps.endpoints.futures import Chainable, gather
+
+
+class ScriptedTransport(object):
+    """
+    wait_any() completes RPCs in the order their names are given
+    """
+    def __init__(self, *order):
+        self.order = list(order)
+        self.events = []
+
+    def wait_any(self, rpcs):
+        first = min(rpcs, key=lambda rpc: self.order.index(rpc.name))
+        first.complete()
+        return first
+
+
+class ScriptedRPC(Chainable):
+
+    def __init__(self, transport, name, value):
+        self.transport = transport
+        self.name = name
+        self.value = value
+        self.completed = False
+
+    def complete(self):
+        if not self.completed:
+            self.completed = True
+            self.transport.events.append("%s done" % self.name)
+
+    def get_result(self):
+        self.complete()
+        return self.value
+
+
+class TestDeferredChains(unittest.TestCase):
+
+    def setUp(self):
+        self.background = futures.BACKGROUND_THREADS
+        futures.BACKGROUND_THREADS = False
+
+    def tearDown(self):
+        futures.BACKGROUND_THREADS = self.background
+
+    def continuation(self, transport, name, following=None):
+        def _then(value):
+            transport.events.append("then %s" % name)
+            return following if following is not None else value * 10
+        return _then
+
+    def test_continuations_run_in_completion_order(self):
+        transport = ScriptedTransport("second", "first")
+        first = ScriptedRPC(transport, "first", 1)
+        second = ScriptedRPC(transport, "second", 2)
+        gathered = gather(first.then(self.continuation(transport, "first")),
+                          second.then(self.continuation(transport, "second")))
+        self.assertEqual(transport.events, [])
+        self.assertEqual(gathered.get_result(), [10, 20])
+        # The second continuation ran while the first RPC was outstanding
+        self.assertEqual(transport.events,
+                         ["second done", "then second", "first done", "then first"])
+
+    def test_chained_rpc_is_waited_on_alongside(self):
+        transport = ScriptedTransport("second", "third", "first")
+        first = ScriptedRPC(transport, "first", 1)
+        second = ScriptedRPC(transport, "second", 2)
+        third = ScriptedRPC(transport, "third", 3)
+        gathered = gather(first.then(self.continuation(transport, "first")),
+                          second.then(self.continuation(transport, "second", third)))
+        self.assertEqual(gathered.get_result(), [10, 3])
+        self.assertEqual(transport.events,
+                         ["second done", "then second", "third done",
+                          "first done", "then first"])
+
+    def test_only_what_is_waited_for_is_stepped(self):
+        transport = ScriptedTransport("second", "first")
+        first = ScriptedRPC(transport, "first", 1)
+        second = ScriptedRPC(transport, "second", 2)
+        chained = first.then(self.continuation(transport, "first"))
+        second.then(self.continuation(transport, "second"))
+        self.assertEqual(chained.get_result(), 10)
+        self.assertEqual(transport.events, ["first done", "then first"])
+
+    def test_failure_propagates(self):
+        transport = ScriptedTransport("first")
+        first = ScriptedRPC(transport, "first", 0)
+        chained = first.then(lambda value: 1 // value)
+        self.assertRaises(ZeroDivisionError, chained.get_result)
+
+    def test_map(self):
+        transport = ScriptedTransport("list")
+        items = ScriptedRPC(transport, "list", [1, 2, 3])
+        self.assertEqual(items.map(lambda item: item * 2).get_result(), [2, 4, 6])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Sharing recorded results between instances
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from theopencorps.endpoints.sharedcache import LocalCache, SharedCache
+from theopencorps.results import ResultsStore
+
+SHA = "a" * 40
+
+
+class TestSharedResults(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = SharedCache(LocalCache())
+
+    def test_new_instance_starts_with_results(self):
+        ResultsStore(shared=self.shared).record("o/r", "master", SHA, 100.0, {"passed": 3})
+        latest = ResultsStore(shared=self.shared).latest("o/r", "master")
+        self.assertEqual(latest["commit"], SHA)
+        self.assertEqual(latest["passed"], 3)
+
+    def test_other_instances_see_new_results(self):
+        here = ResultsStore(shared=self.shared)
+        there = ResultsStore(shared=self.shared)
+        changed = []
+        there.subscribe(lambda project, branch: changed.append((project, branch)))
+        here.record("o/r", "master", SHA, 100.0, {"passed": 3})
+        self.assertEqual(there.latest("o/r", "master")["passed"], 3)
+        here.record("o/r", "master", "b" * 40, 200.0, {"passed": 4})
+        self.assertEqual(there.latest("o/r", "master")["passed"], 4)
+        self.assertEqual(changed, [("o/r", "master")] * 2)
+        # Nothing new, nothing reloaded
+        there.latest("o/r", "master")
+        self.assertEqual(len(changed), 2)
+
+    def test_records_onto_shared_copy(self):
+        here = ResultsStore(shared=self.shared)
+        there = ResultsStore(shared=self.shared)
+        here.record("o/r", "master", SHA, 100.0, {"passed": 3})
+        there.record("o/r", "master", "b" * 40, 200.0, {"passed": 4})
+        self.assertEqual(here.query("o/r", "master")["passed"], [3, 4])
+
+    def test_without_shared_cache(self):
+        store = ResultsStore()
+        store.record("o/r", "master", SHA, 100.0, {"passed": 3})
+        self.assertEqual(store.latest("o/r", "master")["passed"], 3)
+        self.assertIsNone(ResultsStore().latest("o/r", "master"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Failures shared between callers of one RPC
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import unittest
+
+from theopencorps.endpoints import ASyncResult, HTTPException
+from theopencorps.endpoints.singleflight import SingleFlight
+from theopencorps.endpoints.transport import TransportError
+
+
+class FailingRPC(object):
+    msg = "GET: /failing"
+
+    def get_result(self):
+        raise TransportError("connection reset")
+
+
+class TestSharedFailure(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight(error=HTTPException)
+        self.leader = self.flight.call("key", FailingRPC.msg,
+                                       lambda: (FailingRPC(), lambda response: response))
+        self.follower = self.flight.call("key", FailingRPC.msg, None)
+
+    def test_wrapped_for_every_caller(self):
+        self.assertIs(self.leader, self.follower)
+        for shared in (self.leader, self.follower):
+            with self.assertRaises(HTTPException) as raised:
+                shared.get_result()
+            self.assertNotIsInstance(raised.exception, TransportError)
+
+    def test_async_result_reports_failure(self):
+        log = logging.getLogger("test_singleflight")
+        log.disabled = True
+        self.assertIsNone(ASyncResult(self.leader, log).get_response())
+        self.assertIsNone(ASyncResult(self.follower, log).get_result())
+
+    def test_start_failure_wrapped(self):
+        def _start():
+            raise TransportError("no route to host")
+        with self.assertRaises(HTTPException):
+            self.flight.call("other", "GET: /other", _start)
+
+    def test_unwrapped_without_error_class(self):
+        flight = SingleFlight()
+        shared = flight.call("key", FailingRPC.msg,
+                             lambda: (FailingRPC(), lambda response: response))
+        self.assertRaises(TransportError, shared.get_result)
+
+
+if __name__ == "__main__":
+    unittest.main()
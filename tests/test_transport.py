@@ -0,0 +1,77 @@
+"""
+Connection slots of the pooled HTTP transport
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from theopencorps.endpoints.transport import PooledHTTPTransport, TransportError
+
+
+class BrokenConnection(object):
+    """Fails each request with error"""
+    sock = None
+
+    def __init__(self, error):
+        self.error = error
+        self.closed = 0
+
+    def request(self, *args, **kwargs):
+        raise self.error
+
+    def close(self):
+        self.closed += 1
+
+
+class TestSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = PooledHTTPTransport(max_per_host=1)
+        self.pool = self.transport._pool("http", "example.com")
+
+    def fetch(self, error):
+        self.pool.connect = lambda timeout: BrokenConnection(error)
+        self.assertRaises(type(error), self.transport.fetch, "http://example.com/")
+
+    def assertSlotFree(self):
+        self.assertTrue(self.pool._slots.acquire(False), "slot was not released")
+
+    def test_released_on_transport_error(self):
+        self.fetch(IOError("connection reset"))
+        self.assertSlotFree()
+
+    def test_released_on_other_errors(self):
+        self.fetch(ValueError("bad header"))
+        self.fetch(ValueError("bad header"))
+        self.assertSlotFree()
+
+    def test_released_when_connecting_fails(self):
+        def _connect(timeout):
+            raise ValueError("bad host")
+        self.pool.connect = _connect
+        self.assertRaises(ValueError, self.transport.fetch, "http://example.com/")
+        self.assertSlotFree()
+
+
+if __name__ == "__main__":
+    unittest.main()
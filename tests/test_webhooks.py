@@ -0,0 +1,405 @@
+"""
+Webhook signature checks, redelivery detection and push coalescing
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import threading
+import time
+import unittest
+
+import webapp2
+
+from theopencorps.endpoints.sharedcache import LocalCache, SharedCache
+from theopencorps import webhooks
+from theopencorps.invalidation import InvalidationBus
+from theopencorps.results import ResultsStore
+from theopencorps.webhooks import BuildResult, Deliveries, DrainPushes, GithubWebhook, \
+                                  LocalPushQueue, Push, ResultRecorder, TaskPushQueue, \
+                                  parse_result, signature, verify_signature
+
+SECRET = "s3cret"
+
+PAYLOAD = json.dumps({
+    "ref":          "refs/heads/master",
+    "after":        "a" * 40,
+    "repository":   {"name": "repo", "owner": {"login": "owner"}}})
+
+
+def _push(branch="master", sha="a" * 40, received=None):
+    return Push("owner", "repo", branch, sha,
+                time.time() if received is None else received)
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+
+class TestSignature(unittest.TestCase):
+
+    def test_known_value(self):
+        # echo -n '{}' | openssl sha1 -hmac s3cret
+        self.assertEqual(signature(SECRET, b"{}"),
+                         "sha1=e7e0225292f975eab7d48999ea520020ef91b18d")
+
+    def test_str_and_bytes_agree(self):
+        self.assertEqual(signature(SECRET, "{}"), signature(SECRET.encode("utf8"), b"{}"))
+
+    def test_accepts_matching_header(self):
+        self.assertTrue(verify_signature(SECRET, PAYLOAD, signature(SECRET, PAYLOAD)))
+
+    def test_rejects_other_secret(self):
+        self.assertFalse(verify_signature(SECRET, PAYLOAD, signature("other", PAYLOAD)))
+
+    def test_rejects_other_body(self):
+        self.assertFalse(verify_signature(SECRET, PAYLOAD + " ", signature(SECRET, PAYLOAD)))
+
+    def test_rejects_missing_or_truncated_header(self):
+        self.assertFalse(verify_signature(SECRET, PAYLOAD, None))
+        self.assertFalse(verify_signature(SECRET, PAYLOAD, ""))
+        self.assertFalse(verify_signature(SECRET, PAYLOAD, signature(SECRET, PAYLOAD)[:-1]))
+
+
+class TestDeliveries(unittest.TestCase):
+
+    def test_seen_claims(self):
+        deliveries = Deliveries()
+        self.assertFalse(deliveries.seen("1"))
+        self.assertTrue(deliveries.seen("1"))
+        self.assertFalse(deliveries.seen("2"))
+        self.assertEqual(deliveries.duplicates, 1)
+
+    def test_known_does_not_claim(self):
+        deliveries = Deliveries()
+        self.assertFalse(deliveries.known("1"))
+        self.assertFalse(deliveries.known("1"))
+        deliveries.seen("1")
+        self.assertTrue(deliveries.known("1"))
+
+    def test_capacity(self):
+        deliveries = Deliveries(capacity=2)
+        for delivery in ("1", "2", "3"):
+            deliveries.seen(delivery)
+        self.assertFalse(deliveries.known("1"))
+        self.assertTrue(deliveries.known("3"))
+
+    def test_shared_between_instances(self):
+        shared = SharedCache(LocalCache())
+        here, there = Deliveries(shared=shared), Deliveries(shared=shared)
+        self.assertFalse(here.seen("1"))
+        self.assertTrue(there.known("1"))
+        self.assertTrue(there.seen("1"))
+
+
+class RecordingProcessor(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.pushes = []
+        self.running = 0
+        self.overlapped = False
+        self._lock = threading.Lock()
+
+    def __call__(self, push):
+        with self._lock:
+            self.running += 1
+            self.overlapped = self.overlapped or self.running > 1
+        time.sleep(self.delay)
+        with self._lock:
+            self.running -= 1
+            self.pushes.append(push)
+
+
+class TestLocalPushQueue(unittest.TestCase):
+
+    def test_burst_is_coalesced_to_newest(self):
+        processor = RecordingProcessor()
+        queue = LocalPushQueue(processor, window=0.05)
+        now = time.time()
+        queue.add(_push(sha="1" * 40, received=now))
+        queue.add(_push(sha="3" * 40, received=now + 2))
+        # Arriving late doesn't make an older push newest
+        queue.add(_push(sha="2" * 40, received=now + 1))
+        _wait_for(lambda: queue.stats()["processed"] == 1)
+        self.assertEqual([push.sha for push in processor.pushes], ["3" * 40])
+        stats = queue.stats()
+        self.assertEqual(stats["received"], 3)
+        self.assertEqual(stats["coalesced"], 2)
+        self.assertEqual(stats["pending"], 0)
+
+    def test_branches_are_separate(self):
+        processor = RecordingProcessor()
+        queue = LocalPushQueue(processor, window=0.05)
+        queue.add(_push(branch="master"))
+        queue.add(_push(branch="develop"))
+        _wait_for(lambda: queue.stats()["processed"] == 2)
+        self.assertEqual(sorted(push.branch for push in processor.pushes),
+                         ["develop", "master"])
+        self.assertEqual(queue.stats()["coalesced"], 0)
+
+    def test_branch_is_not_processed_concurrently(self):
+        processor = RecordingProcessor(delay=0.2)
+        queue = LocalPushQueue(processor, window=0.05)
+        queue.add(_push(sha="1" * 40))
+        _wait_for(lambda: processor.running == 1)
+        queue.add(_push(sha="2" * 40))
+        _wait_for(lambda: queue.stats()["processed"] == 2)
+        self.assertFalse(processor.overlapped)
+        self.assertEqual([push.sha for push in processor.pushes], ["1" * 40, "2" * 40])
+
+
+class FakeTaskQueue(object):
+    """
+    The parts of google.appengine.api.taskqueue TaskPushQueue uses, with
+    one pull queue and a record of the named push tasks added
+    """
+    class TaskAlreadyExistsError(Exception):
+        pass
+
+    class TombstonedTaskError(Exception):
+        pass
+
+    class Task(object):
+        def __init__(self, payload=None, method=None, tag=None):
+            self.payload = payload
+            self.method = method
+            self.tag = tag
+            self.leased_until = 0
+
+    def __init__(self):
+        self.tasks = []
+        self.named = []
+        self.now = time.time
+
+    def Queue(self, name):  # pylint: disable=invalid-name
+        return self
+
+    def add(self, task=None, name=None, url=None, params=None, countdown=None):
+        if task is not None:
+            self.tasks.append(task)
+            return
+        if name in self.named:
+            raise self.TaskAlreadyExistsError(name)
+        self.named.append(name)
+
+    def lease_tasks_by_tag(self, lease_seconds, max_tasks, tag=None):
+        now = self.now()
+        leased = [task for task in self.tasks
+                  if task.tag == tag and task.leased_until <= now][:max_tasks]
+        for task in leased:
+            task.leased_until = now + lease_seconds
+        return leased
+
+    def modify_task_lease(self, task, lease_seconds):
+        task.leased_until = self.now() + lease_seconds
+
+    def delete_tasks(self, tasks):
+        self.tasks = [task for task in self.tasks if task not in tasks]
+
+
+class FailOnce(RecordingProcessor):
+
+    def __init__(self):
+        RecordingProcessor.__init__(self)
+        self.calls = 0
+
+    def __call__(self, push):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError("GitHub unavailable")
+        RecordingProcessor.__call__(self, push)
+
+
+class TestTaskPushQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.taskqueue = FakeTaskQueue()
+        self.real_taskqueue = webhooks.taskqueue
+        webhooks.taskqueue = self.taskqueue
+
+    def tearDown(self):
+        webhooks.taskqueue = self.real_taskqueue
+
+    def test_burst_is_drained_once(self):
+        processor = RecordingProcessor()
+        queue = TaskPushQueue(processor, window=2)
+        queue.add(_push(sha="1" * 40, received=100.0))
+        queue.add(_push(sha="3" * 40, received=101.5))
+        queue.add(_push(sha="2" * 40, received=101.0))
+        queue.add(_push(branch="develop", received=100.0))
+        # One drain task per branch per window
+        self.assertEqual(len(self.taskqueue.named), 2)
+
+        self.assertEqual(queue.drain("owner/repo:master"), 3)
+        self.assertEqual([push.sha for push in processor.pushes], ["3" * 40])
+        self.assertEqual([task.tag for task in self.taskqueue.tasks],
+                         ["owner/repo:develop"])
+        self.assertEqual(queue.drain("owner/repo:master"), 0)
+
+    def test_failed_drain_is_retried(self):
+        processor = FailOnce()
+        queue = TaskPushQueue(processor)
+        queue.add(_push(sha="1" * 40))
+        self.assertRaises(RuntimeError, queue.drain, "owner/repo:master")
+        # Still queued, and not held by the failed attempt's lease
+        self.assertEqual(len(self.taskqueue.tasks), 1)
+        self.assertEqual(queue.drain("owner/repo:master"), 1)
+        self.assertEqual([push.sha for push in processor.pushes], ["1" * 40])
+        self.assertEqual(self.taskqueue.tasks, [])
+
+    def test_drain_handler(self):
+        processor = RecordingProcessor()
+        app = webapp2.WSGIApplication([('/tasks/pushes', DrainPushes)])
+        app.registry["push_queue"] = TaskPushQueue(processor)
+        app.registry["push_queue"].add(_push())
+
+        request = webapp2.Request.blank("/tasks/pushes", method="POST",
+                                        POST={"tag": "owner/repo:master"})
+        self.assertEqual(request.get_response(app).status_int, 403)
+        self.assertEqual(processor.pushes, [])
+
+        request = webapp2.Request.blank("/tasks/pushes", method="POST",
+                                        POST={"tag": "owner/repo:master"},
+                                        headers={"X-AppEngine-QueueName": "default"})
+        self.assertEqual(request.get_response(app).status_int, 200)
+        self.assertEqual(len(processor.pushes), 1)
+
+
+def _notification(**changes):
+    notification = {
+        "id":           7,
+        "type":         "push",
+        "branch":       "master",
+        "commit":       "c" * 40,
+        "finished_at":  "2016-01-01T00:01:40Z",
+        "repository":   {"owner_name": "owner", "name": "repo"},
+        "matrix":       [{"id": 1}, {"id": 2}]}
+    notification.update(changes)
+    return notification
+
+
+class LogTravis(object):
+    """
+    Stands in for TravisEndpoint.read_log with a log per job
+    """
+    def __init__(self, logs):
+        self.logs = logs
+
+    def read_log(self, job_id, pipeline, offset=0):
+        pipeline.feed(self.logs[job_id])
+        return offset + len(self.logs[job_id])
+
+
+class TestResults(unittest.TestCase):
+
+    def test_parse_result(self):
+        self.assertEqual(parse_result(_notification()),
+                         BuildResult("owner/repo", "master", "c" * 40, 1451606500, [1, 2]))
+
+    def test_unfinished_and_pull_request_builds_ignored(self):
+        self.assertIsNone(parse_result(_notification(finished_at=None)))
+        self.assertIsNone(parse_result(_notification(type="pull_request")))
+
+    def test_recorder(self):
+        travis = LogTravis({
+            1: b"** test_a   PASS  \n** test_b   FAIL  \n",
+            2: (b"Test Passed: test_c\n"
+                b"=== top ===\n"
+                b"   Number of cells:               1200\n"
+                b"=== sub ===\n"
+                b"   Number of cells:                300\n")})
+        store = ResultsStore()
+        recorder = ResultRecorder(travis, store)
+        self.assertTrue(recorder(parse_result(_notification())))
+        latest = store.latest("owner/repo", "master")
+        self.assertEqual((latest["commit"], latest["time"]), ("c" * 40, 1451606500))
+        self.assertEqual((latest["passed"], latest["failed"], latest["cells"]),
+                         (2, 1, 1200))
+
+    def test_recorder_without_results(self):
+        store = ResultsStore()
+        recorder = ResultRecorder(LogTravis({1: b"make: nothing to be done\n"}), store)
+        self.assertFalse(recorder(BuildResult("owner/repo", "master", "c" * 40, 0, [1])))
+        self.assertIsNone(store.latest("owner/repo", "master"))
+
+
+class FailingQueue(object):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.pushes = []
+
+    def add(self, push):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("queue unavailable")
+        self.pushes.append(push)
+
+
+class TestGithubWebhook(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webapp2.WSGIApplication([('/webhooks/github', GithubWebhook)],
+                                           config={"webhook_secret": SECRET})
+        self.queue = FailingQueue()
+        self.app.registry["push_queue"] = self.queue
+        self.app.registry["deliveries"] = Deliveries()
+        self.app.registry["invalidation"] = InvalidationBus()
+
+    def post(self, body=PAYLOAD, delivery="1", sign=SECRET, event="push"):
+        headers = {"X-GitHub-Event": event, "X-GitHub-Delivery": delivery}
+        if sign:
+            headers["X-Hub-Signature"] = signature(sign, body)
+        request = webapp2.Request.blank("/webhooks/github", method="POST",
+                                        headers=headers, POST=body)
+        return request.get_response(self.app)
+
+    def test_bad_signature(self):
+        self.assertEqual(self.post(sign="other").status_int, 403)
+        self.assertEqual(self.post(sign=None).status_int, 403)
+        self.assertEqual(self.queue.pushes, [])
+
+    def test_push_is_queued_once(self):
+        self.assertEqual(self.post().status_int, 202)
+        self.assertEqual(self.post().status_int, 200)
+        self.assertEqual(len(self.queue.pushes), 1)
+        self.assertEqual(self.queue.pushes[0].sha, "a" * 40)
+
+    def test_unparseable_delivery_is_not_claimed(self):
+        self.assertEqual(self.post(body="{").status_int, 400)
+        self.assertFalse(self.app.registry["deliveries"].known("1"))
+
+    def test_failed_delivery_is_retried(self):
+        self.queue.failures = 1
+        self.assertEqual(self.post().status_int, 500)
+        self.assertFalse(self.app.registry["deliveries"].known("1"))
+        self.assertEqual(self.post().status_int, 202)
+        self.assertEqual(len(self.queue.pushes), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
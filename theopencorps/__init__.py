@@ -1,11 +1,48 @@
+import json
+import os
+
 import webapp2
 
+from theopencorps.badges import BadgePage
+from theopencorps.endpoints import metrics_snapshot
+from theopencorps.endpoints.transport import default_transport
+from theopencorps.webhooks import GithubWebhook, DrainPushes, RecordResults, \
+                                  TravisWebhook
+
 class MainPage(webapp2.RequestHandler):
     def get(self):
         self.response.headers['Content-Type'] = 'text/plain'
         self.response.write('Hello, World!')
 
+class MetricsPage(webapp2.RequestHandler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(metrics_snapshot(), sort_keys=True))
+
+config = {
+    "github_token":     os.environ.get("GITHUB_TOKEN"),
+    "travis_token":     os.environ.get("TRAVIS_TOKEN"),
+    "webhook_secret":   os.environ.get("WEBHOOK_SECRET"),
+    "organisation":     os.environ.get("GITHUB_ORGANISATION", "theopencorps"),
+}
+
 app = webapp2.WSGIApplication([
     ('/', MainPage),
-], debug=True)
+    ('/metrics', MetricsPage),
+    ('/webhooks/github', GithubWebhook),
+    ('/webhooks/travis', TravisWebhook),
+    ('/tasks/pushes', DrainPushes),
+    ('/tasks/results', RecordResults),
+    (r'/badges/([^/]+/[^/]+)/(\w+)\.svg', BadgePage),
+], config=config, debug=True)
+
+def _dispatch(router, request, response):
+    """
+    Account for any RPCs the handler started but didn't wait for
+    """
+    try:
+        return router.default_dispatcher(request, response)
+    finally:
+        default_transport().settle()
 
+app.router.set_dispatcher(_dispatch)
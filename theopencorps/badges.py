@@ -0,0 +1,286 @@
+"""
+shields.io style SVG badges for project READMEs
+
+Badges are by far our most requested resource, so each rendered badge is
+kept per (project, branch, metric, style) until new results are recorded
+for that branch.  Responses carry a strong ETag so browsers, GitHub's image
+proxy and CDNs revalidate with a 304 rather than fetching the SVG again.
+The ETag is derived from the stored result the badge shows, not from
+anything rendered, so every instance hands out the same one and can answer
+a revalidation without rendering.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict, namedtuple
+from xml.sax.saxutils import escape
+
+import webapp2
+
+from theopencorps.results import results_store
+
+# Caches may serve a badge this long before revalidating
+MAX_AGE = 60
+
+COLOURS = {
+    "brightgreen":  "#4c1",
+    "green":        "#97ca00",
+    "yellowgreen":  "#a4a61d",
+    "yellow":       "#dfb317",
+    "orange":       "#fe7d37",
+    "red":          "#e05d44",
+    "lightgrey":    "#9f9f9f",
+    "blue":         "#007ec6",
+}
+
+Badge = namedtuple("Badge", ["svg", "etag"])
+
+# Approximate advance widths of Verdana 11px, which shields.io lays out with
+_NARROW = frozenset("fijlrtI!()[]{}.,:;'|/\\ -")
+_WIDE = frozenset("mwMW%@")
+
+
+def text_width(text):
+    width = 0.0
+    for char in text:
+        if char in _NARROW:
+            width += 4.0
+        elif char in _WIDE:
+            width += 10.0
+        elif char.isupper() or char.isdigit():
+            width += 7.5
+        else:
+            width += 6.5
+    return int(round(width))
+
+
+def _status(latest):
+    if latest is None or ("failed" not in latest and "passed" not in latest):
+        return "build", "unknown", "lightgrey"
+    if latest.get("failed"):
+        return "build", "failing", "red"
+    return "build", "passing", "brightgreen"
+
+
+def _coverage(latest):
+    if latest is None or "coverage" not in latest:
+        return "coverage", "unknown", "lightgrey"
+    coverage = latest["coverage"]
+    for threshold, colour in ((90, "brightgreen"), (75, "green"), (60, "yellow"),
+                              (40, "orange")):
+        if coverage >= threshold:
+            break
+    else:
+        colour = "red"
+    return "coverage", "%d%%" % coverage, colour
+
+
+def _utilisation(latest):
+    if latest is None or "cells" not in latest:
+        return "resources", "unknown", "lightgrey"
+    cells = latest["cells"]
+    if cells >= 1000:
+        value = "%.1fk cells" % (cells / 1000.0)
+    else:
+        value = "%d cells" % cells
+    return "resources", value, "blue"
+
+
+BADGES = {
+    "status":       _status,
+    "coverage":     _coverage,
+    "utilisation":  _utilisation,
+}
+
+_FLAT = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="20">'
+    '<linearGradient id="s" x2="0" y2="100%"><stop offset="0" stop-color="#bbb" '
+    'stop-opacity=".1"/><stop offset="1" stop-opacity=".1"/></linearGradient>'
+    '<mask id="m"><rect width="{width}" height="20" rx="3" fill="#fff"/></mask>'
+    '<g mask="url(#m)"><rect width="{label_width}" height="20" fill="#555"/>'
+    '<rect x="{label_width}" width="{value_width}" height="20" fill="{colour}"/>'
+    '<rect width="{width}" height="20" fill="url(#s)"/></g>'
+    '<g fill="#fff" text-anchor="middle" '
+    'font-family="DejaVu Sans,Verdana,Geneva,sans-serif" font-size="11">'
+    '<text x="{label_x}" y="15" fill="#010101" fill-opacity=".3">{label}</text>'
+    '<text x="{label_x}" y="14">{label}</text>'
+    '<text x="{value_x}" y="15" fill="#010101" fill-opacity=".3">{value}</text>'
+    '<text x="{value_x}" y="14">{value}</text></g></svg>')
+
+_FLAT_SQUARE = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="20">'
+    '<g shape-rendering="crispEdges"><rect width="{label_width}" height="20" fill="#555"/>'
+    '<rect x="{label_width}" width="{value_width}" height="20" fill="{colour}"/></g>'
+    '<g fill="#fff" text-anchor="middle" '
+    'font-family="DejaVu Sans,Verdana,Geneva,sans-serif" font-size="11">'
+    '<text x="{label_x}" y="14">{label}</text>'
+    '<text x="{value_x}" y="14">{value}</text></g></svg>')
+
+STYLES = {
+    "flat":         _FLAT,
+    "flat-square":  _FLAT_SQUARE,
+}
+
+
+def render(label, value, colour, style="flat"):
+    """
+    Return a Badge for label / value on a background of colour
+    """
+    label_width = text_width(label) + 10
+    value_width = text_width(value) + 10
+    svg = STYLES[style].format(width=label_width + value_width,
+                               label_width=label_width,
+                               value_width=value_width,
+                               colour=COLOURS.get(colour, colour),
+                               label_x=label_width / 2.0,
+                               value_x=label_width + value_width / 2.0,
+                               label=escape(label),
+                               value=escape(value))
+    etag = '"%s"' % hashlib.sha1(svg.encode("utf8")).hexdigest()
+    return Badge(svg, etag)
+
+
+def metric_etag(latest, metric, style="flat"):
+    """
+    ETag of the badge for metric given the latest results of a branch (or
+    None): the commit they are for and the value shown
+    """
+    _, value, _ = BADGES[metric](latest)
+    commit = latest.get("commit") if latest is not None else None
+    key = json.dumps([commit, metric, value, style])
+    return '"%s"' % hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+def render_metric(latest, metric, style="flat"):
+    """
+    Badge for metric given the latest results of a branch (or None)
+    """
+    label, value, colour = BADGES[metric](latest)
+    return Badge(render(label, value, colour, style).svg,
+                 metric_etag(latest, metric, style))
+
+
+class BadgeCache(object):
+    """
+    Rendered badges, dropped a branch at a time when its results change
+
+    Holds at most capacity branches, least recently requested go first.
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._branches = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # pylint: disable=too-many-arguments
+    def get(self, project, branch, metric, style, make):
+        """
+        The cached badge, or the one returned by make() which is then cached
+        """
+        key = (project, branch)
+        with self._lock:
+            badges = self._branches.pop(key, None)
+            if badges is not None:
+                self._branches[key] = badges
+                badge = badges.get((metric, style))
+                if badge is not None:
+                    self.hits += 1
+                    return badge
+            self.misses += 1
+            version = self._version
+
+        badge = make()
+
+        with self._lock:
+            # Don't cache something rendered from results since replaced
+            if version == self._version:
+                self._branches.setdefault(key, {})[(metric, style)] = badge
+                while len(self._branches) > self.capacity:
+                    self._branches.popitem(last=False)
+        return badge
+
+    def invalidate(self, project, branch):
+        with self._lock:
+            self._version += 1
+            if self._branches.pop((project, branch), None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        return {"branches":         len(self._branches),
+                "hits":             self.hits,
+                "misses":           self.misses,
+                "invalidations":    self.invalidations}
+
+
+def badge_cache(app):
+    """
+    The app's badge cache, created on first use and kept in step with its
+    results store
+    """
+    cache = app.registry.get("badges")
+    if cache is None:
+        created = BadgeCache()
+        cache = app.registry.setdefault("badges", created)
+        if cache is created:
+            results_store(app).subscribe(cache.invalidate)
+    return cache
+
+
+def _matches(etag, header):
+    if not header:
+        return False
+    return any(candidate.strip() in (etag, "*") for candidate in header.split(","))
+
+
+class BadgePage(webapp2.RequestHandler):
+    """
+    /badges/<owner>/<repo>/<metric>.svg?branch=master&style=flat
+    """
+    def get(self, project, metric):
+        branch = self.request.get("branch") or "master"
+        style = self.request.get("style") or "flat"
+        if metric not in BADGES or style not in STYLES:
+            self.abort(404)
+
+        # Shared between instances, see ResultsStore
+        latest = results_store(self.app).latest(project, branch)
+        etag = metric_etag(latest, metric, style)
+        self.response.headers["ETag"] = etag
+        self.response.headers["Cache-Control"] = "public, max-age=%d" % MAX_AGE
+        if _matches(etag, self.request.headers.get("If-None-Match")):
+            self.response.set_status(304)
+            return
+
+        badge = badge_cache(self.app).get(
+            project, branch, metric, style,
+            lambda: render_metric(latest, metric, style))
+        if badge.etag != etag:
+            # Rendered from results since replaced
+            badge = render_metric(latest, metric, style)
+        self.response.headers["Content-Type"] = "image/svg+xml"
+        self.response.write(badge.svg)
@@ -6,6 +6,9 @@ bit funny about requests module etc.
 
 We can also make use of the google Asynchronous URLFetch service to optimise
 transfers.
+
+The HTTP transport is pluggable (see transport.py) so the endpoints also work
+outside of the GAE sandbox.
 """
 __copyright__ = """
 Copyright (C) 2016 Potential Ventures Ltd
@@ -29,70 +32,132 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
 import json
 import logging
-
-from google.appengine.api import urlfetch
+import re
+import time
+from collections import namedtuple
+
+from theopencorps.endpoints.futures import Chainable, gather
+from theopencorps.endpoints.httpcache import ResponseCache
+from theopencorps.endpoints.memo import cache, memoize, cache_stats
+from theopencorps.endpoints.metrics import METRICS, route_for
+from theopencorps.endpoints.ratelimit import RateLimiter, PRIORITY_HIGH, \
+                                             PRIORITY_NORMAL, PRIORITY_LOW
+from theopencorps.endpoints.retry import RetryPolicy, RetryingRPC
+from theopencorps.endpoints.sharedcache import default_shared_cache
+from theopencorps.endpoints.singleflight import SingleFlight
+from theopencorps.endpoints.transport import TransportError, default_transport
 
 _MY_APP = 'TheOpenCorps/1.0.0'
 
+_LINK_NEXT = re.compile(r'<([^>]+)>\s*;\s*rel="next"')
+
 class HTTPException(Exception):
     """Base class for all HTTP related exceptions"""
     pass
 
-class cache(object):    # pylint: disable=invalid-name
-    """
-    Decorator to memoise return value (no kword args)
-    """
-    def __init__(self, func):
-        self._func = func
-        self.memo = {}
-
-    def __call__(self, *args):
-        if args not in self.memo:
-            self.memo[args] = self._func(*args)
-        return self.memo[args]
+# One entry of the output of APIEndpointBase.request_many
+BatchResult = namedtuple("BatchResult", ["index", "resource", "result", "error"])
 
 def auth(method):
     """
     Decorator to ensure we're logged in for API access where login is required
     """
-    def _wrapper(*args):
+    def _wrapper(*args, **kwargs):
         self = args[0]
         if self.token is None:
             self.login()
-        return method(*args)
+        return method(*args, **kwargs)
     return _wrapper
 
-class ASyncResult(object):
+class _PrettyJSON(object):
+    """
+    Defers pretty-printing until a log record is actually emitted
+    """
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, sort_keys=True, indent=4, separators=(',', ': '))
+
+class _FreshRPC(object):
+    """
+    An RPC already answered from the response cache
+    """
+    def __init__(self, response, msg):
+        self.response = response
+        self.msg = msg
+
+    def get_result(self):
+        return self.response
+
+    def done(self):
+        return True
+
+class ASyncResult(Chainable):
     """
     Convenience mechanism for un-wrapping an RPC
+
+    Dependent requests can be chained without blocking:
+
+        endpoint.get_repo_async(user, repo).then(
+            lambda repo: endpoint.get_head(user, repo["name"]))
     """
-    def __init__(self, rpc, log, valid_codes=(200,)):
+    def __init__(self, rpc, log, valid_codes=(200,), process=None):
         self.rpc = rpc
         self.log = log
         self.valid_codes = valid_codes
+        self.process = process
+        self._response = None
+        self._collected = False
 
-    def get_result(self):
+    @property
+    def transport_rpc(self):
+        """The transport's RPC we're waiting on, for wait_any()"""
+        return getattr(self.rpc, "transport_rpc", self.rpc)
+
+    def get_response(self):
+        """
+        Return the underlying response object (status_code, content, headers)
+        or None if the fetch failed
+        """
+        if self._collected:
+            return self._response
         try:
             result = self.rpc.get_result()
-        except urlfetch.DownloadError as e:
-            self.log.error("Failed to retrieve %s (%s)", self.rpc.msg, repr(e))
+        except (TransportError, HTTPException) as e:
+            # A SharedRPC raises the HTTPException it shares with its followers
+            self.log.error("Failed to retrieve %s (%r)", self.rpc.msg, e)
+            result = None
+        if self.process is not None:
+            result = self.process(result)
+        self._response, self._collected = result, True
+        return result
+
+    def get_result(self):
+        result = self.get_response()
+        if result is None:
             return None
 
-        msg = "{} {} (returned {} bytes)".format(self.rpc.msg,
-                                                 result.status_code,
-                                                 len(result.content))
-        json_result = json.loads(result.content)
+        try:
+            json_result = json.loads(result.content)
+        except ValueError:
+            # Typically an HTML error page from a proxy or a 5xx
+            self.log.warning("%s %d returned non-JSON content (%d bytes)",
+                             self.rpc.msg, result.status_code, len(result.content))
+            self.log.info("%s", result.content)
+            return None
 
         if result.status_code in self.valid_codes:
-            self.log.debug(msg)
-            self.log.debug(json.dumps(
-                json_result, sort_keys=True, indent=4, separators=(',', ': ')))
+            self.log.debug("%s %d (returned %d bytes)", self.rpc.msg,
+                           result.status_code, len(result.content))
+            self.log.debug("%s", _PrettyJSON(json_result))
         else:
-            self.log.warning(msg)
-            self.log.info(json.dumps(
-                json_result, sort_keys=True, indent=4, separators=(',', ': ')))
+            self.log.warning("%s %d (returned %d bytes)", self.rpc.msg,
+                             result.status_code, len(result.content))
+            self.log.info("%s", _PrettyJSON(json_result))
 
         return json_result
 
@@ -110,25 +175,26 @@ class ASyncJSONObject(ASyncResult):
         self._result = None
 
     def get_result(self):
-        if self._retrieved:
-            return
-        self._result = ASyncResult.get_result(self)
-        self._retrieved = True
+        if not self._retrieved:
+            self._result = ASyncResult.get_result(self)
+            self._retrieved = True
+        return self._result
 
     def __nonzero__(self):
-        self.get_result()
-        try:
-            return self._result.__nonzero__()
-        except AttributeError:
-            return len(self._result) != 0
+        return bool(self.get_result())
+    __bool__ = __nonzero__
 
     def __len__(self):
-        self.get_result()
-        return self._result.__len__()
+        return len(self.get_result())
 
     def __getitem__(self, key):
-        self.get_result()
-        return self._result.__getitem__(key)
+        return self.get_result()[key]
+
+    def __iter__(self):
+        return iter(self.get_result())
+
+    def __contains__(self, item):
+        return item in self.get_result()
 
     def __getattr__(self, name):
         """Forward everything else on to our result object"""
@@ -136,6 +202,64 @@ class ASyncJSONObject(ASyncResult):
         return getattr(self._result, name)
 
 
+class Paginator(object):
+    """
+    Iterate lazily over the items of a paged list resource
+
+    The request for the next page is issued as soon as the current page
+    arrives, so the RPC is in flight while the caller consumes the items.
+    The number of pages and items fetched so far are available as
+    attributes.
+
+    If given, iteration stops at the first item for which until(item) is
+    true and no further pages are requested.
+    """
+    def __init__(self, endpoint, resource, key=None, until=None, **kwargs):
+        self.endpoint = endpoint
+        self.resource = resource
+        self.key = key
+        self.until = until
+        self.kwargs = kwargs
+        self.pages = 0
+        self.items = 0
+
+    def __iter__(self):
+        pending = self.endpoint.request_async(self.resource, **self.kwargs)
+        while pending is not None:
+            response = pending.get_response()
+            if response is None or response.status_code != 200:
+                raise HTTPException("Fetching page %d of %s failed (%s)",
+                                    self.pages + 1, self.resource,
+                                    None if response is None else response.status_code)
+            page = json.loads(response.content)
+            items = page[self.key] if self.key is not None else page
+            self.pages += 1
+
+            stop = None
+            if self.until is not None:
+                for index, item in enumerate(items):
+                    if self.until(item):
+                        stop = index
+                        break
+
+            resource = None
+            if stop is None:
+                resource = self.endpoint._next_page(self.resource, response, items)
+            else:
+                items = items[:stop]
+            if resource is not None:
+                pending = self.endpoint.request_async(resource, **self.kwargs)
+            else:
+                pending = None
+
+            for item in items:
+                self.items += 1
+                yield item
+
+        self.endpoint.log.info("Fetched %d items in %d pages from %s",
+                               self.items, self.pages, self.resource)
+
+
 
 class APIEndpointBase(object):
 
@@ -146,9 +270,36 @@ class APIEndpointBase(object):
     _endpoint = ""
     _accept = ""
 
-    def __init__(self):
+    # Second tier (memcache) shared between processes, None to disable
+    shared_cache = default_shared_cache()
+
+    # Shared between all instances, the token forms part of the key
+    response_cache = ResponseCache(shared=shared_cache)
+
+    # Budgets are per token so this is also shared
+    rate_limiter = RateLimiter()
+
+    # Give up rather than wait longer than this for rate limit budget
+    rate_limit_timeout = 60
+
+    metrics = METRICS
+
+    # Identical concurrent GETs share a single RPC
+    single_flight = SingleFlight(error=HTTPException)
+
+    # Idempotent requests are retried (and GETs hedged) under this policy
+    retry_policy = RetryPolicy()
+
+    # (pattern, seconds) - a GET of a matching resource is answered from the
+    # response cache without a request for up to seconds, provided we are
+    # receiving webhooks for the scope matched by the pattern's first group
+    # (see watch and invalidate)
+    _max_age = ()
+
+    def __init__(self, transport=None):
         self._token = None
         self.log = logging.getLogger(self.__class__.__name__)
+        self.transport = transport or default_transport()
 
     @property
     def token(self):
@@ -158,8 +309,7 @@ class APIEndpointBase(object):
     def token(self, token):
         if self._token is not None:
             self.log.error("Token has been set multiple times")
-            self.log.debug("Before: %s, after: %s",
-                           repr(self._token), repr(token))
+            self.log.debug("Before: %r, after: %r", self._token, token)
         self._token = token
 
     # pylint: disable=too-many-arguments
@@ -201,34 +351,282 @@ class APIEndpointBase(object):
             request_args['headers']["Content-Type"] = "application/json"
         return request_args
 
+    def _conditional(self, resource, request_args):
+        """
+        Make a GET conditional if we hold a cached copy of the response
+
+        Returns a function to post-process the response, or None if the
+        request isn't cacheable
+        """
+        if self.response_cache is None or request_args["method"] != "GET" or \
+                "Range" in request_args["headers"]:
+            return None
+        key = (self._token, request_args["method"], self._endpoint + resource)
+        headers, validated = self.response_cache.conditional(key)
+        for name, value in headers.items():
+            request_args["headers"].setdefault(name, value)
+        requested = time.time()
+        return lambda response: self.response_cache.update(key, response, requested,
+                                                           validated)
+
+    def _fresh(self, resource, kwargs):
+        """
+        A cached response for resource we can use without asking, or None
+        """
+        if self.response_cache is None or kwargs.get("method", "GET") != "GET" or \
+                kwargs.get("payload") is not None or \
+                "Range" in (kwargs.get("headers") or {}):
+            return None
+        for pattern, max_age in self._max_age:
+            match = pattern.match(resource)
+            if match is not None:
+                return self.response_cache.fresh(
+                    (self._token, "GET", self._endpoint + resource), max_age,
+                    self._endpoint + match.group(1))
+        return None
+
+    @classmethod
+    def watch(cls, scope):
+        """
+        Note that we are receiving webhooks for scope (eg "/repos/owner/name")
+        so that responses under it may be used until invalidated
+        """
+        if cls.response_cache is not None:
+            cls.response_cache.watch(cls._endpoint + scope)
+
+    @classmethod
+    def invalidate(cls, *resources):
+        """
+        Forget cached responses for resources, which have changed
+        """
+        if cls.response_cache is None:
+            return
+        for resource in resources:
+            cls.response_cache.invalidate_url(cls._endpoint + resource)
+
+    def _prepare(self, resource, kwargs):
+        """
+        Wait for rate limit budget then build the request arguments
+
+        Returns the request arguments, a function to post-process the
+        response when it's collected and the request's priority
+        """
+        priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        token = self._token
+        if self.rate_limiter is not None and \
+                not self.rate_limiter.acquire(token, priority,
+                                              timeout=self.rate_limit_timeout):
+            raise HTTPException("Rate limit budget for %s%s not available "
+                                "within %d seconds",
+                                self._endpoint, resource, self.rate_limit_timeout)
+
+        request_args = self._create_request_args(**kwargs)
+        conditional = self._conditional(resource, request_args)
+
+        def _process(response):
+            if response is None or conditional is None:
+                return response
+            return conditional(response)
+        return request_args, _process, priority
+
+    def _account(self, method, resource):
+        """
+        Record an RPC being issued, returns completed(response) for the
+        transport to call when it finishes (response None if it failed)
+
+        Latency and the rate limit budget come from the transport's
+        callback, not from whenever (if ever) somebody collects the
+        response.  Under URLFetch that callback can be late, see
+        URLFetchTransport.
+        """
+        token = self._token
+        key = self.metrics.started(self.__class__.__name__, method, resource)
+        started = time.time()
+
+        def _completed(response):
+            latency = time.time() - started
+            try:
+                if response is not None and self.rate_limiter is not None:
+                    self.rate_limiter.update(token, response)
+            finally:
+                if response is None:
+                    self.metrics.finished(key, latency)
+                else:
+                    self.metrics.finished(key, latency, response.status_code,
+                                          len(response.content))
+        return _completed
+
+    def _send(self, resource, request_args):
+        """
+        Start a single transport RPC for resource
+        """
+        return self.transport.fetch_async(
+            self._endpoint + resource,
+            callback=self._account(request_args["method"], resource),
+            **request_args)
+
+    def _issue(self, resource, request_args, priority):
+        """
+        Start the RPC, retrying and hedging if the request is idempotent
+
+        Budget for the first attempt has already been acquired, retries
+        wait for their own at the request's priority and a hedge is only
+        sent if there is budget to spare there and then.
+        """
+        policy = self.retry_policy
+        if policy is None or not policy.applies(request_args["method"]):
+            return self._send(resource, request_args)
+        hedge_after = None
+        if request_args["method"] == "GET":
+            hedge_after = self.metrics.latency_quantile(
+                (self.__class__.__name__, "GET", route_for(resource)), 0.95)
+
+        def _resend(hedge):
+            if self.rate_limiter is not None and not self.rate_limiter.acquire(
+                    self._token, PRIORITY_LOW if hedge else priority,
+                    timeout=0 if hedge else self.rate_limit_timeout):
+                return None
+            return self._send(resource, request_args)
+
+        return RetryingRPC(self.transport, self._endpoint + resource,
+                           request_args, policy, hedge_after=hedge_after,
+                           send=lambda: self._send(resource, request_args),
+                           resend=_resend)
+
+    def cache_identity(self):
+        """
+        Identifies whose view of the API we have, for keying shared caches
+        without exposing the token
+        """
+        identity = "%s|%s" % (self._endpoint, self._token)
+        return hashlib.sha1(identity.encode("utf8")).hexdigest()
+
+    @classmethod
+    def use_shared_cache(cls, shared):
+        """
+        Switch the second tier cache (eg to a LocalCache backed one in tests)
+        """
+        cls.shared_cache = shared
+        cls.response_cache.shared = shared
+
+    def rate_limit_stats(self):
+        """
+        Remaining budget and queue depth for our token
+        """
+        return {"remaining":    self.rate_limiter.budget(self._token),
+                "queued":       self.rate_limiter.queue_depth(self._token)}
+
+    def _next_page(self, resource, response, items):
+        """
+        Return the resource for the page following response, or None if this
+        was the last page.
+
+        Default follows the RFC 5988 Link header as used by GitHub
+        """
+        match = _LINK_NEXT.search(response.headers.get("Link") or "")
+        if match is None:
+            return None
+        url = match.group(1)
+        if url.startswith(self._endpoint):
+            url = url[len(self._endpoint):]
+        return url
+
+    def paginate(self, resource, key=None, until=None, **kwargs):
+        """
+        Returns a Paginator yielding every item of a paged list resource
+
+        key selects the list from each page if the page is an object, until
+        ends the iteration early (see Paginator)
+        """
+        return Paginator(self, resource, key=key, until=until, **kwargs)
+
     def request(self, resource, **kwargs):
         """
         Convenience for making requests
 
         Synchronous returns an object with status_code and content members.
 
+        All request methods accept priority (PRIORITY_HIGH, PRIORITY_NORMAL,
+        PRIORITY_LOW) which decides who waits when the rate limit is tight.
+
         FIXME this should really return JSON to match ASync
         """
-        request_args = self._create_request_args(**kwargs)
-        result = urlfetch.fetch(self._endpoint + resource, **request_args)
-
-        msg = "%s: %s%s %d (returned %d bytes)" % (
-            request_args["method"], self._endpoint, resource,
-            result.status_code, len(result.content))
+        fresh = self._fresh(resource, kwargs)
+        if fresh is not None:
+            self.log.info("GET: %s%s fresh in cache", self._endpoint, resource)
+            return fresh
+
+        shared = self._shared(resource, kwargs)
+        if shared is not None:
+            result = shared.get_result()
+            self.log.info("%s %d (returned %d bytes)",
+                          shared.msg, result.status_code, len(result.content))
+            self.log.debug("Got:  %r", result.content)
+            return result
+
+        request_args, process, priority = self._prepare(resource, kwargs)
+        if self.retry_policy is not None and \
+                self.retry_policy.applies(request_args["method"]):
+            result = self._issue(resource, request_args, priority).get_result()
+        else:
+            completed = self._account(request_args["method"], resource)
+            try:
+                result = self.transport.fetch(self._endpoint + resource,
+                                              **request_args)
+            except TransportError:
+                completed(None)
+                raise
+            completed(result)
+        result = process(result)
 
         if result.status_code == 200:
-            self.log.info(msg)
-            self.log.debug("Sent: %s", repr(request_args["headers"]))
-            self.log.debug("payload: %s", repr(request_args["payload"]))
-            self.log.debug("Got:  %s", repr(result.content))
+            self.log.info("%s: %s%s %d (returned %d bytes)",
+                          request_args["method"], self._endpoint, resource,
+                          result.status_code, len(result.content))
+            self.log.debug("Sent: %r", request_args["headers"])
+            self.log.debug("payload: %r", request_args["payload"])
+            self.log.debug("Got:  %r", result.content)
         else:
-            self.log.warning(msg)
-            self.log.info("Sent %s", repr(request_args["headers"]))
-            self.log.debug("payload: %s", repr(request_args["payload"]))
-            self.log.info(result.content)
+            self.log.warning("%s: %s%s %d (returned %d bytes)",
+                             request_args["method"], self._endpoint, resource,
+                             result.status_code, len(result.content))
+            self.log.info("Sent %r", request_args["headers"])
+            self.log.debug("payload: %r", request_args["payload"])
+            self.log.info("%s", result.content)
         return result
 
 
+    def _fetch_async(self, resource, **kwargs):
+        """
+        Start an RPC for resource, returning it along with the function to
+        post-process the response
+        """
+        fresh = self._fresh(resource, kwargs)
+        if fresh is not None:
+            return (_FreshRPC(fresh, "GET: %s%s" % (self._endpoint, resource)),
+                    lambda response: response)
+        request_args, process, priority = self._prepare(resource, kwargs)
+        rpc = self._issue(resource, request_args, priority)
+        rpc.msg = "%s: %s%s" % (request_args["method"],
+                                self._endpoint,
+                                resource)
+        return rpc, process
+
+    def _shared(self, resource, kwargs):
+        """
+        Join or start a shared RPC if this is an idempotent GET, otherwise
+        returns None
+        """
+        if self.single_flight is None or \
+                kwargs.get("method", "GET") != "GET" or \
+                kwargs.get("payload") is not None:
+            return None
+        key = (self._token, self._endpoint + resource,
+               repr(sorted((kwargs.get("headers") or {}).items())))
+        msg = "GET: %s%s" % (self._endpoint, resource)
+        return self.single_flight.call(
+            key, msg, lambda: self._fetch_async(resource, **kwargs))
+
     def request_async(self, resource, **kwargs):
         """
         Convenience for making requests
@@ -236,23 +634,85 @@ class APIEndpointBase(object):
         Returns ASyncResult object, for which the JSON can
         be retrieved in the future using get_result()
         """
-        request_args = self._create_request_args(**kwargs)
-        rpc = urlfetch.create_rpc()
-        rpc.msg = "%s: %s%s" % (request_args["method"],
-                                self._endpoint,
-                                resource)
-        urlfetch.make_fetch_call(rpc, self._endpoint + resource, **request_args)
-        return ASyncResult(rpc, self.log)
+        rpc, process = self._fetch_async(resource, **kwargs)
+        return ASyncResult(rpc, self.log, process=process)
 
 
     def request_json(self, resource, valid_codes=(200,), **kwargs):
         """
         Returns a JSON-like object which is actually a future...
+
+        Concurrent identical GETs share one RPC, each caller gets its own
+        parsed copy of the response
         """
-        request_args = self._create_request_args(**kwargs)
-        rpc = urlfetch.create_rpc()
-        rpc.msg = "%s: %s%s" % (request_args["method"],
-                                self._endpoint,
-                                resource)
-        urlfetch.make_fetch_call(rpc, self._endpoint+resource, **request_args)
-        return ASyncJSONObject(rpc, self.log, valid_codes=valid_codes)
+        shared = self._shared(resource, kwargs)
+        if shared is not None:
+            return ASyncJSONObject(shared, self.log, valid_codes=valid_codes)
+        rpc, process = self._fetch_async(resource, **kwargs)
+        return ASyncJSONObject(rpc, self.log, valid_codes=valid_codes,
+                               process=process)
+
+
+    # pylint: disable=too-many-arguments
+    def request_many(self, resources, max_in_flight=8, ordered=True,
+                     valid_codes=(200,), **kwargs):
+        """
+        Fetch many resources with at most max_in_flight RPCs outstanding
+
+        Generator yielding a BatchResult per resource, in the order given if
+        ordered else as they complete.  A failed fetch is reported through the
+        error member rather than aborting the batch.
+        """
+        resources = iter(enumerate(resources))
+        pending = []
+
+        def _issue():
+            while len(pending) < max_in_flight:
+                entry = next(resources, None)
+                if entry is None:
+                    return
+                index, resource = entry
+                pending.append((index, resource,
+                                self.request_async(resource, **kwargs)))
+
+        _issue()
+        while pending:
+            if ordered:
+                index, resource, rpc = pending.pop(0)
+            else:
+                rpcs = [getattr(entry[2].rpc, "transport_rpc", entry[2].rpc)
+                        for entry in pending]
+                fresh = [rpc for rpc in rpcs if isinstance(rpc, _FreshRPC)]
+                done = fresh[0] if fresh else self.transport.wait_any(rpcs)
+                index, resource, rpc = pending.pop(rpcs.index(done))
+            yield self._batch_result(index, resource, rpc, valid_codes)
+            _issue()
+
+    @staticmethod
+    def _batch_result(index, resource, rpc, valid_codes):
+        response = rpc.get_response()
+        if response is None:
+            return BatchResult(index, resource, None,
+                               HTTPException("No response for %s" % resource))
+        if response.status_code not in valid_codes:
+            return BatchResult(index, resource, None,
+                               HTTPException("%s returned %d" % (
+                                   resource, response.status_code)))
+        try:
+            return BatchResult(index, resource, json.loads(response.content), None)
+        except ValueError as e:
+            return BatchResult(index, resource, None, e)
+
+
+def metrics_snapshot():
+    """
+    Everything we instrument, as a JSON serialisable dict
+    """
+    return {"requests":         APIEndpointBase.metrics.snapshot(),
+            "response_cache":   APIEndpointBase.response_cache.stats(),
+            "rate_limits":      APIEndpointBase.rate_limiter.stats(),
+            "single_flight":    APIEndpointBase.single_flight.stats(),
+            "retries":          APIEndpointBase.retry_policy.stats(),
+            "shared_cache":     (APIEndpointBase.shared_cache.stats()
+                                 if APIEndpointBase.shared_cache is not None else None),
+            "memoised":         cache_stats()}
@@ -0,0 +1,559 @@
+"""
+Minimal futures and thread pool
+
+GAE python27 doesn't ship concurrent.futures, and we only need a fraction of
+it.  A Future here honours the same get_result() contract as a urlfetch RPC
+so either can sit behind an ASyncResult.
+
+App Engine joins every thread a request started before letting the request
+finish, so a pool of long-lived workers would hold up the first request to
+use it until its deadline.  There (BACKGROUND_THREADS is False) work is
+deferred instead: an Executor and poll() return a Future which does the
+work in the first thread to wait for it.  A Future from then() or gather()
+remembers the RPCs it is waiting on, and whoever waits for it steps
+whichever of those completes first (using the transport's wait_any), so
+each continuation still runs as soon as its own input is ready.  RPCs
+themselves run concurrently, urlfetch doesn't need our threads for that.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+BACKGROUND_THREADS = not os.environ.get("SERVER_SOFTWARE", "").startswith(
+    ("Google App Engine/", "Development/"))
+
+
+class TimeoutError(Exception):  # pylint: disable=redefined-builtin
+    """Raised when a result isn't available within the requested time"""
+    pass
+
+
+class Chainable(object):
+    """
+    Combinators for anything with a get_result()
+
+    Each returns a Future straight away.  The next step starts as soon as
+    its input resolves, so a chain of dependent RPCs runs without the caller
+    waiting on each one, and independent branches run side by side.
+    """
+    def then(self, func):
+        """
+        Future for func(result).  If func returns something with a
+        get_result() (another RPC or Future) its result is used instead.
+        """
+        future = Future()
+
+        def _resolved(value, error):
+            if error is not None:
+                future.set_exception(error)
+                return
+            try:
+                following = func(value)
+            except Exception as e:  # pylint: disable=broad-except
+                future.set_exception(e)
+                return
+            future._waits_on(resolve(following, future.set))
+        future._waits_on(resolve(self, _resolved))
+        return future
+
+    def map(self, func):
+        """
+        Future for [func(item) for item in result], waiting on any RPCs
+        func returns
+        """
+        return self.then(lambda items: gather(*[func(item) for item in items]))
+
+
+class Future(Chainable):
+    """
+    The result of an operation which may not have completed yet
+    """
+    def __init__(self, run=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        # Deferred work completing us, done by the first thread to wait
+        self._run = run
+        # Without BACKGROUND_THREADS, the _Watches and Futures we need
+        # stepped before we can complete
+        self._inputs = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def _waits_on(self, item):
+        if item is not None:
+            self._inputs.append(item)
+
+    def _drive(self, timeout=None):
+        with self._lock:
+            run, self._run = self._run, None
+        if run is not None:
+            run()
+        if not BACKGROUND_THREADS:
+            _step_until(self.done, [self], timeout)
+
+    def wait(self, timeout=None):
+        """
+        Returns True if complete within timeout seconds
+        """
+        self._drive(timeout)
+        return self._event.wait(timeout)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def set(self, value, error=None):
+        """Resolve with value, or fail with error if given"""
+        if error is not None:
+            self.set_exception(error)
+        else:
+            self.set_result(value)
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._invoke(callback)
+
+    def _invoke(self, callback):
+        try:
+            callback(self)
+        except Exception:   # pylint: disable=broad-except
+            logging.getLogger(__name__).exception(
+                "Exception raised by future callback %s", repr(callback))
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) once complete, immediately if already done
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._invoke(callback)
+
+    def exception(self, timeout=None):
+        self._drive(timeout)
+        if not self._event.wait(timeout):
+            raise TimeoutError("Future not complete after %r seconds" % timeout)
+        return self._exception
+
+    def get_result(self, timeout=None):
+        self._drive(timeout)
+        if not self._event.wait(timeout):
+            raise TimeoutError("Future not complete after %r seconds" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def _call(future, func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:  # pylint: disable=broad-except
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def _deferred(func, *args, **kwargs):
+    """
+    Future for func(*args, **kwargs), called by the first thread to wait
+    """
+    future = Future()
+    future._run = lambda: _call(future, func, args, kwargs)
+    return future
+
+
+def _wait(obj, callback):
+    try:
+        value = obj.get_result()
+    except Exception as e:  # pylint: disable=broad-except
+        callback(None, e)
+    else:
+        callback(value, None)
+
+
+class _Watch(object):
+    """
+    Without BACKGROUND_THREADS, a callback(value, error) waiting for obj
+    until somebody steps it
+    """
+    def __init__(self, obj, callback):
+        self.obj = obj
+        self.callback = callback
+        self.fired = False
+        self._lock = threading.Lock()
+
+    def fire(self):
+        with self._lock:
+            if self.fired:
+                return
+            self.fired = True
+        _wait(self.obj, self.callback)
+
+
+def _leaf(obj):
+    """
+    The transport RPC under any wrappers (ASyncResult, RetryingRPC...)
+    """
+    while hasattr(obj, "transport_rpc"):
+        obj = obj.transport_rpc
+    return obj
+
+
+def _pending(futures):
+    """
+    The _Watches not yet fired that futures are (indirectly) waiting on
+    """
+    watches = []
+    seen = set()
+    stack = list(futures)
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, _Watch):
+            if not item.fired:
+                watches.append(item)
+        elif not item.done():
+            stack.extend(item._inputs)
+    return watches
+
+
+def _next(watches):
+    """
+    The watch to fire next: one whose RPC is known to be complete, else
+    the first to complete of those a transport can wait on together
+    """
+    leaves = [_leaf(watch.obj) for watch in watches]
+    for watch, leaf in zip(watches, leaves):
+        done = getattr(leaf, "done", None)
+        if done is not None and done():
+            return watch
+    transports = [getattr(leaf, "transport", None) for leaf in leaves]
+    transport = next((t for t in transports if t is not None), None)
+    if transport is None:
+        return watches[0]
+    rpcs = [leaf for leaf, t in zip(leaves, transports) if t is transport]
+    first = transport.wait_any(rpcs)
+    for watch, leaf in zip(watches, leaves):
+        if leaf is first:
+            return watch
+    return watches[0]
+
+
+def _step_until(done, futures, timeout=None):
+    """
+    Without BACKGROUND_THREADS, fire whatever futures are waiting on, in
+    the order it completes, until done() or timeout seconds pass
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while not done():
+        if deadline is not None and time.time() >= deadline:
+            return
+        watches = _pending(futures)
+        if not watches:
+            return
+        _next(watches).fire()
+
+
+def resolve(obj, callback):
+    """
+    Call callback(value, error) once obj has a result
+
+    obj may be a Future (no thread is used), anything else with a
+    get_result() (waited on by a worker) or a plain value.
+
+    Without BACKGROUND_THREADS nothing waits on obj in the background:
+    we return what the caller's Future needs stepped (see _step_until)
+    before callback can be called.
+    """
+    if isinstance(obj, Future):
+        if obj._run is not None:
+            # Deferred, nothing will complete it unless stepped
+            return _Watch(obj, callback)
+        obj.add_done_callback(lambda future: callback(future._result,
+                                                      future._exception))
+        return None if BACKGROUND_THREADS else obj
+    elif hasattr(obj, "get_result"):
+        if not BACKGROUND_THREADS:
+            return _Watch(obj, callback)
+        _WAITERS.submit(_wait, obj, callback)
+    else:
+        callback(obj, None)
+    return None
+
+
+def gather(*items):
+    """
+    Future for the list of results of items, failing if any of them do
+    """
+    future = Future()
+    results = [None] * len(items)
+    remaining = [len(items)]
+    lock = threading.Lock()
+    if not items:
+        future.set_result([])
+
+    def _collect(index):
+        def _resolved(value, error):
+            with lock:
+                if future.done():
+                    return
+                if error is not None:
+                    future.set_exception(error)
+                    return
+                results[index] = value
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            future.set_result(results)
+        return _resolved
+
+    for index, item in enumerate(items):
+        future._waits_on(resolve(item, _collect(index)))
+    return future
+
+
+def wait_any(futures, timeout=None):
+    """
+    Block until one of futures is complete and return it
+    """
+    event = threading.Event()
+    for future in futures:
+        if future.done():
+            return future
+    for future in futures:
+        if future._run is not None:
+            # Deferred, nothing else will complete it
+            future._drive()
+            return future
+    if not BACKGROUND_THREADS:
+        _step_until(lambda: any(future.done() for future in futures),
+                    futures, timeout)
+    for future in futures:
+        future.add_done_callback(lambda _: event.set())
+    event.wait(timeout)
+    for future in futures:
+        if future.done():
+            return future
+    raise TimeoutError("No future completed within %r seconds" % timeout)
+
+
+class Executor(object):
+    """
+    Pool of daemon worker threads, created on demand up to max_workers
+
+    Without BACKGROUND_THREADS nothing is started, each call is deferred
+    until its result is waited for.
+    """
+    def __init__(self, max_workers=8, name="worker"):
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedule func(*args, **kwargs), returning a Future for the result
+        """
+        if not BACKGROUND_THREADS:
+            return _deferred(func, *args, **kwargs)
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        with self._lock:
+            if self._queue.qsize() > self._idle and \
+                                    self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name="%s-%d" % (self.name, self._workers))
+                worker.daemon = True
+                worker.start()
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            future, func, args, kwargs = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            _call(future, func, args, kwargs)
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter
+
+    Each delay is drawn uniformly from [(1 - jitter) * d, d] where d doubles
+    (by factor) from initial up to maximum.
+    """
+    def __init__(self, initial=0.1, maximum=10.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay * (1 - self.jitter * random.random())
+            delay = min(delay * self.factor, self.maximum)
+
+
+class _Timer(object):
+    """
+    Single daemon thread running callables once their time is due
+    """
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay,
+                                        next(self._sequence), func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timer")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time()
+                                    if self._heap else None)
+                _, _, func, args = heapq.heappop(self._heap)
+            try:
+                func(*args)
+            except Exception:   # pylint: disable=broad-except
+                logging.getLogger(__name__).exception(
+                    "Exception raised by timer callback %s", repr(func))
+
+
+_TIMER = _Timer()
+_POLLERS = Executor(8, name="poll")
+# Only ever wait on RPCs, never on other chained futures, so can't deadlock
+_WAITERS = Executor(32, name="then")
+
+
+def call_later(delay, func, *args):
+    """
+    Run func(*args) on the timer thread after delay seconds
+
+    Not available without BACKGROUND_THREADS: use a task with a countdown.
+    """
+    if not BACKGROUND_THREADS:
+        raise RuntimeError("No timer thread on App Engine, %s would never run"
+                           % repr(func))
+    _TIMER.call_later(delay, func, *args)
+
+
+def poll(check, backoff=None, timeout=None, timeout_exception=None,
+         executor=None):
+    """
+    Call check() with backoff between attempts until it returns something
+    other than None, without holding a thread while waiting
+
+    Returns a Future resolved with the value returned by check, or failing
+    with whatever check raised or timeout_exception (TimeoutError by default)
+    if timeout seconds pass first.
+
+    Without BACKGROUND_THREADS polling happens in the thread which waits
+    for the result, sleeping between attempts.
+    """
+    delays = (backoff or Backoff()).delays()
+    deadline = None if timeout is None else time.time() + timeout
+
+    def _timed_out():
+        return timeout_exception or TimeoutError(
+            "Polling %s didn't complete within %r seconds" % (repr(check), timeout))
+
+    if not BACKGROUND_THREADS:
+        def _poll():
+            while True:
+                result = check()
+                if result is not None:
+                    return result
+                delay = next(delays)
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise _timed_out()
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+        return _deferred(_poll)
+
+    future = Future()
+    executor = executor or _POLLERS
+
+    def _attempt():
+        try:
+            result = check()
+        except Exception as e:  # pylint: disable=broad-except
+            future.set_exception(e)
+            return
+        if result is not None:
+            future.set_result(result)
+            return
+        delay = next(delays)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                future.set_exception(_timed_out())
+                return
+            # One last attempt right on the deadline
+            delay = min(delay, remaining)
+        call_later(delay, executor.submit, _attempt)
+
+    executor.submit(_attempt)
+    return future
@@ -24,9 +24,31 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import base64
+import hashlib
 import json
+import re
+from collections import OrderedDict, deque, namedtuple
 
-from theopencorps.endpoints import APIEndpointBase, HTTPException, cache
+from theopencorps.endpoints import APIEndpointBase, HTTPException, memoize, \
+                                   PRIORITY_HIGH
+from theopencorps.endpoints.futures import Backoff, Future, poll
+
+# Outcome of bringing one fork up to date, action is one of
+# up-to-date, fast-forward, merge, conflict or failed
+Propagation = namedtuple("Propagation", ["upstream", "fork", "action", "sha", "error"])
+
+# Modes of a blob holding file content, others (120000, a symlink) aren't kept
+_FILE_MODES = ("100644", "100755")
+
+
+def git_blob_sha(content):
+    """
+    SHA1 git would give content stored as a blob
+    """
+    if not isinstance(content, bytes):
+        content = content.encode("utf8")
+    header = ("blob %d\0" % len(content)).encode("ascii")
+    return hashlib.sha1(header + content).hexdigest()
 
 
 class GithubEndpoint(APIEndpointBase):
@@ -34,13 +56,25 @@ class GithubEndpoint(APIEndpointBase):
     _endpoint = "https://api.github.com"
     _accept = "application/vnd.github.v3+json"
 
-    def __init__(self, token=None):
-        APIEndpointBase.__init__(self)
+    # Repositories and branch heads change only with a push, which our
+    # webhooks tell us about
+    _max_age = (
+        (re.compile(r"^(/repos/[^/?]+/[^/?]+)$"), 24*3600),
+        (re.compile(r"^(/repos/[^/?]+/[^/?]+)/git/refs/heads/[^?]+$"), 24*3600),
+    )
+
+    def __init__(self, token=None, transport=None):
+        APIEndpointBase.__init__(self, transport=transport)
         self.token = token
         self.log.info("Created endpoint with token %s", repr(token))
+        # Files we did / didn't need to write because the content matched
+        self.commit_stats = {"written": 0, "skipped": 0}
+        # Outcomes of propagate(), by action
+        self.propagation_stats = dict.fromkeys(
+            ["up-to-date", "fast-forward", "merge", "conflict", "failed"], 0)
 
     @property
-    @cache
+    @memoize(maxsize=1, ttl=3600, shared=True)
     def user(self):
         """
         Get the currently logged in user
@@ -48,10 +82,16 @@ class GithubEndpoint(APIEndpointBase):
         return json.loads(self.request("/user").content)
 
 
-    def get_repos(self):
+    def iter_repos(self):
+        """
+        Lazily iterate over every repo belonging to the current user
+        """
         username = self.user["login"]
         self.log.info("Fetching repos for %s", username)
-        return json.loads(self.request("/users/%s/repos" % username).content)
+        return self.paginate("/users/%s/repos?per_page=100" % username)
+
+    def get_repos(self):
+        return list(self.iter_repos())
 
     def get_repo_async(self, user, repo):
         return self.request_async("/repos/%s/%s" % (user, repo))
@@ -77,21 +117,25 @@ class GithubEndpoint(APIEndpointBase):
         return base64.b64decode(response['content'])
 
 
-    def fork(self, user, repo, organisation="", block=True):
+    # pylint: disable=too-many-arguments
+    def fork(self, user, repo, organisation="", block=True, timeout=45,
+             backoff=None):
         """
         Fork a repo
 
+        GitHub creates forks asynchronously, so returns a Future resolved with
+        the new repository information once the fork is usable (its default
+        branch can be read), polling with backoff for up to timeout seconds.
+        The default leaves room inside App Engine's 60 second request
+        deadline, task queue handlers can afford to wait longer.
+
         If block, wait until the new repository is available and
         return the new repository information
         """
-        if not block:
-            raise NotImplementedError("Haven't implemented non-blocking fork yet")
         if organisation:
             payload = json.dumps({"organization": organisation})
-            fullname = "%s/%s" % (organisation, repo)
         else:
             payload = None
-            fullname = "%s/%s" % (self.user["login"], repo)
         result = self.request("/repos/%s/%s/forks" % (user, repo),
                               method="POST",
                               payload=payload)
@@ -100,10 +144,60 @@ class GithubEndpoint(APIEndpointBase):
                                 user, repo,
                                 result.status_code, result.content)
 
+        forked = json.loads(result.content)
         self.log.info("Forking %s/%s to %s returned %d",
-                      user, repo, fullname, result.status_code)
+                      user, repo, forked["full_name"], result.status_code)
+
+        future = self._wait_for_fork(forked, timeout, backoff)
+        if block:
+            return future.get_result()
+        return future
+
+    def fork_many(self, repos, organisation="", max_in_flight=8, timeout=45,
+                  backoff=None):
+        """
+        Fork many repos concurrently
+
+            repos   list of (user, repo)
+
+        Returns a list of Futures in the same order as repos, each resolved
+        with the new repository information once that fork is usable
+        (see fork() for timeout)
+        """
+        payload = json.dumps({"organization": organisation}) if organisation else None
+        futures = []
+        for item in self.request_many(["/repos/%s/%s/forks" % (user, repo)
+                                       for user, repo in repos],
+                                      max_in_flight=max_in_flight,
+                                      valid_codes=(202,),
+                                      method="POST",
+                                      payload=payload):
+            if item.error is not None:
+                future = Future()
+                future.set_exception(item.error)
+            else:
+                future = self._wait_for_fork(item.result, timeout, backoff)
+            futures.append(future)
+        return futures
+
+    def _wait_for_fork(self, forked, timeout, backoff):
+        """
+        Returns a Future polling until the fork is usable
+        """
+        owner, name = forked["owner"]["login"], forked["name"]
+        branch = forked.get("default_branch") or "master"
+
+        def _available():
+            if self.get_head(owner, name, branch) is None:
+                return None
+            self.log.info("Fork %s/%s is available", owner, name)
+            return self.get_repo(owner, name)
 
-        return json.loads(result.content)
+        return poll(_available, backoff or Backoff(initial=1.0, maximum=15.0),
+                    timeout=timeout,
+                    timeout_exception=HTTPException(
+                        "Fork %s/%s not available within %d seconds",
+                        owner, name, timeout))
 
     # pylint: disable=too-many-arguments
     def create_webhook(self, user, repo, url,
@@ -136,6 +230,51 @@ class GithubEndpoint(APIEndpointBase):
                                 response.status_code, response.content)
         return True
 
+    @staticmethod
+    def _status(state, context, description, target_url):
+        payload = {"state": state, "context": context, "description": description}
+        if target_url is not None:
+            payload["target_url"] = target_url
+        return payload
+
+    # pylint: disable=too-many-arguments
+    def create_status_async(self, user, repo, sha1, state, context="theopencorps",
+                            description="", target_url=None):
+        """
+        Start setting the status of a commit, returns an ASyncResult
+        """
+        return self.request_async("/repos/%s/%s/statuses/%s" % (user, repo, sha1),
+                                  method="POST",
+                                  payload=json.dumps(self._status(state, context,
+                                                                  description,
+                                                                  target_url)))
+
+    # pylint: disable=too-many-arguments
+    def create_status(self, user, repo, sha1, state, context="theopencorps",
+                      description="", target_url=None):
+        """
+        Set the status of a commit
+            state       (str)   pending, success, failure or error
+        """
+        response = self.request("/repos/%s/%s/statuses/%s" % (user, repo, sha1),
+                                method="POST",
+                                payload=json.dumps(self._status(state, context,
+                                                                description,
+                                                                target_url)))
+        if response.status_code != 201:
+            raise HTTPException("Attempt to set status of %s/%s@%s returned %d (%s)",
+                                user, repo, sha1,
+                                response.status_code, response.content)
+        return True
+
+    @classmethod
+    def head_moved(cls, user, repo, branch):
+        """
+        Invalidate what a push to (or deletion of) a branch changes
+        """
+        cls.invalidate("/repos/%s/%s" % (user, repo),
+                       "/repos/%s/%s/git/refs/heads/%s" % (user, repo, branch))
+
     def get_head(self, user, repo, branch='master'):
         """
         Find the SHA1 of the tip of selected branch
@@ -155,18 +294,25 @@ class GithubEndpoint(APIEndpointBase):
             path        (str)   path to file
             content     (str)   file contents
             message     (str)   commit message
+
+        Nothing is written if the file already has this content, raises
+        HTTPException if the write fails
         """
         # Find the SHA1 of the existing file, if it exists
-        response = self.request("/repos/%s/%s/contents/%s" % (user, repo, path),
-                                payload=json.dumps({
-                                    "path"      : path,
-                                    "ref"       : branch}))
+        response = self.request("/repos/%s/%s/contents/%s?ref=%s" % (
+                                    user, repo, path, branch))
         if response.status_code == 404:
             sha1 = None
         else:
             current = json.loads(response.content)
             sha1 = current['sha']
 
+        if sha1 == git_blob_sha(content):
+            self.log.info("%s/%s/%s on %s is unchanged, not committing",
+                          user, repo, path, branch)
+            self.commit_stats["skipped"] += 1
+            return True
+
         parameters = {
             "path"      : path,
             "message"   : message,
@@ -183,10 +329,258 @@ class GithubEndpoint(APIEndpointBase):
         response = self.request("/repos/%s/%s/contents/%s" % (user, repo, path),
                                 payload=json.dumps(parameters),
                                 method="PUT")
-        if sha1 is None:
-            return response.status_code == 201
-        return response.status_code == 200
+        if response.status_code not in (200, 201):
+            raise HTTPException("Attempt to commit %s to %s/%s %s returned %d (%s)",
+                                path, user, repo, branch,
+                                response.status_code, response.content)
+        self.head_moved(user, repo, branch)
+        self.commit_stats["written"] += 1
+        return True
+
+
+    def commit_files(self, user, repo, files, message, branch='master'):
+        """
+        Commit several files as a single commit using the Git Data API
+            files       (dict)  path -> file contents
+            message     (str)   commit message
+
+        Files whose content and mode already match the branch are left out,
+        and if nothing has changed no commit is made.  Existing files keep
+        their mode (an executable stays executable), new ones are 100644.
+
+        The remaining blobs are uploaded in parallel, then a tree and commit
+        are created on top of the branch and the branch advanced once, so N
+        changed files cost N+3 writes.  Reading the branch head and its tree
+        to find what has changed adds two requests (more if the tree is too
+        large to list in one go).  Returns the SHA1 of the new (or unchanged)
+        head commit.
+        """
+        base = "/repos/%s/%s" % (user, repo)
+        local = dict((path, git_blob_sha(content)) for path, content in files.items())
+
+        response = self.request("%s/branches/%s" % (base, branch))
+        if response.status_code != 200:
+            raise HTTPException("Attempt to retrieve branch %s of %s/%s returned %d (%s)",
+                                branch, user, repo,
+                                response.status_code, response.content)
+        head = json.loads(response.content)["commit"]
+        parent, base_tree = head["sha"], head["commit"]["tree"]["sha"]
+
+        existing = self._tree_entries(user, repo, base_tree, files)
+
+        # A symlink written as a file becomes a regular file
+        wanted = {}
+        for path in files:
+            mode = existing.get(path, (None, None))[1]
+            if mode not in _FILE_MODES:
+                mode = "100644"
+            wanted[path] = (local[path], mode)
+
+        changed = sorted(path for path in files if existing.get(path) != wanted[path])
+        self.commit_stats["skipped"] += len(files) - len(changed)
+        if not changed:
+            self.log.info("All %d files already up to date on %s/%s %s",
+                          len(files), user, repo, branch)
+            return parent
+
+        blobs = [(path, self.request_async(base + "/git/blobs",
+                                           method="POST",
+                                           payload=json.dumps({
+                                               "content"   : base64.b64encode(files[path]),
+                                               "encoding"  : "base64"})))
+                 for path in changed]
+
+        tree = []
+        for path, rpc in blobs:
+            response = rpc.get_response()
+            if response is None or response.status_code != 201:
+                raise HTTPException("Attempt to create blob for %s in %s/%s failed (%s)",
+                                    path, user, repo,
+                                    None if response is None else response.status_code)
+            tree.append({"path"     : path,
+                         "mode"     : wanted[path][1],
+                         "type"     : "blob",
+                         "sha"      : json.loads(response.content)["sha"]})
+
+        response = self.request(base + "/git/trees",
+                                method="POST",
+                                payload=json.dumps({
+                                    "base_tree" : base_tree,
+                                    "tree"      : tree}))
+        if response.status_code != 201:
+            raise HTTPException("Attempt to create tree in %s/%s returned %d (%s)",
+                                user, repo,
+                                response.status_code, response.content)
+        tree_sha = json.loads(response.content)["sha"]
+
+        response = self.request(base + "/git/commits",
+                                method="POST",
+                                payload=json.dumps({
+                                    "message"   : message,
+                                    "tree"      : tree_sha,
+                                    "parents"   : [parent],
+                                    "committer" : {
+                                        "name"  : self.user['name'],
+                                        "email" : self.user['email'],
+                                        },
+                                    }))
+        if response.status_code != 201:
+            raise HTTPException("Attempt to create commit in %s/%s returned %d (%s)",
+                                user, repo,
+                                response.status_code, response.content)
+        sha1 = json.loads(response.content)["sha"]
+
+        self.cherry_pick(user, repo, sha1, branch=branch)
+        self.commit_stats["written"] += len(tree)
+        self.log.info("Committed %d files to %s/%s %s as %s",
+                      len(tree), user, repo, branch, sha1)
+        return sha1
+
+    def _tree_entries(self, user, repo, tree, paths):
+        """
+        Find the (sha, mode) of those of paths that are files in tree
 
+        GitHub truncates the recursive listing of a large tree, in which
+        case only the directories leading to paths are listed, a level at a
+        time.
+        """
+        base = "/repos/%s/%s" % (user, repo)
+        response = self.request("%s/git/trees/%s?recursive=1" % (base, tree))
+        if response.status_code != 200:
+            raise HTTPException("Attempt to list tree %s of %s/%s returned %d (%s)",
+                                tree, user, repo,
+                                response.status_code, response.content)
+        listing = json.loads(response.content)
+        if not listing.get("truncated"):
+            return dict((entry["path"], (entry["sha"], entry["mode"]))
+                        for entry in listing["tree"]
+                        if entry["type"] == "blob" and entry["path"] in paths)
+
+        self.log.info("Tree %s of %s/%s is truncated, listing %d paths directly",
+                      tree, user, repo, len(paths))
+        directories = set()
+        for path in paths:
+            parts = path.split("/")[:-1]
+            directories.update("/".join(parts[:depth + 1]) + "/"
+                               for depth in range(len(parts)))
+
+        existing = {}
+        level = {"": tree}
+        while level:
+            listings = [(prefix, self.request_async("%s/git/trees/%s" % (base, sha)))
+                        for prefix, sha in level.items()]
+            level = {}
+            for prefix, rpc in listings:
+                response = rpc.get_response()
+                if response is None or response.status_code != 200:
+                    raise HTTPException("Attempt to list %s in %s/%s failed (%s)",
+                                        prefix or "/", user, repo,
+                                        None if response is None else response.status_code)
+                listing = json.loads(response.content)
+                if listing.get("truncated"):
+                    raise HTTPException("Listing of %s in %s/%s is truncated",
+                                        prefix or "/", user, repo)
+                for entry in listing["tree"]:
+                    path = prefix + entry["path"]
+                    if entry["type"] == "blob" and path in paths:
+                        existing[path] = (entry["sha"], entry["mode"])
+                    elif entry["type"] == "tree" and path + "/" in directories:
+                        level[path + "/"] = entry["sha"]
+        return existing
+
+    def propagate(self, pairs, max_in_flight=8):
+        """
+        Bring forks up to date with their upstreams
+
+            pairs   list of (upstream, fork), each (user, repo, branch)
+
+        Every head is read in one concurrent batch, then only the forks
+        behind their upstream are updated, at most max_in_flight at once:
+        a fast-forward if possible, otherwise a merge.  Conflicts and
+        failures are recorded rather than stopping the run.
+
+        Returns a list of Propagation in the order of pairs
+        """
+        refs = list(OrderedDict.fromkeys(ref for pair in pairs for ref in pair))
+        heads, errors = {}, {}
+        for item in self.request_many(["/repos/%s/%s/git/refs/heads/%s" % ref
+                                       for ref in refs],
+                                      max_in_flight=max_in_flight):
+            if item.error is not None:
+                errors[refs[item.index]] = item.error
+            else:
+                heads[refs[item.index]] = item.result["object"]["sha"]
+
+        results = [None] * len(pairs)
+        queue = deque()
+        for index, (upstream, fork) in enumerate(pairs):
+            error = errors.get(upstream) or errors.get(fork)
+            if error is not None:
+                results[index] = Propagation(upstream, fork, "failed", None, error)
+            elif heads[upstream] == heads[fork]:
+                results[index] = Propagation(upstream, fork, "up-to-date",
+                                             heads[fork], None)
+            else:
+                queue.append(index)
+
+        pending = []
+
+        def _start(index, action):
+            fork, sha = pairs[index][1], heads[pairs[index][0]]
+            if action == "fast-forward":
+                rpc = self.request_async("/repos/%s/%s/git/refs/heads/%s" % fork,
+                                         method="PATCH",
+                                         payload=json.dumps({"sha": sha, "force": False}),
+                                         priority=PRIORITY_HIGH)
+            else:
+                rpc = self.request_async("/repos/%s/%s/merges" % fork[:2],
+                                         method="POST",
+                                         payload=json.dumps({"base": fork[2], "head": sha}),
+                                         priority=PRIORITY_HIGH)
+            pending.append((index, action, rpc))
+
+        while queue or pending:
+            while queue and len(pending) < max_in_flight:
+                _start(queue.popleft(), "fast-forward")
+            rpcs = [getattr(entry[2].rpc, "transport_rpc", entry[2].rpc)
+                    for entry in pending]
+            index, action, rpc = pending.pop(rpcs.index(self.transport.wait_any(rpcs)))
+            response = rpc.get_response()
+            status = None if response is None else response.status_code
+            # 422: the fork has commits of its own
+            if action == "fast-forward" and status == 422:
+                _start(index, "merge")
+                continue
+            results[index] = self._propagated(pairs[index], heads, action, response)
+
+        for result in results:
+            self.propagation_stats[result.action] += 1
+        return results
+
+    def _propagated(self, pair, heads, action, response):
+        upstream, fork = pair
+        msg = "%s/%s:%s <- %s" % (fork + (heads[upstream],))
+        if response is None:
+            return Propagation(upstream, fork, "failed", None,
+                               HTTPException("No response updating %s", msg))
+        status = response.status_code
+        if status in (200, 201, 202):
+            self.head_moved(*fork)
+        if action == "fast-forward" and status == 200:
+            self.log.info("Fast-forwarded %s", msg)
+            return Propagation(upstream, fork, action, heads[upstream], None)
+        if action == "merge" and status in (201, 202):
+            self.log.info("Merged %s", msg)
+            return Propagation(upstream, fork, action,
+                               json.loads(response.content or "{}").get("sha"), None)
+        if action == "merge" and status == 204:
+            return Propagation(upstream, fork, "up-to-date", heads[fork], None)
+        error = HTTPException("Updating %s returned %d", msg, status)
+        if status == 409:
+            self.log.warning("Merge conflict! (%s)", msg)
+            return Propagation(upstream, fork, "conflict", None, error)
+        self.log.warning("%s", error)
+        return Propagation(upstream, fork, "failed", None, error)
 
     # pylint: disable=too-many-arguments
     def cherry_pick(self, user, repo, sha1, branch="master", force=False):
@@ -198,9 +592,11 @@ class GithubEndpoint(APIEndpointBase):
         """
         result = self.request("/repos/%s/%s/git/refs/heads/%s" % (user, repo, branch),
                               method="PATCH",
-                              payload=json.dumps({"sha": sha1, "force": force}))
+                              payload=json.dumps({"sha": sha1, "force": force}),
+                              priority=PRIORITY_HIGH)
         msg = "%s/%s <- %s" % (user, repo, sha1)
         if result.status_code == 200:
+            self.head_moved(user, repo, branch)
             self.log.info("Cherry-picked %s", msg)
             return sha1
         raise HTTPException("Cherry-pick failed: %s (%d)", msg, result.status_code)
@@ -216,15 +612,19 @@ class GithubEndpoint(APIEndpointBase):
                               method="POST",
                               payload=json.dumps({
                                 "base"      : base,
-                                "head"      : sha1}))
+                                "head"      : sha1}),
+                              priority=PRIORITY_HIGH)
         msg = "%s/%s <- %s" % (user, repo, sha1)
 
         mapping = {201: "successful", 202: "accepted", 204: "no-op"}
         if result.status_code in mapping:
+            if result.status_code != 204:
+                self.head_moved(user, repo, base)
             self.log.info("Merge %s (%s)", mapping[result.status_code], msg)
             sha = ""
+            content = result.content
             try:
-                content = json.loads(result.content)
+                content = json.loads(content)
                 sha = content["sha"]
                 self.log.info("Merge commit was %s", sha)
             except Exception as e:
@@ -0,0 +1,306 @@
+"""
+Conditional request cache
+
+Stores the validators (ETag / Last-Modified) and body of successful GET
+responses so that subsequent requests can be made conditional.  A 304 from
+the server is then answered from the cache.  GitHub doesn't count 304s
+against the rate limit so this is effectively free polling.
+
+Where webhooks tell us when something changes we needn't poll at all.  A
+scope (eg a repository) we are receiving events for is "watched", and an
+entry under a watched scope is fresh, so can be used without a request,
+until its max age passes or an event invalidates its URL.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import threading
+import time
+from collections import OrderedDict
+
+
+def _encoded_size(content):
+    """Length of content once base64 encoded"""
+    return 4 * ((len(content) + 2) // 3)
+
+
+class CachedResponse(object):
+    """
+    Stands in for a urlfetch result when we answer from the cache
+    """
+    def __init__(self, status_code, content, headers, stored=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        # When the server last confirmed this response
+        self.stored = time.time() if stored is None else stored
+
+
+class ResponseCache(object):
+    """
+    LRU of responses keyed by (token, method, url), bounded by both the
+    number of entries and the total size of their content
+
+    Only responses carrying a validator are stored, anything else can't be
+    revalidated so there's no point holding on to it.
+
+    If given a SharedCache, entries are also written there for ttl seconds
+    and local misses are filled from it.
+    """
+
+    def __init__(self, capacity=512, max_entry_size=1024*1024, shared=None,
+                 ttl=24*3600, watch_ttl=7*24*3600, max_bytes=32*1024*1024):
+        self.capacity = capacity
+        self.max_entry_size = max_entry_size
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.ttl = ttl
+        self.watch_ttl = watch_ttl
+        self._entries = OrderedDict()
+        # Total len(content) of _entries
+        self._bytes = 0
+        # url -> time of the last event that changed it
+        self._invalidated = OrderedDict()
+        # scope -> time we stop trusting events for it
+        self._watched = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.fresh_hits = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        """
+        Find the entry for key locally, falling back to the shared tier
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry
+        if self.shared is None:
+            return None
+        stored = self.shared.get("response", key)
+        if stored is None:
+            return None
+        entry = CachedResponse(stored["status_code"],
+                               base64.b64decode(stored["content"]),
+                               stored["headers"],
+                               stored.get("stored", 0))
+        self._store(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            self._bytes += len(entry.content)
+            self.stores += 1
+            while len(self._entries) > self.capacity or \
+                    (self._bytes > self.max_bytes and len(self._entries) > 1):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.content)
+                self.evictions += 1
+
+    def _drop(self, key):
+        """Remove key from _entries, lock must be held"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.content)
+        return entry
+
+    def conditional(self, key):
+        """
+        Returns (headers, entry): the headers making a request for key
+        conditional and the entry they validate, for update() to answer
+        a 304 with even if it has been evicted in the meantime
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            return {}, None
+        headers = {}
+        etag = entry.headers.get("ETag")
+        if etag:
+            headers["If-None-Match"] = etag
+        modified = entry.headers.get("Last-Modified")
+        if modified:
+            headers["If-Modified-Since"] = modified
+        return headers, entry
+
+    def update(self, key, response, requested=None, validated=None):
+        """
+        Process a response for key to a request made at time requested,
+        conditional on the entry validated (see conditional())
+
+        A 304 is replaced by the cached response, a 200 with a validator
+        is stored.  Returns the response the caller should use.
+        """
+        # A change while the request was in flight mustn't look older than
+        # the response
+        requested = time.time() if requested is None else requested
+        if response.status_code == 304:
+            entry = validated or self._lookup(key)
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                    return response
+                self.hits += 1
+                entry.stored = max(entry.stored, requested)
+                evicted = key not in self._entries
+            if evicted:
+                self._store(key, entry)
+            return entry
+
+        with self._lock:
+            self.misses += 1
+
+        if response.status_code != 200:
+            return response
+
+        headers = response.headers
+        etag = headers.get("ETag")
+        modified = headers.get("Last-Modified")
+        if not (etag or modified) or len(response.content) > self.max_entry_size:
+            return response
+
+        validators = {}
+        if etag:
+            validators["ETag"] = etag
+        if modified:
+            validators["Last-Modified"] = modified
+        # Pagination relies on this surviving a 304
+        link = headers.get("Link")
+        if link:
+            validators["Link"] = link
+
+        entry = CachedResponse(response.status_code, response.content, validators,
+                               requested)
+        self._store(key, entry)
+        # Don't encode what the shared tier would only refuse
+        if self.shared is not None and \
+                _encoded_size(entry.content) < self.shared.max_value_size:
+            self.shared.set("response", key, {
+                "status_code":  entry.status_code,
+                "content":      base64.b64encode(entry.content).decode("ascii"),
+                "headers":      validators,
+                "stored":       entry.stored}, ttl=self.ttl)
+        return response
+
+    def fresh(self, key, max_age, scope):
+        """
+        Return the entry for key if it can be used without asking the
+        server: scope is watched, the entry is less than max_age seconds
+        old and nothing has changed its URL since.  Otherwise None.
+        """
+        if not self.watching(scope):
+            return None
+        entry = self._lookup(key)
+        if entry is None or time.time() - entry.stored >= max_age or \
+                entry.stored <= self._invalidated_at(key[2]):
+            return None
+        with self._lock:
+            self.fresh_hits += 1
+        return entry
+
+    def _invalidated_at(self, url):
+        with self._lock:
+            local = self._invalidated.get(url, 0)
+        if self.shared is None:
+            return local
+        return max(local, self.shared.get("invalidated", url) or 0)
+
+    def watch(self, scope):
+        """
+        Note that events for scope are being received
+        """
+        until = time.time() + self.watch_ttl
+        with self._lock:
+            self._watched[scope] = until
+        if self.shared is not None:
+            self.shared.set("watched", scope, until, ttl=self.watch_ttl)
+
+    def watching(self, scope):
+        now = time.time()
+        with self._lock:
+            until = self._watched.get(scope, 0)
+        if until > now:
+            return True
+        if self.shared is None:
+            return False
+        until = self.shared.get("watched", scope) or 0
+        if until <= now:
+            return False
+        with self._lock:
+            self._watched[scope] = until
+        return True
+
+    def invalidate(self, key):
+        """Drop a single entry"""
+        if self.shared is not None:
+            self.shared.delete("response", key)
+        with self._lock:
+            return self._drop(key) is not None
+
+    def invalidate_url(self, url):
+        """
+        Something changed url: drop our entries for it, whoever's token
+        they were fetched with, and stop anyone treating theirs as fresh
+
+        Returns the number of local entries dropped
+        """
+        now = time.time()
+        with self._lock:
+            self.invalidations += 1
+            self._invalidated.pop(url, None)
+            self._invalidated[url] = now
+            while len(self._invalidated) > 4 * self.capacity:
+                self._invalidated.popitem(last=False)
+            keys = [key for key in self._entries if key[2] == url]
+            for key in keys:
+                self._drop(key)
+        if self.shared is not None:
+            self.shared.set("invalidated", url, now, ttl=self.ttl)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._invalidated.clear()
+            self._watched.clear()
+
+    def stats(self):
+        return {"entries":      len(self._entries),
+                "bytes":        self._bytes,
+                "hits":         self.hits,
+                "misses":       self.misses,
+                "stores":       self.stores,
+                "evictions":    self.evictions,
+                "fresh_hits":   self.fresh_hits,
+                "invalidations": self.invalidations,
+                "watched":      len(self._watched)}
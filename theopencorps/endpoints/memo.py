@@ -0,0 +1,162 @@
+"""
+Memoisation of endpoint methods
+
+Results are held per endpoint instance (weakly, so the memo never keeps an
+endpoint alive) in a bounded LRU with an optional time-to-live.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+# Every cache ever created, so we can export the counters
+_CACHES = weakref.WeakSet()
+
+
+def _make_key(args, kwargs):
+    if not kwargs:
+        return args
+    return args + (tuple(sorted(kwargs.items())),)
+
+
+class cache(object):    # pylint: disable=invalid-name
+    """
+    Decorator to memoise the return value of a method
+
+    The first positional argument is treated as the instance.  Use bare
+    (@cache) for the defaults or via memoize() to set maxsize and ttl.
+
+    If shared, values are also looked up in / written to the instance's
+    shared_cache (see sharedcache.py) under its cache_identity(), so other
+    processes serving the same identity can reuse them.  Values must then
+    be JSON serialisable.
+    """
+    def __init__(self, func, maxsize=128, ttl=None, shared=False):
+        self._func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.name = getattr(func, "__name__", repr(func))
+        self._memo = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        functools.update_wrapper(self, func)
+        _CACHES.add(self)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return functools.partial(self, instance)
+
+    def __call__(self, instance, *args, **kwargs):
+        key = _make_key(args, kwargs)
+        now = time.time()
+        with self._lock:
+            memo = self._memo.get(instance)
+            if memo is not None and key in memo:
+                expires, value = memo.pop(key)
+                if expires is None or expires > now:
+                    memo[key] = (expires, value)
+                    self.hits += 1
+                    return value
+                self.expirations += 1
+            self.misses += 1
+
+        tier = getattr(instance, "shared_cache", None) if self.shared else None
+        if tier is not None:
+            shared_key = ("%s.%s" % (self.__module__, self.name),
+                          instance.cache_identity(), key)
+            value = tier.get("memo", shared_key)
+            if value is None:
+                value = self._func(instance, *args, **kwargs)
+                tier.set("memo", shared_key, value, ttl=self.ttl)
+        else:
+            value = self._func(instance, *args, **kwargs)
+        expires = None if self.ttl is None else now + self.ttl
+
+        with self._lock:
+            memo = self._memo.setdefault(instance, OrderedDict())
+            memo.pop(key, None)
+            memo[key] = (expires, value)
+            while len(memo) > self.maxsize:
+                memo.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, instance, *args, **kwargs):
+        """
+        Forget a memoised value
+
+        With no arguments beyond the instance, everything held for that
+        instance is dropped.  Returns True if anything was removed.
+        """
+        with self._lock:
+            memo = self._memo.get(instance)
+            if memo is None:
+                return False
+            if not args and not kwargs:
+                del self._memo[instance]
+                return True
+            return memo.pop(_make_key(args, kwargs), None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._memo.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = sum(len(memo) for memo in self._memo.values())
+        return {"entries":      entries,
+                "hits":         self.hits,
+                "misses":       self.misses,
+                "evictions":    self.evictions,
+                "expirations":  self.expirations}
+
+
+def memoize(maxsize=128, ttl=None, shared=False):
+    """
+    Parameterised form of the cache decorator
+
+        @memoize(maxsize=64, ttl=300)
+        def method(self, ...):
+    """
+    def _decorator(func):
+        return cache(func, maxsize=maxsize, ttl=ttl, shared=shared)
+    return _decorator
+
+
+def cache_stats():
+    """
+    Return the counters for every live memoised method, keyed by name
+    """
+    stats = {}
+    for memo in list(_CACHES):
+        name = "%s.%s" % (getattr(memo, "__module__", "?"), memo.name)
+        stats[name] = memo.stats()
+    return stats
@@ -0,0 +1,172 @@
+"""
+Request instrumentation
+
+Latency and response size histograms, status code counts and in-flight
+gauges for every endpoint and route.  Routes are the resource with the
+variable parts (owners, repos, ids, SHAs, paths) replaced by placeholders
+so the number of series stays bounded.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import re
+import threading
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_ROUTES = [
+    (re.compile(r"\?.*$"),                          ""),
+    (re.compile(r"/[0-9a-f]{40}(?=/|$)"),           "/:sha"),
+    (re.compile(r"/\d+(?=/|$)"),                    "/:id"),
+    (re.compile(r"^/repos/(?!:id)[^/]+/[^/]+"),     "/repos/:owner/:repo"),
+    (re.compile(r"^/users/[^/]+/"),                 "/users/:user/"),
+    (re.compile(r"/contents/.*$"),                  "/contents/:path"),
+    (re.compile(r"/(refs/heads|branches)/.*$"),     r"/\1/:branch"),
+]
+
+
+def route_for(resource):
+    """
+    Reduce a resource to its route, eg /repos/:owner/:repo/hooks
+    """
+    for pattern, replacement in _ROUTES:
+        resource = pattern.sub(replacement, resource)
+    return resource
+
+
+class Histogram(object):
+    """
+    Per-bucket (non-cumulative) counts plus running count and sum
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile, None if that's
+        the overflow bucket
+        """
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def snapshot(self):
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {"buckets":  dict(zip(bounds, self.counts)),
+                "count":    self.count,
+                "sum":      self.total}
+
+
+class _Series(object):
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        self.status = {}
+        self.inflight = 0
+
+
+class Metrics(object):
+    """
+    Registry of request series keyed by (endpoint, method, route)
+    """
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        return series
+
+    def started(self, endpoint, method, resource):
+        """
+        Record an RPC being issued, returns the key to pass to finished()
+        """
+        key = (endpoint, method, route_for(resource))
+        with self._lock:
+            self._get(key).inflight += 1
+        return key
+
+    def finished(self, key, latency, status_code=None, size=0):
+        """
+        Record the outcome of an RPC, status_code None for a transport error
+        """
+        status = "error" if status_code is None else str(status_code)
+        with self._lock:
+            series = self._get(key)
+            series.inflight -= 1
+            series.latency.observe(latency)
+            series.size.observe(size)
+            series.status[status] = series.status.get(status, 0) + 1
+
+    def latency_quantile(self, key, q, min_samples=20):
+        """
+        Approximate latency quantile for a series, None until we've seen
+        min_samples requests
+        """
+        with self._lock:
+            series = self._series.get(key)
+            if series is None or series.latency.count < min_samples:
+                return None
+            return series.latency.quantile(q)
+
+    def inflight(self, endpoint=None):
+        with self._lock:
+            return sum(series.inflight for key, series in self._series.items()
+                       if endpoint is None or key[0] == endpoint)
+
+    def snapshot(self):
+        """
+        Everything we've recorded as a JSON serialisable dict, keyed by
+        endpoint then "METHOD route"
+        """
+        result = {}
+        with self._lock:
+            for (endpoint, method, route), series in self._series.items():
+                result.setdefault(endpoint, {})["%s %s" % (method, route)] = {
+                    "latency":  series.latency.snapshot(),
+                    "bytes":    series.size.snapshot(),
+                    "status":   dict(series.status),
+                    "inflight": series.inflight}
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+METRICS = Metrics()
@@ -0,0 +1,220 @@
+"""
+Rate limit aware scheduling of requests
+
+GitHub reports the remaining budget for a token in X-RateLimit-* headers and
+asks us to back off with Retry-After when we trip a secondary limit.  We
+track that per token and hold requests back before the budget runs out,
+letting high priority work (merges driven by webhooks) go ahead of low
+priority work (polling).
+
+    PRIORITY_HIGH       only waits if the budget is exhausted
+    PRIORITY_NORMAL     also leaves a reserve untouched for high priority
+    PRIORITY_LOW        additionally paced by a token bucket spreading the
+                        remaining budget evenly until the reset
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+def _fingerprint(token):
+    """Never expose the token itself in metrics"""
+    if token is None:
+        return "anonymous"
+    return hashlib.sha1(str(token).encode("utf8")).hexdigest()[:8]
+
+
+class _Budget(object):
+    """
+    What we know about the budget of a single token
+    """
+    def __init__(self, burst):
+        self.limit = None
+        self.remaining = None
+        self.reset = 0
+        self.retry_until = 0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.rate = None
+        self.refilled = time.time()
+        self.waiters = []
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def delay(self, priority, reserve, now):
+        """
+        Seconds to wait before a request of this priority may proceed
+        """
+        if now < self.retry_until:
+            return self.retry_until - now
+        if self.remaining is None:
+            return 0
+        if now >= self.reset:
+            # The window has rolled over, the next response will tell us
+            # the new budget
+            self.remaining = None
+            self.rate = None
+            return 0
+        if self.remaining <= 0:
+            return self.reset - now
+        if priority == PRIORITY_HIGH:
+            return 0
+        if self.remaining <= reserve:
+            return self.reset - now
+        if priority == PRIORITY_LOW and self.rate is not None:
+            self.refill(now)
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0
+
+    def consume(self, priority):
+        if self.remaining is not None:
+            self.remaining -= 1
+        if priority == PRIORITY_LOW and self.rate is not None:
+            self.tokens -= 1
+
+
+class RateLimiter(object):
+    """
+    Per token budget tracking and prioritised admission of requests
+
+    reserve is the number of calls held back for PRIORITY_HIGH, burst the
+    capacity of the bucket pacing PRIORITY_LOW.
+    """
+
+    def __init__(self, reserve=100, burst=10):
+        self.reserve = reserve
+        self.burst = burst
+        self._budgets = {}
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+        self.delayed = 0
+        self.rejected = 0
+
+    def _budget(self, token):
+        budget = self._budgets.get(token)
+        if budget is None:
+            budget = self._budgets[token] = _Budget(self.burst)
+        return budget
+
+    def acquire(self, token, priority=PRIORITY_NORMAL, timeout=None):
+        """
+        Block until a request may be made with token
+
+        Returns False if that didn't happen within timeout seconds
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            budget = self._budget(token)
+            entry = (priority, next(self._sequence))
+            heapq.heappush(budget.waiters, entry)
+            waited = False
+            try:
+                while True:
+                    now = time.time()
+                    delay = budget.delay(priority, self.reserve, now)
+                    if budget.waiters[0] == entry and delay <= 0:
+                        budget.consume(priority)
+                        return True
+                    if budget.waiters[0] != entry:
+                        # Somebody more important is ahead of us, they'll
+                        # wake us when they go
+                        delay = None
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        delay = remaining if delay is None else min(delay, remaining)
+                    waited = True
+                    self._cond.wait(delay)
+            finally:
+                budget.waiters.remove(entry)
+                heapq.heapify(budget.waiters)
+                if waited:
+                    self.delayed += 1
+                self._cond.notify_all()
+
+    def update(self, token, response):
+        """
+        Update our view of the budget for token from a response
+        """
+        headers = response.headers
+        remaining = headers.get("X-RateLimit-Remaining")
+        retry_after = headers.get("Retry-After")
+        if remaining is None and retry_after is None:
+            return
+
+        now = time.time()
+        with self._cond:
+            budget = self._budget(token)
+            try:
+                if remaining is not None:
+                    budget.remaining = int(remaining)
+                    budget.limit = int(headers.get("X-RateLimit-Limit", remaining))
+                    budget.reset = int(headers.get("X-RateLimit-Reset", now))
+                    budget.refill(now)
+                    window = max(budget.reset - now, 1)
+                    budget.rate = max(budget.remaining - self.reserve, 0) / float(window)
+                if retry_after is not None and response.status_code in (403, 429):
+                    budget.retry_until = now + int(retry_after)
+            except ValueError:
+                return
+            self._cond.notify_all()
+
+    def budget(self, token):
+        """
+        Remaining calls for token, or None if we haven't been told
+        """
+        with self._cond:
+            return self._budget(token).remaining
+
+    def queue_depth(self, token=None):
+        with self._cond:
+            if token is not None:
+                return len(self._budget(token).waiters)
+            return sum(len(budget.waiters) for budget in self._budgets.values())
+
+    def stats(self):
+        with self._cond:
+            tokens = dict((_fingerprint(token), {
+                "limit":        budget.limit,
+                "remaining":    budget.remaining,
+                "reset":        budget.reset,
+                "queued":       len(budget.waiters)})
+                          for token, budget in self._budgets.items())
+        return {"tokens":   tokens,
+                "delayed":  self.delayed,
+                "rejected": self.rejected}
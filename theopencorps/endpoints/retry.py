@@ -0,0 +1,160 @@
+"""
+Retrying and hedging of idempotent requests
+
+Transient failures (connection errors, timeouts, 5xx) on idempotent requests
+are retried with exponential backoff until an overall deadline.  A GET that
+has taken longer than the usual (p95) latency for its route can also be
+hedged: a duplicate is sent and whichever answers first wins.
+
+Non-idempotent requests (merges, forks, PUTs to the contents API...) are
+never retried.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import time
+
+from theopencorps.endpoints.futures import Backoff
+from theopencorps.endpoints.transport import TransportError
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class RetryPolicy(object):
+    """
+    How hard to try before giving up on an idempotent request
+
+        max_attempts    total attempts including the first
+        deadline        overall seconds across all attempts
+        hedge           send a duplicate GET once past the route's p95
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, max_attempts=3, deadline=30.0, backoff=None,
+                 retry_statuses=(500, 502, 503, 504), hedge=True):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff = backoff or Backoff(initial=0.2, maximum=5.0)
+        self.retry_statuses = retry_statuses
+        self.hedge = hedge
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def applies(self, method):
+        return method in IDEMPOTENT_METHODS and self.max_attempts > 1
+
+    def stats(self):
+        return {"retries":      self.retries,
+                "hedges":       self.hedges,
+                "hedge_wins":   self.hedge_wins}
+
+
+class RetryingRPC(object):
+    """
+    Wraps a transport RPC, re-issuing it when it fails transiently
+
+    Honours the rpc get_result() contract.  Backoff between attempts happens
+    in the thread collecting the result.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, transport, url, request_args, policy, hedge_after=None,
+                 send=None, resend=None):
+        """
+        send() starts the first attempt, by default transport.fetch_async().
+        resend(hedge) starts another, or returns None if it may not be sent
+        (eg the rate limiter refused) in which case we make do without.
+        """
+        self.transport = transport
+        self.url = url
+        self.request_args = request_args
+        self.policy = policy
+        self.hedge_after = hedge_after if policy.hedge else None
+        self.started = time.time()
+        self.attempts = 1
+        self.log = logging.getLogger(__name__)
+        self._delays = policy.backoff.delays()
+        self._send = send or (lambda: transport.fetch_async(url, **request_args))
+        self._resend = resend or (lambda hedge: self._send())
+        self._rpc = self._send()
+
+    @property
+    def transport_rpc(self):
+        """The transport's RPC for the current attempt, for wait_any()"""
+        return self._rpc
+
+    def get_result(self):
+        while True:
+            try:
+                response = self._wait()
+                error = None
+            except TransportError as e:
+                response, error = None, e
+
+            if error is None and \
+                    response.status_code not in self.policy.retry_statuses:
+                return response
+
+            delay = next(self._delays)
+            if self.attempts >= self.policy.max_attempts or \
+                    time.time() + delay > self.started + self.policy.deadline:
+                if error is not None:
+                    raise error
+                return response
+
+            self.log.warning("Retrying %s in %.2fs after attempt %d (%s)",
+                             self.url, delay, self.attempts,
+                             error if error is not None else response.status_code)
+            time.sleep(delay)
+            rpc = self._resend(False)
+            if rpc is None:
+                self.log.warning("No rate limit budget to retry %s", self.url)
+                if error is not None:
+                    raise error
+                return response
+            self.policy.retries += 1
+            self.attempts += 1
+            self._rpc = rpc
+
+    def _wait(self):
+        """
+        Wait for the current attempt, hedging the first if it runs long and
+        the transport lets us wait with a timeout
+        """
+        if self.hedge_after is None or self.attempts > 1 or \
+                not self.transport.supports_hedging or \
+                self.transport.wait(self._rpc, self.hedge_after):
+            return self._rpc.get_result()
+
+        hedge = self._resend(True)
+        if hedge is None:
+            return self._rpc.get_result()
+        self.log.info("Hedging %s after %.3fs", self.url, self.hedge_after)
+        self.policy.hedges += 1
+        first = self.transport.wait_any([self._rpc, hedge])
+        second = self._rpc if first is hedge else hedge
+        if first is hedge:
+            self.policy.hedge_wins += 1
+        try:
+            return first.get_result()
+        except TransportError:
+            return second.get_result()
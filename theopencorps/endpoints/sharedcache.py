@@ -0,0 +1,201 @@
+"""
+Second tier cache shared between instances
+
+Every App Engine instance starts cold.  Memoised values (users, repo keys)
+and conditional-request responses are also written to memcache so a new
+instance can pick them up instead of going back to GitHub and Travis.
+
+Values are serialised to JSON ourselves and keys are namespaced and hashed,
+so any client with a memcache-style get/set/delete interface will do.  LocalCache is an
+in-process stand-in for tests and for running outside GAE.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+_now = time.time
+
+# memcache rejects values over 1MB, leave room for the key and flags
+MAX_VALUE_SIZE = 1000 * 1000
+
+
+class LocalCache(object):
+    """
+    In-memory implementation of the subset of the memcache API we use
+    """
+    def __init__(self):
+        self._store = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires <= _now():
+                del self._store[key]
+                return None
+            return value
+
+    def set(self, key, value, time=0):    # pylint: disable=redefined-outer-name
+        with self._lock:
+            self._store[key] = (_now() + time if time else 0, value)
+        return True
+
+    def add(self, key, value, time=0):    # pylint: disable=redefined-outer-name
+        """Set only if key isn't already present"""
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is not None and not (entry[0] and entry[0] <= _now()):
+                return False
+            self._store[key] = (_now() + time if time else 0, value)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return 2 if self._store.pop(key, None) is not None else 1
+
+    def get_multi(self, keys):
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def flush_all(self):
+        with self._lock:
+            self._store.clear()
+        return True
+
+
+class SharedCache(object):
+    """
+    Namespaced, JSON serialising front end to a memcache-style client
+
+    Values serialising to more than max_value_size bytes aren't sent.
+    """
+    def __init__(self, client, namespace="theopencorps", version=1,
+                 max_value_size=MAX_VALUE_SIZE):
+        self.client = client
+        self.max_value_size = max_value_size
+        self.prefix = "%s:v%d:" % (namespace, version)
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+        self.oversized = 0
+
+    def key(self, kind, key):
+        """
+        Key stored in the backend.  The caller's key is always hashed: it
+        may contain a token and memcache keys are limited to 250 bytes.
+        """
+        digest = hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+        return "%s%s:%s" % (self.prefix, kind, digest)
+
+    def get(self, kind, key):
+        """
+        Return the value stored for (kind, key), or None
+        """
+        try:
+            value = self.client.get(self.key(kind, key))
+        except Exception as e:  # pylint: disable=broad-except
+            self.errors += 1
+            self.log.warning("Shared cache get failed (%r)", e)
+            return None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, kind, key, value, ttl=None):
+        """
+        Store a JSON serialisable value, expiring after ttl seconds
+        """
+        serialised = json.dumps(value)
+        if len(serialised) > self.max_value_size:
+            self.oversized += 1
+            return False
+        try:
+            if self.client.set(self.key(kind, key), serialised,
+                               time=int(ttl or 0)):
+                self.sets += 1
+                return True
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.warning("Shared cache set failed (%r)", e)
+        self.errors += 1
+        return False
+
+    def add(self, kind, key, value, ttl=None):
+        """
+        Store value only if nothing is held for (kind, key)
+
+        Returns True if we stored it, so can be used to claim a key.  If the
+        backend fails we return True: better to do work twice than never.
+        """
+        try:
+            if self.client.add(self.key(kind, key), json.dumps(value),
+                               time=int(ttl or 0)):
+                self.sets += 1
+                return True
+            return False
+        except Exception as e:  # pylint: disable=broad-except
+            self.errors += 1
+            self.log.warning("Shared cache add failed (%r)", e)
+        return True
+
+    def delete(self, kind, key):
+        try:
+            self.client.delete(self.key(kind, key))
+        except Exception as e:  # pylint: disable=broad-except
+            self.errors += 1
+            self.log.warning("Shared cache delete failed (%r)", e)
+
+    def stats(self):
+        return {"hits":     self.hits,
+                "misses":   self.misses,
+                "sets":     self.sets,
+                "errors":   self.errors,
+                "oversized": self.oversized}
+
+
+def default_shared_cache():
+    """
+    memcache on App Engine, otherwise no shared tier
+    """
+    if memcache is None:
+        return None
+    return SharedCache(memcache)
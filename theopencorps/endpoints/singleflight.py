@@ -0,0 +1,152 @@
+"""
+Coalescing of identical in-flight requests
+
+When several callers ask for the same resource with the same credentials at
+the same time, only the first issues an RPC.  The others join it and are
+handed the same response, each parsing their own copy of the JSON.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+from theopencorps.endpoints.transport import TransportError
+
+
+class SharedRPC(object):
+    """
+    An RPC whose (post-processed) response is handed to every caller
+
+    Honours the rpc get_result() contract so it can sit behind an
+    ASyncResult.  A transport failure is raised to every caller as the
+    flight's error class rather than the leader's TransportError.
+    """
+    def __init__(self, flight, key, msg):
+        self.msg = msg
+        self.created = time.time()
+        self.rpc = None
+        self._flight = flight
+        self._key = key
+        self._process = None
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+        self._collected = False
+        self._response = None
+        self._error = None
+
+    @property
+    def transport_rpc(self):
+        """The transport's RPC we're waiting on, for wait_any()"""
+        return getattr(self.rpc, "transport_rpc", self.rpc)
+
+    def start(self, start):
+        """
+        start() issues the real RPC, returning (rpc, process)
+        """
+        try:
+            self.rpc, self._process = start()
+        except Exception as e:
+            self._error = self._flight.wrap(self.msg, e)
+            self._collected = True
+            self._flight.forget(self._key, self)
+            if self._error is e:
+                raise
+            raise self._error
+        finally:
+            self._started.set()
+
+    def get_result(self):
+        self._started.wait()
+        with self._lock:
+            if not self._collected:
+                try:
+                    self._response = self._process(self.rpc.get_result())
+                except TransportError as e:
+                    self._error = self._flight.wrap(self.msg, e)
+                self._collected = True
+                self._flight.forget(self._key, self)
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+
+class SingleFlight(object):
+    """
+    Table of shareable RPCs in flight
+
+    An RPC is shareable until its response has been collected, or for window
+    seconds, whichever comes first.  The window stops callers joining an RPC
+    nobody has waited on for a while (and may therefore be stale).
+
+    Transport failures are shared as error (if given), constructed with
+    HTTPException style arguments.
+    """
+    def __init__(self, window=5.0, error=None):
+        self.window = window
+        self.error = error
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.coalesced = 0
+
+    def call(self, key, msg, start):
+        """
+        Return the SharedRPC for key, calling start() to issue it if there
+        isn't one we can join
+        """
+        with self._lock:
+            shared = self._calls.get(key)
+            if shared is not None and time.time() - shared.created < self.window:
+                self.coalesced += 1
+                return shared
+            if len(self._calls) > 1024:
+                self._prune()
+            shared = self._calls[key] = SharedRPC(self, key, msg)
+            self.issued += 1
+        shared.start(start)
+        return shared
+
+    def _prune(self):
+        """Drop entries nobody collected within the window"""
+        now = time.time()
+        for key, shared in list(self._calls.items()):
+            if now - shared.created >= self.window:
+                del self._calls[key]
+
+    def wrap(self, msg, error):
+        """The exception to share in place of error"""
+        if self.error is None or not isinstance(error, TransportError):
+            return error
+        return self.error("%s failed (%r)", msg, error)
+
+    def forget(self, key, shared):
+        with self._lock:
+            if self._calls.get(key) is shared:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            inflight = len(self._calls)
+        return {"issued":       self.issued,
+                "coalesced":    self.coalesced,
+                "inflight":     inflight}
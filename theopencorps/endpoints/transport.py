@@ -0,0 +1,437 @@
+"""
+HTTP transports used by APIEndpointBase
+
+On GAE we use the URLFetch service.  Everywhere else (workers, batch jobs,
+tests) we fall back to a pool of keep-alive connections built on httplib,
+so TLS sessions to api.github.com and api.travis-ci.org are reused rather
+than paying for a handshake on every call.
+
+A transport provides:
+
+    fetch(url, **kwargs)        -> response
+    fetch_async(url, **kwargs)  -> rpc with get_result(), and a transport
+                                   member to wait_any() it with
+    wait_any(rpcs)              -> the first rpc to complete
+    wait(rpc, timeout)          -> True if rpc completed within timeout
+                                   (only if supports_hedging)
+    settle()                    -> wait for RPCs this thread started but
+                                   never collected
+
+where the keyword arguments are those of urlfetch.fetch and a response has
+status_code, content and (case-insensitive) headers members.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import socket
+import threading
+
+try:
+    import httplib
+    from urlparse import urljoin, urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urljoin, urlsplit
+
+try:
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
+
+from theopencorps.endpoints.futures import BACKGROUND_THREADS, Executor, wait_any
+
+
+class TransportError(IOError):
+    """The request couldn't be completed (DNS, connection, timeout...)"""
+    pass
+
+
+class Headers(object):
+    """
+    Case-insensitive mapping of response headers
+    """
+    def __init__(self, items=()):
+        self._store = {}
+        for name, value in items:
+            self[name] = value
+
+    def __setitem__(self, name, value):
+        self._store[name.lower()] = (name, value)
+
+    def __getitem__(self, name):
+        return self._store[name.lower()][1]
+
+    def __contains__(self, name):
+        return name.lower() in self._store
+
+    def __iter__(self):
+        return (name for name, _ in self._store.values())
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, name, default=None):
+        entry = self._store.get(name.lower())
+        return default if entry is None else entry[1]
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self._store.values())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class Response(object):
+    """
+    Mirrors the interesting parts of a urlfetch result
+    """
+    def __init__(self, status_code, content, headers, final_url=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.final_url = final_url
+
+
+class Transport(object):
+    """
+    Base class, subclasses must implement at least fetch_async()
+    """
+    # Can we wait on an RPC with a timeout (and so hedge slow requests)?
+    supports_hedging = False
+
+    def fetch(self, url, **kwargs):
+        return self.fetch_async(url, **kwargs).get_result()
+
+    def fetch_async(self, url, callback=None, **kwargs):
+        """
+        Start fetching url, returns an RPC with get_result()
+
+        callback(response), response None if the fetch failed, is called
+        once the RPC completes whether or not it is ever collected, though
+        see URLFetchTransport for when that is noticed
+        """
+        raise NotImplementedError()
+
+    def settle(self):
+        """
+        Make sure every callback for an RPC started by this thread has
+        been called, eg at the end of a request
+        """
+        pass
+
+    def wait_any(self, rpcs):
+        raise NotImplementedError()
+
+    def wait(self, rpc, timeout):
+        raise NotImplementedError()
+
+
+class _URLFetchRPC(object):
+    """
+    Translates urlfetch errors into TransportError
+    """
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def get_result(self):
+        try:
+            return self.rpc.get_result()
+        except urlfetch.Error as e:
+            raise TransportError(repr(e))
+
+    def response(self):
+        """The result, or None if the fetch failed"""
+        try:
+            return self.get_result()
+        except TransportError:
+            return None
+
+
+class URLFetchTransport(Transport):
+    """
+    GAE URLFetch service
+
+    The API proxy only runs an RPC's callback when something waits on it
+    (get_result(), wait_any()...), so a fetch_async callback sees the time
+    the RPC was first waited on, not when it completed.  An RPC nobody
+    collects is waited on by settle(), which the app calls at the end of
+    every request.
+    """
+    def __init__(self):
+        if urlfetch is None:
+            raise TransportError("URLFetch is only available on App Engine")
+        # RPCs with a callback started by each thread (ie request)
+        self._started = threading.local()
+
+    def fetch(self, url, **kwargs):
+        try:
+            return urlfetch.fetch(url, **kwargs)
+        except urlfetch.Error as e:
+            raise TransportError(repr(e))
+
+    def fetch_async(self, url, callback=None, **kwargs):
+        rpc = urlfetch.create_rpc(deadline=kwargs.pop("deadline", None))
+        wrapped = _URLFetchRPC(rpc)
+        wrapped.transport = self
+        if callback is not None:
+            wrapped.settled = False
+
+            def _completed():
+                wrapped.settled = True
+                response = None
+                try:
+                    response = wrapped.response()
+                finally:
+                    callback(response)
+            rpc.callback = _completed
+            started = getattr(self._started, "rpcs", None)
+            if started is None:
+                started = self._started.rpcs = []
+            started[:] = [other for other in started if not other.settled]
+            started.append(wrapped)
+        urlfetch.make_fetch_call(rpc, url, **kwargs)
+        return wrapped
+
+    def settle(self):
+        started = getattr(self._started, "rpcs", None) or []
+        self._started.rpcs = []
+        for wrapped in started:
+            if wrapped.settled:
+                continue
+            try:
+                wrapped.rpc.wait()
+            except Exception:   # pylint: disable=broad-except
+                logging.getLogger(__name__).exception(
+                    "Uncollected RPC failed (%r)", wrapped.rpc)
+
+    def wait_any(self, rpcs):
+        rpcs = list(rpcs)
+        done = apiproxy_stub_map.UserRPC.wait_any([rpc.rpc for rpc in rpcs])
+        for rpc in rpcs:
+            if rpc.rpc is done:
+                return rpc
+        return rpcs[0]
+
+
+class _HostPool(object):
+    """
+    Idle keep-alive connections to a single host, with a cap on the number
+    of connections open at once
+    """
+    def __init__(self, scheme, netloc, limit):
+        self.scheme = scheme
+        self.netloc = netloc
+        self._slots = threading.BoundedSemaphore(limit)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """
+        Returns (connection, reused), which must be given back to release()
+        """
+        self._slots.acquire()
+        try:
+            with self._lock:
+                if self._idle:
+                    conn = self._idle.pop()
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+            return self.connect(timeout), False
+        except Exception:
+            self._slots.release()
+            raise
+
+    def connect(self, timeout):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.netloc, timeout=timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=timeout)
+
+    def release(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_BODY_HEADERS = ("content-type", "content-length")
+_CREDENTIAL_HEADERS = ("authorization", "cookie")
+
+
+def _without(headers, names):
+    return dict((name, value) for name, value in headers.items()
+                if name.lower() not in names)
+
+
+class PooledHTTPTransport(Transport):
+    """
+    HTTP/1.1 keep-alive transport using the standard library
+
+    At most max_per_host connections are open to any host at once, async
+    requests run on a pool of max_workers threads.  On App Engine there is
+    no pool (see futures.py) so async requests are made as they are
+    collected and can't be hedged: use URLFetchTransport there.
+    """
+    _redirects = (301, 302, 303, 307, 308)
+    supports_hedging = BACKGROUND_THREADS
+
+    def __init__(self, max_per_host=4, max_workers=16, timeout=30,
+                 max_redirects=5):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._executor = Executor(max_workers, name="http")
+
+    def _pool(self, scheme, netloc):
+        with self._lock:
+            pool = self._pools.get((scheme, netloc))
+            if pool is None:
+                pool = _HostPool(scheme, netloc, self.max_per_host)
+                self._pools[(scheme, netloc)] = pool
+            return pool
+
+    def fetch(self, url, **kwargs):
+        return self._fetch(url, None, **kwargs)
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def _fetch(self, url, sent, payload=None, method="GET", headers=None,
+               allow_truncated=False, follow_redirects=True, deadline=None,
+               validate_certificate=None):
+        headers = dict(headers or {})
+        timeout = deadline or self.timeout
+        origin = urlsplit(url).netloc
+        for _ in range(self.max_redirects + 1):
+            response = self._request(url, method, payload, headers, timeout, sent)
+            location = response.headers.get("Location")
+            if not follow_redirects or location is None or \
+                            response.status_code not in self._redirects:
+                return response
+            url = urljoin(url, location)
+            # Only 307 / 308 ask for the request to be repeated as it was
+            if response.status_code not in (307, 308):
+                if method != "HEAD":
+                    method = "GET"
+                payload = None
+                headers = _without(headers, _BODY_HEADERS)
+            # Credentials are for the API, not wherever it sends us (eg
+            # Travis logs are redirected to S3)
+            if urlsplit(url).netloc != origin:
+                headers = _without(headers, _CREDENTIAL_HEADERS)
+        raise TransportError("Too many redirects fetching %s" % url)
+
+    def fetch_async(self, url, callback=None, **kwargs):
+        sent = threading.Event()
+        rpc = self._executor.submit(self._fetch, url, sent, **kwargs)
+        rpc.sent = sent
+        rpc.transport = self
+        if callback is not None:
+            rpc.add_done_callback(lambda future: callback(
+                None if future.exception() is not None else future.get_result()))
+        return rpc
+
+    def wait_any(self, rpcs):
+        return wait_any(list(rpcs))
+
+    def wait(self, rpc, timeout):
+        """
+        Time spent queued for a worker or a connection doesn't count, a
+        hedge sent then would only join the queue
+        """
+        sent = getattr(rpc, "sent", None)
+        if sent is not None:
+            while not sent.wait(timeout):
+                if rpc.done():
+                    return True
+        return rpc.wait(timeout)
+
+    # pylint: disable=too-many-arguments
+    def _request(self, url, method, payload, headers, timeout, sent=None):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        pool = self._pool(parts.scheme, parts.netloc)
+
+        conn, reused = pool.acquire(timeout)
+        # Whatever goes wrong the slot is given back
+        reusable = False
+        try:
+            if sent is not None:
+                sent.set()
+            while True:
+                try:
+                    conn.request(method, path, body=payload, headers=headers)
+                    response = conn.getresponse()
+                    content = response.read()
+                except (socket.error, httplib.HTTPException) as e:
+                    conn.close()
+                    # The server may have dropped an idle connection, try
+                    # once more on a fresh one
+                    if reused:
+                        conn, reused = pool.connect(timeout), False
+                        continue
+                    raise TransportError("%s %s failed (%s)" % (method, url, repr(e)))
+                break
+            reusable = not response.will_close
+        finally:
+            pool.release(conn, reusable)
+        return Response(response.status, content,
+                        Headers(response.getheaders()), final_url=url)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
+
+_DEFAULT = []
+_DEFAULT_LOCK = threading.Lock()
+
+
+def default_transport():
+    """
+    Process-wide transport: URLFetch on App Engine, pooled HTTP elsewhere
+    """
+    with _DEFAULT_LOCK:
+        if not _DEFAULT:
+            if urlfetch is not None:
+                _DEFAULT.append(URLFetchTransport())
+            else:
+                _DEFAULT.append(PooledHTTPTransport())
+        return _DEFAULT[0]
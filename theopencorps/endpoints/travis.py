@@ -25,12 +25,24 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import json
-import time
+import re
 import base64
+from collections import namedtuple
 
 import rsa
 
-from theopencorps.endpoints import APIEndpointBase, cache, HTTPException, auth
+from theopencorps.endpoints import APIEndpointBase, memoize, HTTPException, auth, \
+                                   PRIORITY_LOW
+from theopencorps.endpoints.futures import Backoff, Executor, poll
+
+_ENCRYPTORS = Executor(8, name="encrypt")
+
+# Build states after which a build won't change
+FINISHED_STATES = ("passed", "failed", "errored", "canceled")
+
+BuildSync = namedtuple("BuildSync", ["builds", "jobs", "after_number"])
+
+LOG_CHUNK_SIZE = 256 * 1024
 
 
 class TravisEndpoint(APIEndpointBase):
@@ -38,10 +50,27 @@ class TravisEndpoint(APIEndpointBase):
     _endpoint = "https://api.travis-ci.org"
     _accept = "application/vnd.travis-ci.2+json"
 
-    def __init__(self, token=None):
-        APIEndpointBase.__init__(self)
+    # Build notifications tell us when these change
+    _max_age = (
+        (re.compile(r"^(/repos/[^/?]+/[^/?]+)$"), 24*3600),
+        (re.compile(r"^(/repos/[^/?]+/[^/?]+)/builds$"), 24*3600),
+    )
+
+    def __init__(self, token=None, transport=None):
+        APIEndpointBase.__init__(self, transport=transport)
         self.token = "\"%s\"" % token
 
+    def _next_page(self, resource, response, items):
+        """
+        Travis doesn't send Link headers, list resources which support paging
+        take after_number instead
+        """
+        if not items or "number" not in items[-1]:
+            return None
+        resource = re.sub(r"[?&]after_number=[^&]*$", "", resource)
+        separator = "&" if "?" in resource else "?"
+        return "%s%safter_number=%s" % (resource, separator, items[-1]["number"])
+
     def login(self):
         if self.token is not None:
             self.log.info("Already logged into Travis with token %s", self.token)
@@ -60,6 +89,42 @@ class TravisEndpoint(APIEndpointBase):
         """
         return self.request_json("/repos/%s/%s" % (user, repo))
 
+    @classmethod
+    def build_changed(cls, owner, repo, build_id, job_ids=(), repo_id=None):
+        """
+        Invalidate what a build starting or finishing changes
+        """
+        resources = ["/repos/%s/%s" % (owner, repo),
+                     "/repos/%s/%s/builds" % (owner, repo),
+                     "/builds/%d" % build_id]
+        if repo_id is not None:
+            resources += ["/repos/%d" % repo_id, "/repos/%d/builds" % repo_id]
+        resources += ["/jobs/%d" % job_id for job_id in job_ids]
+        cls.invalidate(*resources)
+
+    @memoize(maxsize=1, ttl=24*3600, shared=True)
+    def notification_key(self):
+        """
+        PEM of the key Travis signs webhook notifications with
+        """
+        response = self.request("/config")
+        if response.status_code != 200:
+            raise HTTPException("Attempt to retrieve Travis config returned %d",
+                                response.status_code)
+        config = json.loads(response.content)["config"]
+        return config["notifications"]["webhook"]["public_key"]
+
+    def verify_notification(self, payload, signature):
+        """
+        Check the Signature header of a webhook notification
+        """
+        try:
+            key = rsa.PublicKey.load_pkcs1_openssl_pem(self.notification_key())
+            rsa.verify(payload, base64.b64decode(signature), key)
+        except (rsa.VerificationError, ValueError, TypeError):
+            return False
+        return True
+
     def get_build(self, build_id):
         """
         Returns a JSON object representing a build
@@ -72,6 +137,130 @@ class TravisEndpoint(APIEndpointBase):
         """
         return self.request_json("/jobs/%s" % repr(job_id))
 
+    def get_builds(self, build_ids, max_in_flight=8):
+        """
+        Fetch many builds concurrently
+
+        Returns a list of BatchResult in the order of build_ids
+        """
+        return list(self.request_many(["/builds/%s" % repr(build_id)
+                                       for build_id in build_ids],
+                                      max_in_flight=max_in_flight))
+
+    def get_jobs(self, job_ids, max_in_flight=8):
+        """
+        Fetch many jobs concurrently
+
+        Returns a list of BatchResult in the order of job_ids
+        """
+        return list(self.request_many(["/jobs/%s" % repr(job_id)
+                                       for job_id in job_ids],
+                                      max_in_flight=max_in_flight))
+
+    def iter_builds(self, repo, after_number=None):
+        """
+        Lazily iterate over the builds of repo (id or "owner/name"), newest
+        first, stopping at build number after_number
+        """
+        until = None
+        if after_number is not None:
+            until = lambda build: int(build["number"]) <= after_number
+        return self.paginate("/repos/%s/builds" % repo, key="builds", until=until)
+
+    def sync_builds(self, repo, after_number=None, max_in_flight=8):
+        """
+        Fetch the builds of repo newer than after_number, and their jobs
+
+        Only the pages holding new builds are requested and the jobs are
+        fetched concurrently, so the cost of a poll depends on the number of
+        new builds rather than the length of the history.
+
+        Returns a BuildSync:
+            builds          new builds, oldest first
+            jobs            dict job id -> job for those builds
+            after_number    high-water mark to pass to the next call
+
+        The mark doesn't advance past a build which hasn't finished or whose
+        jobs couldn't all be fetched, so builds above it may be returned
+        again next time.
+        """
+        builds = list(self.iter_builds(repo, after_number))
+        builds.reverse()
+
+        job_ids = [job_id for build in builds for job_id in build.get("job_ids", [])]
+        jobs = {}
+        for result in self.request_many(["/jobs/%d" % job_id for job_id in job_ids],
+                                        max_in_flight=max_in_flight,
+                                        ordered=False):
+            if result.error is not None:
+                self.log.warning("Failed to fetch job %d (%s)",
+                                 job_ids[result.index], result.error)
+                continue
+            jobs[job_ids[result.index]] = result.result
+
+        for build in builds:
+            if build["state"] not in FINISHED_STATES or \
+                    not all(job_id in jobs for job_id in build.get("job_ids", [])):
+                break
+            after_number = int(build["number"])
+
+        self.log.info("Synchronised %d new builds (%d jobs) of %s, now at %s",
+                      len(builds), len(jobs), repo, after_number)
+        return BuildSync(builds, jobs, after_number)
+
+    def _log_chunk(self, job_id, offset, chunk_size):
+        return self.request_async("/jobs/%d/log" % job_id,
+                                  headers={"Accept": "text/plain",
+                                           "Range": "bytes=%d-%d" % (
+                                               offset, offset + chunk_size - 1)})
+
+    def iter_log(self, job_id, offset=0, chunk_size=LOG_CHUNK_SIZE):
+        """
+        Generator yielding the log of a job in chunks from byte offset
+
+        The request for the next chunk is in flight while the caller
+        processes the current one.  A running job's log can be resumed
+        later from the offset reached (the sum of the chunk lengths).
+        """
+        pending = self._log_chunk(job_id, offset, chunk_size)
+        while pending is not None:
+            response = pending.get_response()
+            if response is None:
+                raise HTTPException("Failed to fetch log of job %d at %d",
+                                    job_id, offset)
+            # Nothing beyond offset (yet)
+            if response.status_code == 416:
+                return
+            if response.status_code == 200:
+                # Range was ignored and we have the whole log
+                chunk = response.content[offset:]
+                pending = None
+            elif response.status_code == 206:
+                chunk = response.content
+                pending = None
+                if len(chunk) == chunk_size:
+                    pending = self._log_chunk(job_id, offset + len(chunk),
+                                              chunk_size)
+            else:
+                raise HTTPException("Fetching log of job %d at %d returned %d",
+                                    job_id, offset, response.status_code)
+            if chunk:
+                offset += len(chunk)
+                yield chunk
+
+    def read_log(self, job_id, pipeline, offset=0, chunk_size=LOG_CHUNK_SIZE):
+        """
+        Feed the log of a job from offset through pipeline (see logparse)
+
+        Returns the offset to resume from if the job is still running
+        """
+        for chunk in self.iter_log(job_id, offset, chunk_size):
+            pipeline.feed(chunk)
+            offset += len(chunk)
+        self.log.info("Read log of job %d to byte %d (%d lines)",
+                      job_id, offset, pipeline.lines)
+        return offset
+
     @auth
     def update_settings(self, repo_id, **kwargs):
         """
@@ -86,33 +275,46 @@ class TravisEndpoint(APIEndpointBase):
 
 
     @auth
-    def sync(self, block=True):
+    def sync(self, block=True, timeout=60, backoff=None, callback=None):
         """
-        If block then don't return until sync is complete
+        Ask Travis to synchronise with GitHub
 
-        TODO should use a future with a callback so this happens in parallel
+        Returns a Future resolved with the synced_at time once Travis reports
+        the sync is complete, polling with exponential backoff until timeout
+        seconds have passed.  No thread is held between polls so many syncs
+        can be in progress at once.  callback(future) is called on completion.
+
+        If block then don't return until sync is complete (returns synced_at)
         """
         response = self.request("/users/sync", method="POST")
         if response.status_code not in [200, 409]:
             raise HTTPException("Sync request returned %d", response.status_code)
-        count = 0
-        while block:
-            response = json.loads(self.request("/users/").content)
+
+        polls = [0]
+        def _synced():
+            polls[0] += 1
+            response = json.loads(self.request("/users/", priority=PRIORITY_LOW).content)
             user = response['user']
-            if not user['is_syncing']:
-                self.log.info("Synchronised at %s after %d polls", 
-                              user['synced_at'],
-                              count)
-                break
-            # Busy waiting on an HTTP API probably isn't that friendly...
-            time.sleep(0.01)
-            count += 1
-            if count > 50:
-                raise HTTPException("Failed to sync within 0.5 seconds")
+            if user['is_syncing']:
+                return None
+            self.log.info("Synchronised at %s after %d polls",
+                          user['synced_at'],
+                          polls[0])
+            return user['synced_at'] or ""
+
+        future = poll(_synced, backoff or Backoff(initial=0.5, maximum=10.0),
+                      timeout=timeout,
+                      timeout_exception=HTTPException(
+                          "Failed to sync within %d seconds", timeout))
+        if callback is not None:
+            future.add_done_callback(callback)
+        if block:
+            return future.get_result()
+        return future
 
     @auth
     def is_synced(self):
-        response = json.loads(self.request("/users/").content)
+        response = json.loads(self.request("/users/", priority=PRIORITY_LOW).content)
         user = response['user']
         if not user['is_syncing']:
             return True
@@ -120,8 +322,14 @@ class TravisEndpoint(APIEndpointBase):
         return False
 
     @auth
+    def iter_hooks(self):
+        """
+        Lazily iterate over all hooks
+        """
+        return self.paginate("/hooks", key="hooks")
+
     def get_hooks(self):
-        return self.request_json("/hooks")
+        return {"hooks": list(self.iter_hooks())}
 
     @auth
     def enable_hook(self, hook_id):
@@ -149,11 +357,19 @@ class TravisEndpoint(APIEndpointBase):
         return True
 
     @auth
-    @cache
+    @memoize(maxsize=256, ttl=24*3600, shared=True)
     def get_key(self, owner, repo_name):
         response = json.loads(self.request('/repos/%s/%s/key' % (owner, repo_name)).content)
         return response['key']
 
+    @auth
+    @memoize(maxsize=256, ttl=24*3600)
+    def get_public_key(self, owner, repo_name):
+        """
+        Parsed form of get_key, so the PEM is only parsed once per repo
+        """
+        return rsa.PublicKey.load_pkcs1_openssl_pem(self.get_key(owner, repo_name))
+
     @auth
     def encrypt(self, owner, repo_name, string):
         """
@@ -161,8 +377,39 @@ class TravisEndpoint(APIEndpointBase):
 
         Returns a base64 encoded string suitable for use in YML file
         """
-        rsa_key = self.get_key(owner, repo_name)
-        pubkey = rsa.PublicKey.load_pkcs1_openssl_pem(rsa_key)
-        secure = rsa.encrypt(string.encode('utf8'), pubkey)
-        return base64.b64encode(secure)
+        return self.encrypt_many(owner, repo_name, [string])[0]
 
+    @auth
+    def encrypt_many(self, owner, repo_name, strings):
+        """
+        Encrypt several strings using the repositories key
+
+        Travis decrypts plain PKCS#1 v1.5 RSA, so each string has to fit in
+        a single block (the key size in bytes less 11).
+        """
+        pubkey = self.get_public_key(owner, repo_name)
+        limit = rsa.common.byte_size(pubkey.n) - 11
+        secure = []
+        for string in strings:
+            message = string.encode('utf8')
+            if len(message) > limit:
+                raise ValueError("%d bytes is too long to encrypt for %s/%s "
+                                 "(limit is %d)" % (len(message), owner,
+                                                    repo_name, limit))
+            secure.append(base64.b64encode(rsa.encrypt(message, pubkey)))
+        return secure
+
+    def encrypt_repos(self, secrets):
+        """
+        Encrypt secrets for many repositories at once
+            secrets     (dict)  (owner, repo_name) -> list of strings
+
+        Repositories are handled on a pool of workers, so fetching their
+        keys overlaps.  Returns a dict (owner, repo_name) -> list of
+        encrypted strings.
+        """
+        futures = dict((repo, _ENCRYPTORS.submit(self.encrypt_many,
+                                                 repo[0], repo[1], strings))
+                       for repo, strings in secrets.items())
+        return dict((repo, future.get_result())
+                    for repo, future in futures.items())
@@ -0,0 +1,140 @@
+"""
+Cache invalidation driven by webhooks
+
+Branch heads, repository metadata and Travis build state only change when
+something happens that GitHub or Travis tells us about.  Each push and
+build notification is published here as an event.  Subscribers evict
+exactly what the event changed, for example the head of one branch.
+Receiving events for a repository also marks it as watched, and responses
+for a watched repository are used without asking again until an event
+invalidates them (see APIEndpointBase._max_age).
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+from collections import namedtuple
+
+from theopencorps.endpoints.github import GithubEndpoint
+from theopencorps.endpoints.travis import TravisEndpoint
+
+# sha is None if the branch was deleted
+HeadMoved = namedtuple("HeadMoved", ["owner", "repo", "branch", "sha"])
+
+BuildChanged = namedtuple("BuildChanged", ["owner", "repo", "repo_id", "build_id",
+                                           "number", "state", "job_ids"])
+
+_NULL_SHA = "0" * 40
+
+
+def parse_head_moved(payload):
+    """
+    Return the HeadMoved described by a push event payload, or None if it
+    isn't to a branch
+    """
+    ref = payload.get("ref", "")
+    if not ref.startswith("refs/heads/"):
+        return None
+    repository = payload["repository"]
+    owner = repository["owner"]
+    sha = payload.get("after")
+    if payload.get("deleted") or sha == _NULL_SHA:
+        sha = None
+    return HeadMoved(owner.get("login") or owner["name"],
+                     repository["name"],
+                     ref[len("refs/heads/"):],
+                     sha)
+
+
+def parse_build(payload):
+    """
+    Return the BuildChanged described by a Travis webhook notification
+    """
+    repository = payload["repository"]
+    return BuildChanged(repository["owner_name"],
+                        repository["name"],
+                        repository.get("id"),
+                        int(payload["id"]),
+                        payload.get("number"),
+                        payload.get("state") or payload.get("status_message"),
+                        tuple(int(job["id"]) for job in payload.get("matrix") or ()))
+
+
+def evict_responses(event):
+    """
+    Subscriber dropping the cached API responses an event has changed
+    """
+    if isinstance(event, HeadMoved):
+        GithubEndpoint.watch("/repos/%s/%s" % (event.owner, event.repo))
+        GithubEndpoint.head_moved(event.owner, event.repo, event.branch)
+    elif isinstance(event, BuildChanged):
+        TravisEndpoint.watch("/repos/%s/%s" % (event.owner, event.repo))
+        TravisEndpoint.build_changed(event.owner, event.repo, event.build_id,
+                                     job_ids=event.job_ids, repo_id=event.repo_id)
+
+
+class InvalidationBus(object):
+    """
+    Hands every event to each subscriber, callback(event), in the order
+    they subscribed
+    """
+    def __init__(self):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, event):
+        with self._lock:
+            self.published += 1
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception:   # pylint: disable=broad-except
+                with self._lock:
+                    self.failed += 1
+                self.log.exception("%r failed to handle %r", callback, event)
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers":  len(self._subscribers),
+                    "published":    self.published,
+                    "failed":       self.failed}
+
+
+def invalidation_bus(app):
+    """
+    The app's invalidation bus, created on first use with the response
+    cache subscribed
+    """
+    bus = app.registry.get("invalidation")
+    if bus is None:
+        created = InvalidationBus()
+        bus = app.registry.setdefault("invalidation", created)
+        if bus is created:
+            bus.subscribe(evict_responses)
+    return bus
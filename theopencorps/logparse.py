@@ -0,0 +1,177 @@
+"""
+Incremental extraction of results from CI job logs
+
+Logs arrive as arbitrary chunks of bytes (see TravisEndpoint.read_log).
+A LogPipeline reassembles them into lines, strips the terminal escapes
+Travis records and hands each line to every parser, so only the current
+line and the parsers' results are ever held in memory.
+
+A parser is anything with feed(line) and result(), plus a name to file
+its result under.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+
+_ANSI = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+
+# Anything longer is binary junk or a runaway progress bar
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class LineParser(object):
+    """
+    Base class for parsers fed one line (without the newline) at a time
+    """
+    name = None
+
+    def feed(self, line):
+        raise NotImplementedError()
+
+    def result(self):
+        raise NotImplementedError()
+
+
+class CocotbParser(LineParser):
+    """
+    Test outcomes from a cocotb regression
+
+    Understands both the per-test log messages and the summary table.
+    """
+    name = "cocotb"
+
+    _TEST = re.compile(r"Test (Passed|Failed|errored): (\S+)")
+    _ROW = re.compile(r"^\*\* (\S+)\s+(PASS|FAIL)\s")
+
+    def __init__(self):
+        self.tests = {}
+
+    def feed(self, line):
+        match = self._TEST.search(line)
+        if match is not None:
+            self.tests[match.group(2)] = "PASS" if match.group(1) == "Passed" else "FAIL"
+            return
+        match = self._ROW.search(line)
+        if match is not None:
+            self.tests[match.group(1)] = match.group(2)
+
+    def result(self):
+        passed = sum(1 for outcome in self.tests.values() if outcome == "PASS")
+        return {"tests":    self.tests,
+                "passed":   passed,
+                "failed":   len(self.tests) - passed}
+
+
+class YosysStatParser(LineParser):
+    """
+    Resource use per module from the Yosys stat command
+
+    If stat runs more than once (before and after synthesis) the last
+    report for a module wins.
+    """
+    name = "yosys"
+
+    _MODULE = re.compile(r"^=== (.+) ===\s*$")
+    _COUNT = re.compile(r"^\s+Number of ([a-z ]+):\s+(\d+)\s*$")
+    _CELL = re.compile(r"^\s{4,}(\S+)\s+(\d+)\s*$")
+    _AREA = re.compile(r"^\s+Chip area for (?:module|top module) .*: ([0-9.]+)\s*$")
+
+    def __init__(self):
+        self.modules = {}
+        self._current = None
+        self._in_cells = False
+
+    def feed(self, line):
+        match = self._MODULE.match(line)
+        if match is not None:
+            self._current = {"cell_types": {}}
+            self.modules[match.group(1).lstrip("\\")] = self._current
+            self._in_cells = False
+            return
+        if self._current is None:
+            return
+        match = self._COUNT.match(line)
+        if match is not None:
+            name = match.group(1).strip().replace(" ", "_")
+            self._current[name] = int(match.group(2))
+            self._in_cells = name == "cells"
+            return
+        if self._in_cells:
+            match = self._CELL.match(line)
+            if match is not None:
+                self._current["cell_types"][match.group(1)] = int(match.group(2))
+                return
+            self._in_cells = False
+        match = self._AREA.match(line)
+        if match is not None:
+            self._current["area"] = float(match.group(1))
+        elif not line.strip() or line.startswith(("   ", "\t")):
+            return
+        else:
+            # Something other than the report, stop attributing lines
+            self._current = None
+
+    def result(self):
+        return self.modules
+
+
+class LogPipeline(object):
+    """
+    Feed chunks of a log through a set of line parsers
+
+        pipeline = LogPipeline(CocotbParser(), YosysStatParser())
+        offset = travis.read_log(job_id, pipeline)
+        ...
+        offset = travis.read_log(job_id, pipeline, offset)   # still running
+        pipeline.close()
+        pipeline.results()
+    """
+    def __init__(self, *parsers):
+        self.parsers = parsers
+        self.lines = 0
+        self.bytes = 0
+        self._partial = b""
+
+    def feed(self, chunk):
+        self.bytes += len(chunk)
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()[-MAX_LINE_LENGTH:]
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        """Flush a final line with no newline, once the log is complete"""
+        if self._partial:
+            self._line(self._partial)
+            self._partial = b""
+
+    def _line(self, raw):
+        self.lines += 1
+        line = _ANSI.sub("", raw[:MAX_LINE_LENGTH].decode("utf8", "replace"))
+        # Progress output overwrites itself with carriage returns
+        line = line.rstrip("\r").rsplit("\r", 1)[-1]
+        for parser in self.parsers:
+            parser.feed(line)
+
+    def results(self):
+        return dict((parser.name, parser.result()) for parser in self.parsers)
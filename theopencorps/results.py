@@ -0,0 +1,429 @@
+"""
+Result history of every project
+
+Each (project, branch) has a Series: one row per commit, ordered by commit
+time, held column-wise.  Times and each metric are a flat array of doubles
+(NaN where a build didn't report a metric) and the commit SHAs are packed
+20 bytes apiece, so a row costs a few dozen bytes however many builds we
+hold.  Sorted times make a range query two bisections, and per day / per
+week rollups are updated as results are recorded so history pages never
+scan the rows.
+
+A Series serialises to a compact blob (dumps / loads) for persistence.
+The ResultsStore keeps each blob in the shared cache (memcache on App
+Engine) so that every instance sees results whichever one recorded them,
+and a new instance starts with them.  Results are recorded from finished
+Travis builds, see webhooks.ResultRecorder.
+
+memcache is the only copy: a series it evicts is lost, as is one too
+large for it (some ten thousand builds), and two instances recording to
+the same branch at once can drop one of the rows.  A durable store (the
+datastore) is still to come.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import binascii
+import json
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from theopencorps.endpoints import APIEndpointBase
+
+NAN = float("nan")
+
+PERIODS = {"day": 24*3600, "week": 7*24*3600}
+
+_SHA_SIZE = 20
+
+
+def _values(column):
+    """JSON friendly copy of a column, None where there's no value"""
+    return [None if value != value else value for value in column]
+
+
+def _span(times, start, end):
+    """Indices of the entries of sorted times in [start, end)"""
+    lo = 0 if start is None else bisect_left(times, start)
+    hi = len(times) if end is None else bisect_left(times, end)
+    return lo, max(lo, hi)
+
+
+def _tobytes(column):
+    return column.tobytes() if hasattr(column, "tobytes") else column.tostring()
+
+
+def _frombytes(column, data):
+    if hasattr(column, "frombytes"):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)
+    return column
+
+
+class Rollup(object):
+    """
+    Count, total, minimum and maximum of every metric per fixed period
+    """
+    def __init__(self, period):
+        self.period = period
+        self.starts = array("d")
+        self.stats = {}
+
+    def _column(self, metric):
+        stats = self.stats.get(metric)
+        if stats is None:
+            buckets = len(self.starts)
+            stats = (array("l", [0]) * buckets, array("d", [0.0]) * buckets,
+                     array("d", [NAN]) * buckets, array("d", [NAN]) * buckets)
+            self.stats[metric] = stats
+        return stats
+
+    def bucket(self, when):
+        """Start of the period holding when"""
+        return when - when % self.period
+
+    def _slot(self, when):
+        start = self.bucket(when)
+        index = bisect_left(self.starts, start)
+        if index == len(self.starts) or self.starts[index] != start:
+            self.starts.insert(index, start)
+            for count, total, low, high in self.stats.values():
+                count.insert(index, 0)
+                total.insert(index, 0.0)
+                low.insert(index, NAN)
+                high.insert(index, NAN)
+        return index
+
+    def add(self, when, metrics):
+        index = self._slot(when)
+        for metric, value in metrics.items():
+            if value != value:
+                continue
+            count, total, low, high = self._column(metric)
+            count[index] += 1
+            total[index] += value
+            # Comparisons with NaN are false, so the first value always lands
+            if not low[index] <= value:
+                low[index] = value
+            if not high[index] >= value:
+                high[index] = value
+
+    def merge(self, when, metric, values):
+        """Add several values (none NaN) of metric to the bucket holding when"""
+        index = self._slot(when)
+        count, total, low, high = self._column(metric)
+        count[index] += len(values)
+        total[index] += sum(values)
+        low[index] = min(values) if low[index] != low[index] else min(low[index], min(values))
+        high[index] = max(values) if high[index] != high[index] else max(high[index], max(values))
+
+    def reset(self, when):
+        """Empty the bucket holding when, ready for it to be recomputed"""
+        index = self._slot(when)
+        for count, total, low, high in self.stats.values():
+            count[index] = 0
+            total[index] = 0.0
+            low[index] = NAN
+            high[index] = NAN
+
+    def query(self, start=None, end=None, metrics=None):
+        """
+        Buckets starting in [start, end) as columns:
+
+            {"time": [...], metric: {"count": [...], "mean": [...],
+                                     "min": [...], "max": [...]}}
+        """
+        lo, hi = _span(self.starts, start, end)
+        result = {"time": list(self.starts[lo:hi])}
+        for metric in (self.stats if metrics is None else metrics):
+            if metric not in self.stats:
+                result[metric] = None
+                continue
+            count, total, low, high = self.stats[metric]
+            result[metric] = {
+                "count":    list(count[lo:hi]),
+                "mean":     [total[i] / count[i] if count[i] else None
+                             for i in range(lo, hi)],
+                "min":      _values(low[lo:hi]),
+                "max":      _values(high[lo:hi])}
+        return result
+
+
+class Series(object):
+    """
+    Results of one branch of a project, one row per commit in time order
+    """
+    def __init__(self):
+        self.times = array("d")
+        self.commits = bytearray()
+        self.columns = {}
+        self.rollups = dict((name, Rollup(period)) for name, period in PERIODS.items())
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.times)
+
+    def _column(self, metric):
+        column = self.columns.get(metric)
+        if column is None:
+            column = array("d", [NAN]) * len(self.times)
+            self.columns[metric] = column
+        return column
+
+    def _commits(self, lo, hi):
+        packed = binascii.hexlify(bytes(self.commits[lo * _SHA_SIZE:hi * _SHA_SIZE]))
+        packed = packed.decode("ascii")
+        width = 2 * _SHA_SIZE
+        return [packed[offset:offset + width] for offset in range(0, len(packed), width)]
+
+    def _find(self, when, sha):
+        index = bisect_left(self.times, when)
+        while index < len(self.times) and self.times[index] == when:
+            offset = index * _SHA_SIZE
+            if self.commits[offset:offset + _SHA_SIZE] == sha:
+                return index
+            index += 1
+        return None
+
+    def record(self, commit, when, metrics):
+        """
+        Record metrics (dict name -> number) for commit, made at time when
+        (seconds since the epoch)
+
+        Recording the same commit again (a rebuild) updates its row.
+        Raises ValueError unless commit is a full 40 character hex SHA.
+        """
+        try:
+            sha = bytearray(binascii.unhexlify(commit))
+        except (TypeError, binascii.Error):
+            sha = None
+        if sha is None or len(sha) != _SHA_SIZE:
+            raise ValueError("%r is not a full commit SHA" % (commit,))
+        with self._lock:
+            for metric in metrics:
+                self._column(metric)
+            index = self._find(when, sha)
+            if index is None:
+                index = bisect_right(self.times, when)
+                self.times.insert(index, when)
+                self.commits[index * _SHA_SIZE:index * _SHA_SIZE] = sha
+                for metric, column in self.columns.items():
+                    column.insert(index, metrics.get(metric, NAN))
+                for rollup in self.rollups.values():
+                    rollup.add(when, metrics)
+                return
+
+            for metric, value in metrics.items():
+                self.columns[metric][index] = value
+            for rollup in self.rollups.values():
+                start = rollup.bucket(when)
+                rollup.reset(when)
+                self._rebuild(rollup, *_span(self.times, start, start + rollup.period))
+
+    def _rebuild(self, rollup, lo, hi):
+        """Add rows [lo, hi) to rollup, a bucket at a time"""
+        times = self.times
+        while lo < hi:
+            start = rollup.bucket(times[lo])
+            end = bisect_left(times, start + rollup.period, lo, hi)
+            for metric, column in self.columns.items():
+                values = [value for value in column[lo:end] if value == value]
+                if values:
+                    rollup.merge(start, metric, values)
+            lo = end
+
+    def query(self, start=None, end=None, metrics=None):
+        """
+        Rows with commit times in [start, end) as columns:
+
+            {"time": [...], "commit": [...], metric: [...]}
+        """
+        with self._lock:
+            lo, hi = _span(self.times, start, end)
+            result = {"time": list(self.times[lo:hi]),
+                      "commit": self._commits(lo, hi)}
+            for metric in (self.columns if metrics is None else metrics):
+                column = self.columns.get(metric)
+                result[metric] = _values(column[lo:hi]) if column is not None else None
+            return result
+
+    def rollup(self, period="day", start=None, end=None, metrics=None):
+        with self._lock:
+            return self.rollups[period].query(start, end, metrics)
+
+    def latest(self):
+        """The most recent row as a dict, or None"""
+        with self._lock:
+            if not self.times:
+                return None
+            row = {"time": self.times[-1], "commit": self._commits(len(self.times) - 1,
+                                                                     len(self.times))[0]}
+            for metric, column in self.columns.items():
+                if column[-1] == column[-1]:
+                    row[metric] = column[-1]
+            return row
+
+    def dumps(self):
+        """
+        Serialise to bytes: a JSON header line followed by the raw columns
+        """
+        with self._lock:
+            metrics = sorted(self.columns)
+            header = json.dumps({"rows":        len(self.times),
+                                 "metrics":     metrics,
+                                 "byteorder":   sys.byteorder})
+            return b"".join([header.encode("utf8"), b"\n",
+                             _tobytes(self.times), bytes(self.commits)] +
+                            [_tobytes(self.columns[metric]) for metric in metrics])
+
+    @classmethod
+    def loads(cls, data):
+        newline = data.index(b"\n")
+        header = json.loads(data[:newline].decode("utf8"))
+        rows = header["rows"]
+        swap = header["byteorder"] != sys.byteorder
+
+        def _take(offset, size):
+            return data[offset:offset + size], offset + size
+
+        series = cls()
+        offset = newline + 1
+        chunk, offset = _take(offset, rows * series.times.itemsize)
+        _frombytes(series.times, chunk)
+        chunk, offset = _take(offset, rows * _SHA_SIZE)
+        series.commits = bytearray(chunk)
+        for metric in header["metrics"]:
+            column = array("d")
+            chunk, offset = _take(offset, rows * column.itemsize)
+            series.columns[metric] = _frombytes(column, chunk)
+
+        for column in [series.times] + list(series.columns.values()):
+            if swap:
+                column.byteswap()
+        for rollup in series.rollups.values():
+            series._rebuild(rollup, 0, rows)
+        return series
+
+
+class ResultsStore(object):
+    """
+    Series for every branch of every project
+
+    Callbacks registered with subscribe() are called with (project, branch)
+    whenever results for that branch are recorded, here or (when we notice)
+    by another instance.
+
+    Given a SharedCache each Series is written there as it is recorded.
+    Alongside it is the time it was written, which is checked whenever the
+    series is used so that we pick up another instance's results.
+    """
+    def __init__(self, shared=None):
+        self.shared = shared
+        self._series = {}
+        # (project, branch) -> when the shared copy we hold was written
+        self._written = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def _notify(self, project, branch):
+        for callback in self._listeners:
+            callback(project, branch)
+
+    def series(self, project, branch, create=False):
+        key = (project, branch)
+        if self.shared is not None:
+            self._refresh(key)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None and create:
+                series = self._series[key] = Series()
+            return series
+
+    def _refresh(self, key):
+        """Load the shared copy of a series if it's newer than ours"""
+        written = self.shared.get("results-written", key)
+        with self._lock:
+            if written is None or written == self._written.get(key):
+                return
+        blob = self.shared.get("results", key)
+        if blob is None:
+            return
+        series = Series.loads(base64.b64decode(blob))
+        with self._lock:
+            self._series[key] = series
+            self._written[key] = written
+        self._notify(*key)
+
+    def _persist(self, key, series):
+        written = time.time()
+        blob = base64.b64encode(series.dumps()).decode("ascii")
+        if self.shared.set("results", key, blob) and \
+                self.shared.set("results-written", key, written):
+            with self._lock:
+                self._written[key] = written
+
+    def branches(self, project):
+        with self._lock:
+            return sorted(branch for name, branch in self._series if name == project)
+
+    # pylint: disable=too-many-arguments
+    def record(self, project, branch, commit, when, metrics):
+        series = self.series(project, branch, create=True)
+        series.record(commit, when, metrics)
+        if self.shared is not None:
+            self._persist((project, branch), series)
+        self._notify(project, branch)
+
+    def query(self, project, branch, start=None, end=None, metrics=None):
+        series = self.series(project, branch)
+        return series.query(start, end, metrics) if series is not None else None
+
+    def rollup(self, project, branch, period="day", start=None, end=None,
+               metrics=None):
+        series = self.series(project, branch)
+        if series is None:
+            return None
+        return series.rollup(period, start, end, metrics)
+
+    def latest(self, project, branch):
+        series = self.series(project, branch)
+        return series.latest() if series is not None else None
+
+
+def results_store(app):
+    """
+    The app's results store, created on first use and backed by the same
+    shared cache as the API endpoints
+    """
+    store = app.registry.get("results")
+    if store is None:
+        store = app.registry.setdefault(
+            "results", ResultsStore(shared=APIEndpointBase.shared_cache))
+    return store
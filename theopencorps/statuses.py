@@ -0,0 +1,143 @@
+"""
+Batched publishing of GitHub commit statuses
+
+While a matrix build runs every job wants to update the status of the same
+commit.  Only the latest state for a (repository, commit, context) is of
+any interest, so updates are buffered for a short interval and anything
+superseded in the meantime is never sent.  The survivors are sent
+concurrently.
+
+On App Engine there is no timer thread to flush with, so a request which
+publishes statuses must call flush() before it returns.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from theopencorps.endpoints.futures import BACKGROUND_THREADS, Executor, call_later
+
+_FLUSHERS = Executor(2, name="statuses")
+
+Status = namedtuple("Status", ["state", "description", "target_url", "attempts"])
+
+
+class StatusPublisher(object):
+    """
+    Buffers commit statuses and sends the latest per (user, repo, sha1,
+    context) every interval seconds, at most max_in_flight at once
+
+    A status which fails with a transport error or a 5xx is put back, unless
+    superseded, up to max_attempts times.
+    """
+    def __init__(self, github, interval=1.0, max_in_flight=8, max_attempts=3):
+        self.github = github
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.log = logging.getLogger(self.__class__.__name__)
+        self._pending = OrderedDict()
+        self._scheduled = False
+        self._lock = threading.Lock()
+        # Flushes are serialised so that an older state can't overtake a newer one
+        self._flushing = threading.Lock()
+        self.queued = 0
+        self.superseded = 0
+        self.sent = 0
+        self.failed = 0
+
+    # pylint: disable=too-many-arguments
+    def publish(self, user, repo, sha1, state, context="theopencorps",
+                description="", target_url=None):
+        """
+        Queue a status, replacing any not yet sent for the same commit and
+        context
+        """
+        self._queue((user, repo, sha1, context),
+                    Status(state, description, target_url, 0), count=True)
+
+    def _queue(self, key, status, count=False):
+        with self._lock:
+            if count:
+                self.queued += 1
+            if key in self._pending:
+                if not count:
+                    # A retry loses to anything published since
+                    return
+                self.superseded += 1
+            self._pending[key] = status
+            if self._scheduled or not BACKGROUND_THREADS:
+                return
+            self._scheduled = True
+        call_later(self.interval, _FLUSHERS.submit, self.flush)
+
+    def flush(self):
+        """
+        Send everything buffered now, returns the number sent
+        """
+        with self._flushing:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+                self._scheduled = False
+
+            sent = 0
+            in_flight = []
+            for key, status in pending.items():
+                if len(in_flight) >= self.max_in_flight:
+                    sent += self._collect(*in_flight.pop(0))
+                user, repo, sha1, context = key
+                in_flight.append((key, status, self.github.create_status_async(
+                    user, repo, sha1, status.state, context=context,
+                    description=status.description, target_url=status.target_url)))
+            for entry in in_flight:
+                sent += self._collect(*entry)
+
+        if pending:
+            self.log.info("Sent %d of %d statuses", sent, len(pending))
+        return sent
+
+    def _collect(self, key, status, rpc):
+        response = rpc.get_response()
+        if response is not None and response.status_code == 201:
+            with self._lock:
+                self.sent += 1
+            return 1
+
+        with self._lock:
+            self.failed += 1
+        self.log.warning("Setting status %s of %s/%s@%s (%s) failed (%s)",
+                         status.state, key[0], key[1], key[2], key[3],
+                         None if response is None else response.status_code)
+        if (response is None or response.status_code >= 500) and \
+                status.attempts + 1 < self.max_attempts:
+            self._queue(key, status._replace(attempts=status.attempts + 1))
+        return 0
+
+    def stats(self):
+        with self._lock:
+            return {"queued":       self.queued,
+                    "superseded":   self.superseded,
+                    "sent":         self.sent,
+                    "failed":       self.failed,
+                    "pending":      len(self._pending)}
@@ -0,0 +1,528 @@
+"""
+Receiving GitHub and Travis webhooks
+
+Every push and build notification is published on the invalidation bus so
+cached API responses it changes are dropped.
+
+A push is acknowledged as soon as its signature has been checked and it has
+been queued.  The work (bringing our fork up to date and marking the commit
+as pending) happens in the background, and a burst of pushes to the same
+branch is handled as one: only the newest head is merged.
+
+On App Engine pushes go into a pull queue tagged by branch, and one named
+drain task per branch per window processes everything under that tag.
+Elsewhere LocalPushQueue does the same in-process.
+
+When Travis reports a push build finished, a task reads its job logs and
+records the results they report in the results store.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import calendar
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    taskqueue = None
+
+import webapp2
+
+from theopencorps.endpoints import APIEndpointBase, HTTPException
+from theopencorps.endpoints.futures import Executor, call_later
+from theopencorps.endpoints.github import GithubEndpoint
+from theopencorps.endpoints.travis import TravisEndpoint
+from theopencorps.invalidation import invalidation_bus, parse_build, parse_head_moved
+from theopencorps.logparse import CocotbParser, LogPipeline, YosysStatParser
+from theopencorps.results import results_store
+
+Push = namedtuple("Push", ["owner", "repo", "branch", "sha", "received"])
+
+# A finished build of a branch, finished in seconds since the epoch
+BuildResult = namedtuple("BuildResult", ["project", "branch", "sha", "finished",
+                                         "job_ids"])
+
+_NULL_SHA = "0" * 40
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else value.encode("utf8")
+
+
+def signature(secret, body):
+    """
+    The X-Hub-Signature GitHub sends with body when configured with secret
+    """
+    return "sha1=" + hmac.new(_bytes(secret), _bytes(body), hashlib.sha1).hexdigest()
+
+
+def verify_signature(secret, body, header):
+    """
+    Check a X-Hub-Signature header in constant time
+    """
+    if not header:
+        return False
+    expected = _bytes(signature(secret, body))
+    header = _bytes(header)
+    compare = getattr(hmac, "compare_digest", None)
+    if compare is not None:
+        return compare(expected, header)
+    if len(expected) != len(header):
+        return False
+    difference = 0
+    for a, b in zip(bytearray(expected), bytearray(header)):
+        difference |= a ^ b
+    return difference == 0
+
+
+def parse_push(payload):
+    """
+    Return the Push described by a push event payload, or None if it isn't
+    a new head of a branch (tags, deleted branches)
+    """
+    ref = payload.get("ref", "")
+    if not ref.startswith("refs/heads/") or payload.get("deleted") or \
+            payload.get("after", _NULL_SHA) == _NULL_SHA:
+        return None
+    repository = payload["repository"]
+    owner = repository["owner"]
+    return Push(owner.get("login") or owner["name"],
+                repository["name"],
+                ref[len("refs/heads/"):],
+                payload["after"],
+                time.time())
+
+
+def parse_result(payload):
+    """
+    Return the BuildResult described by a Travis webhook notification, or
+    None if the build hasn't finished or is of a pull request
+    """
+    if payload.get("type") == "pull_request" or not payload.get("finished_at"):
+        return None
+    repository = payload["repository"]
+    finished = calendar.timegm(time.strptime(payload["finished_at"],
+                                             "%Y-%m-%dT%H:%M:%SZ"))
+    return BuildResult("%s/%s" % (repository["owner_name"], repository["name"]),
+                       payload["branch"],
+                       payload["commit"],
+                       finished,
+                       [int(job["id"]) for job in payload.get("matrix") or ()])
+
+
+def job_metrics(reports):
+    """
+    The metrics (see badges) in the results of the log parsers of a
+    build's jobs
+    """
+    metrics = {}
+    for report in reports:
+        cocotb = report.get("cocotb") or {}
+        if cocotb.get("tests"):
+            for outcome in ("passed", "failed"):
+                metrics[outcome] = metrics.get(outcome, 0) + cocotb[outcome]
+        # The top module holds the most cells
+        cells = [module["cells"] for module in (report.get("yosys") or {}).values()
+                 if "cells" in module]
+        if cells:
+            metrics["cells"] = max([metrics.get("cells", 0)] + cells)
+    return metrics
+
+
+class Deliveries(object):
+    """
+    Remembers recent delivery IDs so that redelivered webhooks are dropped
+
+    Recent IDs are held locally, and claimed in the shared cache (if there
+    is one) so that a redelivery to another instance is caught too.  A
+    delivery should only be claimed once it has been handled, so that one
+    we failed part way through is retried when GitHub redelivers it.
+    """
+    def __init__(self, capacity=4096, ttl=24*3600, shared=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.shared = shared
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def known(self, delivery):
+        """
+        True if delivery has already been claimed, here or elsewhere
+        """
+        with self._lock:
+            if delivery in self._seen:
+                self.duplicates += 1
+                return True
+        if self.shared is not None and self.shared.get("delivery", delivery):
+            with self._lock:
+                self.duplicates += 1
+            return True
+        return False
+
+    def seen(self, delivery):
+        """
+        True if delivery has been seen before, otherwise records it
+        """
+        with self._lock:
+            if delivery in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen[delivery] = True
+            while len(self._seen) > self.capacity:
+                self._seen.popitem(last=False)
+        if self.shared is not None and \
+                not self.shared.add("delivery", delivery, 1, ttl=self.ttl):
+            with self._lock:
+                self.duplicates += 1
+            return True
+        return False
+
+
+class PushProcessor(object):
+    """
+    Brings our fork of a repository up to date with a push and marks the
+    pushed commit as pending
+    """
+    def __init__(self, github, organisation="theopencorps", context="theopencorps"):
+        self.github = github
+        self.organisation = organisation
+        self.context = context
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __call__(self, push):
+        fork = "%s/%s" % (self.organisation, push.repo)
+        try:
+            try:
+                self.github.cherry_pick(self.organisation, push.repo, push.sha,
+                                        branch=push.branch)
+            except HTTPException:
+                # Not a fast-forward
+                self.github.merge(self.organisation, push.repo, push.sha,
+                                  base=push.branch)
+        except HTTPException as e:
+            self.log.warning("Couldn't bring %s up to date with %s/%s@%s (%s)",
+                             fork, push.owner, push.repo, push.sha, e)
+            self.github.create_status(push.owner, push.repo, push.sha, "error",
+                                      context=self.context,
+                                      description="Unable to merge into %s" % fork)
+            return False
+        self.github.create_status(push.owner, push.repo, push.sha, "pending",
+                                  context=self.context,
+                                  description="Waiting for simulation and synthesis")
+        return True
+
+
+class ResultRecorder(object):
+    """
+    Reads the logs of a finished build's jobs and records the results they
+    report
+    """
+    def __init__(self, travis, store):
+        self.travis = travis
+        self.store = store
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __call__(self, result):
+        reports = []
+        for job_id in result.job_ids:
+            pipeline = LogPipeline(CocotbParser(), YosysStatParser())
+            self.travis.read_log(job_id, pipeline)
+            pipeline.close()
+            reports.append(pipeline.results())
+        metrics = job_metrics(reports)
+        if not metrics:
+            self.log.info("No results in the logs of %s@%s", result.project, result.sha)
+            return False
+        self.store.record(result.project, result.branch, result.sha,
+                          result.finished, metrics)
+        return True
+
+
+def _branch(push):
+    return "%s/%s:%s" % (push.owner, push.repo, push.branch)
+
+
+class LocalPushQueue(object):
+    """
+    In-process stand-in for the task queue, for tests and running outside
+    App Engine
+
+    A push is processed window seconds after the first of a burst arrives,
+    and never while an earlier push to the same branch is being processed.
+    """
+    def __init__(self, processor, window=2.0, max_workers=4):
+        self.processor = processor
+        self.window = window
+        self.log = logging.getLogger(self.__class__.__name__)
+        self._pending = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._executor = Executor(max_workers, name="pushes")
+        self.received = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.failed = 0
+
+    def add(self, push):
+        branch = _branch(push)
+        with self._lock:
+            self.received += 1
+            current = self._pending.get(branch)
+            if current is None:
+                self._pending[branch] = push
+            else:
+                self.coalesced += 1
+                if push.received >= current.received:
+                    self._pending[branch] = push
+                return
+        call_later(self.window, self._executor.submit, self._drain, branch)
+
+    def _drain(self, branch):
+        with self._lock:
+            if branch in self._running:
+                call_later(self.window, self._executor.submit, self._drain, branch)
+                return
+            push = self._pending.pop(branch)
+            self._running.add(branch)
+        try:
+            self.processor(push)
+            self.processed += 1
+        except Exception:   # pylint: disable=broad-except
+            self.failed += 1
+            self.log.exception("Failed to process push to %s", branch)
+        finally:
+            with self._lock:
+                self._running.discard(branch)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"received":     self.received,
+                "coalesced":    self.coalesced,
+                "processed":    self.processed,
+                "failed":       self.failed,
+                "pending":      pending}
+
+
+class TaskPushQueue(object):
+    """
+    App Engine task queue backed equivalent of LocalPushQueue
+
+    Needs the pull queue defined in queue.yaml and DrainPushes routed at
+    drain_url.
+    """
+    def __init__(self, processor, window=2, pull_queue="pushes",
+                 drain_url="/tasks/pushes"):
+        self.processor = processor
+        self.window = window
+        self.pull_queue = pull_queue
+        self.drain_url = drain_url
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def add(self, push):
+        branch = _branch(push)
+        taskqueue.Queue(self.pull_queue).add(
+            taskqueue.Task(payload=json.dumps(push._asdict()), method="PULL",
+                           tag=branch))
+        # Every push in the same window names the same drain task, so only
+        # the first schedules one
+        name = "drain-%s-%d" % (hashlib.sha1(_bytes(branch)).hexdigest()[:16],
+                                int(push.received // self.window))
+        try:
+            taskqueue.add(name=name, url=self.drain_url, params={"tag": branch},
+                          countdown=self.window)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    def drain(self, branch):
+        """
+        Process the newest push queued for branch, discarding the rest
+
+        If processing fails the pushes are put back before re-raising, so
+        the drain task's retry finds them rather than an empty queue.
+        """
+        queue = taskqueue.Queue(self.pull_queue)
+        tasks = queue.lease_tasks_by_tag(60, 1000, tag=branch)
+        if not tasks:
+            return 0
+        pushes = [Push(**json.loads(task.payload)) for task in tasks]
+        try:
+            self.processor(max(pushes, key=lambda push: push.received))
+        except Exception:
+            for task in tasks:
+                queue.modify_task_lease(task, 0)
+            raise
+        queue.delete_tasks(tasks)
+        self.log.info("Processed %d pushes to %s", len(tasks), branch)
+        return len(tasks)
+
+
+def push_queue(app):
+    """
+    The app's push queue, created on first use from its config
+    """
+    queue = app.registry.get("push_queue")
+    if queue is None:
+        processor = PushProcessor(GithubEndpoint(app.config.get("github_token")),
+                                  organisation=app.config.get("organisation",
+                                                              "theopencorps"))
+        queue = (TaskPushQueue(processor) if taskqueue is not None
+                 else LocalPushQueue(processor))
+        queue = app.registry.setdefault("push_queue", queue)
+    return queue
+
+
+def travis_endpoint(app):
+    endpoint = app.registry.get("travis")
+    if endpoint is None:
+        endpoint = app.registry.setdefault(
+            "travis", TravisEndpoint(app.config.get("travis_token")))
+    return endpoint
+
+
+def result_recorder(app):
+    recorder = app.registry.get("result_recorder")
+    if recorder is None:
+        recorder = app.registry.setdefault(
+            "result_recorder", ResultRecorder(travis_endpoint(app), results_store(app)))
+    return recorder
+
+
+_RECORDING = Executor(2, name="results")
+
+
+def record_result(app, result, url="/tasks/results"):
+    """
+    Record a build's results in the background: in a task handled by
+    RecordResults on App Engine, otherwise on a worker thread
+    """
+    if taskqueue is not None:
+        taskqueue.add(url=url, params={"result": json.dumps(result._asdict())})
+    else:
+        _RECORDING.submit(result_recorder(app), result)
+
+
+def deliveries(app):
+    found = app.registry.get("deliveries")
+    if found is None:
+        found = app.registry.setdefault(
+            "deliveries", Deliveries(shared=APIEndpointBase.shared_cache))
+    return found
+
+
+class GithubWebhook(webapp2.RequestHandler):
+    """
+    Receives push events from the webhooks created by create_webhook
+    """
+    def post(self):
+        secret = self.app.config.get("webhook_secret")
+        body = self.request.body
+        if not secret or not verify_signature(
+                secret, body, self.request.headers.get("X-Hub-Signature")):
+            self.abort(403)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        event = self.request.headers.get("X-GitHub-Event")
+        if event != "push":
+            self.response.write("Ignored %s" % event)
+            return
+
+        delivery = self.request.headers.get("X-GitHub-Delivery")
+        if delivery and deliveries(self.app).known(delivery):
+            self.response.write("Duplicate delivery")
+            return
+
+        try:
+            payload = json.loads(body)
+            moved = parse_head_moved(payload)
+            push = parse_push(payload)
+        except (ValueError, KeyError):
+            self.abort(400)
+        if moved is not None:
+            invalidation_bus(self.app).publish(moved)
+        if push is not None:
+            push_queue(self.app).add(push)
+        # Only now is it safe to drop a redelivery.  Should another instance
+        # have claimed it meanwhile the push is queued twice, and coalesced.
+        if delivery:
+            deliveries(self.app).seen(delivery)
+        self.response.set_status(202)
+        self.response.write("Queued")
+
+
+class DrainPushes(webapp2.RequestHandler):
+    """
+    Drain task scheduled by TaskPushQueue
+    """
+    def post(self):
+        if "X-AppEngine-QueueName" not in self.request.headers:
+            self.abort(403)
+        push_queue(self.app).drain(self.request.get("tag"))
+
+
+class TravisWebhook(webapp2.RequestHandler):
+    """
+    Receives build notifications (notifications: webhooks: in .travis.yml)
+    """
+    def post(self):
+        payload = self.request.get("payload")
+        if not payload:
+            self.abort(400)
+        try:
+            verified = travis_endpoint(self.app).verify_notification(
+                _bytes(payload), self.request.headers.get("Signature", ""))
+        except HTTPException:
+            # Can't fetch the key to check it against
+            self.abort(503)
+        if not verified:
+            self.abort(403)
+
+        try:
+            notification = json.loads(payload)
+            build = parse_build(notification)
+            result = parse_result(notification)
+        except (ValueError, KeyError, TypeError):
+            self.abort(400)
+        invalidation_bus(self.app).publish(build)
+        if result is not None:
+            record_result(self.app, result)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write("Build %d %s" % (build.build_id, build.state))
+
+
+class RecordResults(webapp2.RequestHandler):
+    """
+    Task queued by record_result
+    """
+    def post(self):
+        if "X-AppEngine-QueueName" not in self.request.headers:
+            self.abort(403)
+        result = BuildResult(**json.loads(self.request.get("result")))
+        result_recorder(self.app)(result)